@@ -1,3 +1,12 @@
 from django.contrib import admin
+from api.models import Tombstone
 
-# Register your models here.
+
+@admin.register(Tombstone)
+class TombstoneAdmin(admin.ModelAdmin):
+    list_display = [
+        'model',
+        'object_id',
+        'deleted_at'
+    ]
+    list_filter = ('model', 'deleted_at')
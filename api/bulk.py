@@ -0,0 +1,180 @@
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from client.models import Client, Device, LedgerEntry
+from storage.models import Part
+from ticket.models import Ticket, TicketStatus, Charges, schedule_pdf
+
+# the fields a ticket of a batch may have, client, device, status and charges are resolved separately
+TICKET_FIELDS = ('problem', 'diagnosis', 'actions', 'work_charge', 'delivered', 'discharge_date')
+CHARGE_FIELDS = ('charge', 'serial_number')
+
+
+def to_id(value):
+    """
+    returns the value as an id, raises ValueError if it's not one
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(value)
+    return int(value)
+
+
+class TicketItem:
+    """
+    A ticket of a batch with its charges, the ids of the rows it references and the errors found
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.errors = {}
+        self.ticket = None
+        self.charges = []
+        self.client_id = self.device_id = self.status = None
+        self.part_ids = []
+        if not isinstance(data, dict):
+            self.errors['__all__'] = ['A ticket must be an object']
+            return
+        unknown = set(data) - set(TICKET_FIELDS) - {'client', 'device', 'status', 'charges'}
+        if unknown:
+            self.errors['__all__'] = ['Unknown fields {0}'.format(', '.join(sorted(unknown)))]
+        for name in ('client', 'device'):
+            try:
+                setattr(self, name + '_id', to_id(data.get(name)))
+            except ValueError:
+                self.errors[name] = ['A valid id is required']
+        self.status = data.get('status')
+        if not isinstance(self.status, str) or not self.status:
+            self.errors['status'] = ['A status name is required']
+        self.ticket = Ticket(**{name: data[name] for name in TICKET_FIELDS if name in data})
+        try:
+            self.ticket.full_clean(exclude=['client', 'device', 'status'])
+        except ValidationError as exc:
+            self.errors.update(exc.message_dict)
+        discharge_date = self.ticket.discharge_date
+        if isinstance(discharge_date, datetime) and settings.USE_TZ and timezone.is_naive(discharge_date):
+            self.ticket.discharge_date = timezone.make_aware(discharge_date)
+        charges = data.get('charges', [])
+        if not isinstance(charges, list):
+            self.errors['charges'] = ['A list of charges is required']
+            return
+        for number, charge in enumerate(charges):
+            self.add_charge(number, charge)
+
+    def add_charge(self, number, data):
+        """
+        validate a charge of the ticket
+        """
+        key = 'charges.{0}'.format(number)
+        if not isinstance(data, dict):
+            self.errors[key] = ['A charge must be an object']
+            return
+        try:
+            part_id = to_id(data.get('part'))
+        except ValueError:
+            self.errors[key + '.part'] = ['A valid id is required']
+            part_id = None
+        charge = Charges(part_id=part_id, **{name: data[name] for name in CHARGE_FIELDS if name in data})
+        try:
+            charge.full_clean(exclude=['ticket', 'part'])
+        except ValidationError as exc:
+            self.errors.update({'{0}.{1}'.format(key, name): messages for name, messages in exc.message_dict.items()})
+        self.charges.append(charge)
+        self.part_ids.append(part_id)
+
+    def resolve(self, clients, devices, statuses, parts):
+        """
+        check the references of the ticket against the rows found, and set them
+        """
+        if self.client_id is not None and self.client_id not in clients:
+            self.errors['client'] = ['Client {0} does not exist'.format(self.client_id)]
+        if self.device_id is not None:
+            if self.device_id not in devices:
+                self.errors['device'] = ['Device {0} does not exist'.format(self.device_id)]
+            elif devices[self.device_id] != self.client_id:
+                self.errors['device'] = ['Device {0} belongs to another client'.format(self.device_id)]
+        if self.status and self.status not in statuses:
+            self.errors['status'] = ['Status {0} does not exist'.format(self.status)]
+        for number, part_id in enumerate(self.part_ids):
+            if part_id is not None and part_id not in parts:
+                self.errors['charges.{0}.part'.format(number)] = ['Part {0} does not exist'.format(part_id)]
+        if self.errors:
+            return
+        self.ticket.client_id = self.client_id
+        self.ticket.device_id = self.device_id
+        self.ticket.status_id = statuses[self.status]
+        # the costs the charges add up to, the same that saving them one by one would give
+        self.ticket.parts_total = sum((Decimal(charge.charge) for charge in self.charges), Decimal(0))
+        self.ticket.total_cost = self.ticket.parts_total + Decimal(self.ticket.work_charge)
+        # full_clean ran before the costs were added up, check they fit their columns
+        for name in ('parts_total', 'total_cost'):
+            try:
+                Ticket._meta.get_field(name).clean(getattr(self.ticket, name), self.ticket)
+            except ValidationError as exc:
+                self.errors[name] = exc.messages
+
+
+def create_tickets(rows):
+    """
+    Validate a batch of tickets with their charges and insert the valid ones in one transaction.
+    The referenced clients, devices, statuses and parts are loaded with one query each.
+    :return: a list with the id of every ticket created or the errors of the invalid ones, in the order of the rows
+    """
+    items = [TicketItem(row) for row in rows]
+    clients = set(Client.objects.filter(
+        pk__in={item.client_id for item in items} - {None}
+    ).values_list('pk', flat=True))
+    devices = dict(Device.objects.filter(
+        pk__in={item.device_id for item in items} - {None}
+    ).values_list('pk', 'client_id'))
+    statuses = dict(TicketStatus.objects.filter(
+        status__in={item.status for item in items if isinstance(item.status, str)}
+    ).values_list('status', 'pk'))
+    parts = set(Part.objects.filter(
+        pk__in={part_id for item in items for part_id in item.part_ids} - {None}
+    ).values_list('pk', flat=True))
+    for item in items:
+        item.resolve(clients, devices, statuses, parts)
+    valid = [item for item in items if not item.errors]
+    if valid:
+        with transaction.atomic():
+            insert(valid)
+    return [{'errors': item.errors} if item.errors else {'id': item.ticket.pk} for item in items]
+
+
+def insert(items):
+    """
+    insert the tickets and their charges and post their costs to the ledger of the clients
+    """
+    tickets = [item.ticket for item in items]
+    if connection.features.can_return_ids_from_bulk_insert:
+        Ticket.objects.bulk_create(tickets)
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(client_id=ticket.client_id, ticket_id=ticket.pk, amount=ticket.total_cost,
+                        description='Ticket')
+            for ticket in tickets if ticket.total_cost
+        ])
+        owed = defaultdict(Decimal)
+        for ticket in tickets:
+            owed[ticket.client_id] += ticket.total_cost
+        for client_id, amount in owed.items():
+            if amount:
+                Client.objects.filter(pk=client_id).update(balance=F('balance') + amount)
+        for ticket in tickets:
+            # bulk_create sends no signals, render the pdf the way the post_save of the ticket does
+            if ticket.discharge_date or ticket.delivered:
+                transaction.on_commit(lambda pk=ticket.pk: schedule_pdf(pk))
+    else:
+        # without the ids of the inserted rows the charges can't reference their tickets,
+        # save the tickets one by one, their save() posts the costs to the ledger
+        for ticket in tickets:
+            ticket.save()
+    for item in items:
+        for charge in item.charges:
+            charge.ticket_id = item.ticket.pk
+    # the costs of the tickets include the charges already
+    Charges.objects.bulk_create([charge for item in items for charge in item.charges])
@@ -0,0 +1,96 @@
+import time
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction, reset_queries
+from django.test import RequestFactory
+from client.models import Client, Device, DeviceModel, DeviceType
+from ticket.models import Ticket, TicketStatus
+from api.views import resource_list
+from utils.pagination import encode_cursor
+
+# tickets written by every insert of the fixtures
+INSERT_BATCH = 10000
+
+
+class Rollback(Exception):
+    """
+    raised to roll back the fixtures created in the database
+    """
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the requests per second of the ticket list of the api, ' \
+           'adding fixture tickets up to the given number and rolling them back at the end.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tickets', type=int, default=1000000, help='tickets in the table during the benchmark')
+        parser.add_argument('--requests', type=int, default=200, help='requests of every case')
+        parser.add_argument('--limit', type=int, default=50, help='rows of every page')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.create_tickets(options['tickets'])
+                self.run(options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def create_tickets(self, count):
+        """
+        add fixture tickets until the table has count of them
+        """
+        missing = count - Ticket.objects.count()
+        if missing <= 0:
+            return
+        client = Client.objects.create(first_name='Γιώργος', last_name='Παπαδόπουλος', phone='2101234567')
+        device = Device.objects.create(client=client, model=DeviceModel.objects.get_or_create(name='Benchmark')[0],
+                                       type=DeviceType.objects.get_or_create(type='Laptop')[0])
+        status, _ = TicketStatus.objects.get_or_create(status='Open')
+        started = time.perf_counter()
+        for start in range(0, missing, INSERT_BATCH):
+            Ticket.objects.bulk_create([
+                Ticket(client=client, device=device, status=status, problem='Benchmark',
+                       work_charge=Decimal('25.00'), total_cost=Decimal('25.00'))
+                for _ in range(min(INSERT_BATCH, missing - start))
+            ])
+        self.stdout.write('Added {0} tickets in {1:.1f} s'.format(missing, time.perf_counter() - started))
+
+    def run(self, options):
+        """
+        time the requests of every case and print the requests per second
+        """
+        factory = RequestFactory()
+        user = User(username='benchmark', is_staff=True, is_active=True)
+        limit = options['limit']
+        # the cursor of a page near the end of the table
+        last = Ticket.objects.order_by('-pk').values_list('pk', flat=True)[limit:limit + 1].first()
+        cases = [
+            ('first page', {'limit': limit}),
+            ('deep page', {'limit': limit, 'cursor': encode_cursor([last or 0])}),
+            ('sparse fields', {'limit': limit, 'fields': 'id,status,total_cost'}),
+            ('filtered', {'limit': limit, 'delivered': 'false', 'order': '-admission_date'}),
+        ]
+        self.stdout.write('{0:<16}{1:>10}{2:>10}{3:>12}'.format('case', 'req/s', '304 req/s', 'bytes'))
+        for name, params in cases:
+            elapsed, response = self.time(factory, user, params, options['requests'])
+            elapsed_304, response_304 = self.time(factory, user, params, options['requests'],
+                                                  HTTP_IF_NONE_MATCH=response['ETag'])
+            assert response_304.status_code == 304
+            self.stdout.write('{0:<16}{1:>10.1f}{2:>10.1f}{3:>12}'.format(
+                name, options['requests'] / elapsed, options['requests'] / elapsed_304, len(response.content)))
+
+    @staticmethod
+    def time(factory, user, params, requests, **headers):
+        """
+        :return: the seconds the requests took and the last response
+        """
+        started = time.perf_counter()
+        for _ in range(requests):
+            # the debug mode keeps every query in memory
+            reset_queries()
+            request = factory.get('/api/tickets/', params, **headers)
+            request.user = user
+            response = resource_list(request, 'tickets')
+        return time.perf_counter() - started, response
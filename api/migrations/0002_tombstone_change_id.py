@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from api.triggers import create_change_id_trigger, drop_change_id_trigger
+
+
+def create_trigger(apps, schema_editor):
+    create_change_id_trigger(schema_editor, 'api_tombstone')
+
+
+def drop_trigger(apps, schema_editor):
+    drop_change_id_trigger(schema_editor, 'api_tombstone')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_tombstone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tombstone',
+            name='change_id',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['model', 'change_id', 'id'], name='api_tombsto_model_9f8721_idx'),
+        ),
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
@@ -1,3 +1,36 @@
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from client.models import Payment
+from ticket.models import Ticket
 
-# Create your models here.
+
+class Tombstone(models.Model):
+    """
+    A deleted ticket or payment, kept so the change feed can tell the clients that synced it to remove it
+    """
+    model = models.CharField(max_length=20)
+    object_id = models.IntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+    # the id of the transaction of the delete, set by a trigger on postgresql and read by the change feed
+    change_id = models.BigIntegerField(default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            # the deletes of a model since a time
+            models.Index(fields=['model', 'deleted_at', 'id']),
+            # the deletes of a model since a transaction
+            models.Index(fields=['model', 'change_id', 'id']),
+        ]
+
+    def __str__(self):
+        return " ".join([self.model, str(self.object_id)])
+
+
+@receiver(post_delete, sender=Ticket)
+@receiver(post_delete, sender=Payment)
+def record_tombstone(sender, instance, **kwargs):
+    """
+    record the delete of the ticket or the payment for the change feed
+    """
+    Tombstone.objects.create(model=sender._meta.model_name, object_id=instance.pk)
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from client.adminfilters import SubscriptionExpirationFilter, SubscriptionStatusFilter, ClientBalanceFilter
+from client.models import Client, Device, Subscription, Payment
+from ticket.adminfilters import TicketDeliveredFilter
+from ticket.models import Ticket
+
+
+class Resource:
+    """
+    Describes what the api returns for a model.
+    The fields are read with values() so the related rows come with joins in the same query,
+    a dotted name is returned as a nested object: client.first_name is {"client": {"first_name": ...}}.
+    """
+    model = None
+    # the fields of the resource as name: field lookup
+    fields = OrderedDict()
+    # the orderings accepted by the list, the last field of every ordering must be unique
+    orderings = OrderedDict([
+        ('id', ['pk']),
+        ('-id', ['-pk']),
+    ])
+    # query string parameters filtering on a field: parameter: field lookup
+    filters = {}
+    # admin list filters applied with their own query string parameters
+    list_filters = []
+    # the field with the time a row was last changed, for the Last-Modified header of the detail
+    last_modified = None
+
+    def get_queryset(self):
+        return self.model.objects.all()
+
+
+class TicketResource(Resource):
+    model = Ticket
+    fields = OrderedDict([
+        ('id', 'pk'),
+        ('client.id', 'client_id'),
+        ('client.first_name', 'client__first_name'),
+        ('client.last_name', 'client__last_name'),
+        ('device.id', 'device_id'),
+        ('device.model', 'device__model__name'),
+        ('device.serial_number', 'device__serial_number'),
+        ('status', 'status__status'),
+        ('admission_date', 'admission_date'),
+        ('discharge_date', 'discharge_date'),
+        ('delivered', 'delivered'),
+        ('problem', 'problem'),
+        ('diagnosis', 'diagnosis'),
+        ('actions', 'actions'),
+        ('work_charge', 'work_charge'),
+        ('parts_total', 'parts_total'),
+        ('total_cost', 'total_cost'),
+        ('updated_at', 'updated_at'),
+    ])
+    orderings = OrderedDict([
+        ('id', ['pk']),
+        ('-id', ['-pk']),
+        ('admission_date', ['admission_date', 'pk']),
+        ('-admission_date', ['-admission_date', '-pk']),
+    ])
+    filters = {
+        'client': 'client_id',
+        'device': 'device_id',
+        'status': 'status__status',
+    }
+    list_filters = [TicketDeliveredFilter]
+    last_modified = 'updated_at'
+
+
+class ClientResource(Resource):
+    model = Client
+    fields = OrderedDict([
+        ('id', 'pk'),
+        ('first_name', 'first_name'),
+        ('last_name', 'last_name'),
+        ('phone', 'phone'),
+        ('mobile', 'mobile'),
+        ('email', 'email'),
+        ('comment', 'comment'),
+        ('balance', 'balance'),
+    ])
+    list_filters = [ClientBalanceFilter]
+
+
+class DeviceResource(Resource):
+    model = Device
+    fields = OrderedDict([
+        ('id', 'pk'),
+        ('client.id', 'client_id'),
+        ('client.first_name', 'client__first_name'),
+        ('client.last_name', 'client__last_name'),
+        ('model', 'model__name'),
+        ('type', 'type__type'),
+        ('serial_number', 'serial_number'),
+        ('description', 'description'),
+        ('comment', 'comment'),
+    ])
+    filters = {
+        'client': 'client_id',
+    }
+
+
+class SubscriptionResource(Resource):
+    model = Subscription
+    fields = OrderedDict([
+        ('id', 'pk'),
+        ('client.id', 'client_id'),
+        ('client.first_name', 'client__first_name'),
+        ('client.last_name', 'client__last_name'),
+        ('type', 'type__description'),
+        ('description', 'description'),
+        ('create_date', 'create_date'),
+        ('status', 'payment_status'),
+        ('paid_until', 'current_paid_until'),
+        ('last_paid_on', 'last_paid_on'),
+    ])
+    orderings = OrderedDict([
+        ('id', ['pk']),
+        ('-id', ['-pk']),
+        ('paid_until', ['current_paid_until', 'pk']),
+        ('-paid_until', ['-current_paid_until', '-pk']),
+    ])
+    filters = {
+        'client': 'client_id',
+    }
+    list_filters = [SubscriptionStatusFilter, SubscriptionExpirationFilter]
+
+    def get_queryset(self):
+        return Subscription.objects.with_payment_status()
+
+
+class PaymentResource(Resource):
+    model = Payment
+    fields = OrderedDict([
+        ('id', 'pk'),
+        ('client.id', 'client_id'),
+        ('client.first_name', 'client__first_name'),
+        ('client.last_name', 'client__last_name'),
+        ('subscription.id', 'subscription_id'),
+        ('subscription.description', 'subscription__description'),
+        ('duration', 'duration'),
+        ('amount', 'amount'),
+        ('paid_on', 'paid_on'),
+        ('paid_until', 'paid_until'),
+        ('updated_at', 'updated_at'),
+    ])
+    filters = {
+        'client': 'client_id',
+        'subscription': 'subscription_id',
+    }
+    last_modified = 'updated_at'
+
+
+# the resources by the name of their url
+RESOURCES = OrderedDict([
+    ('tickets', TicketResource()),
+    ('clients', ClientResource()),
+    ('devices', DeviceResource()),
+    ('subscriptions', SubscriptionResource()),
+    ('payments', PaymentResource()),
+])
+
+# the resources with a change feed, their rows have an updated_at and a change_id and their deletes leave a Tombstone
+FEEDS = ('tickets', 'payments')
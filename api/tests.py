@@ -1,3 +1,212 @@
-from django.test import TestCase
+import json
+from datetime import date
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from client.models import Client, Device, DeviceType, Subscription, SubscriptionType, Payment, LedgerEntry
+from storage.models import Part
+from ticket.models import Ticket, TicketStatus
+from api.bulk import create_tickets
+from api.resources import RESOURCES
+from utils.pagination import encode_cursor
 
-# Create your tests here.
+
+class APIFixtures:
+    """
+    Logs in a staff user and creates a client with a device and the Open status
+    """
+
+    def setUp(self):
+        super(APIFixtures, self).setUp()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+        self.status = TicketStatus.objects.create(status='Open')
+        self.device_type = DeviceType.objects.create(type='Laptop')
+        self.owner = self.create_client('Owner')
+
+    def create_client(self, name):
+        client = Client.objects.create(first_name=name, last_name=name)
+        client.device = Device.objects.create(client=client, serial_number='SN' + name, type=self.device_type)
+        return client
+
+    def create_ticket(self, client=None):
+        client = client or self.owner
+        return Ticket.objects.create(client=client, device=client.device, status=self.status, problem='Broken')
+
+    def get_json(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response, json.loads(response.content.decode('utf-8'))
+
+
+class ResourceListTests(APIFixtures, TestCase):
+    """
+    The keyset pages of the list have every row once, also when the sorted values are tied or null
+    """
+
+    def walk(self, name, order):
+        """
+        :return: the ids of the rows of every page in order
+        """
+        response, page = self.get_json('/api/{0}/'.format(name), order=order, limit=3)
+        ids = [row['id'] for row in page['results']]
+        while page['next']:
+            response, page = self.get_json(page['next'])
+            ids.extend(row['id'] for row in page['results'])
+        return ids
+
+    def test_tied_admission_dates(self):
+        tickets = [self.create_ticket() for _ in range(10)]
+        # half of the tickets were admitted at the same time
+        Ticket.objects.filter(pk__in=[ticket.pk for ticket in tickets[::2]]).update(
+            admission_date=tickets[0].admission_date)
+        for order in ('admission_date', '-admission_date', 'id', '-id'):
+            ids = self.walk('tickets', order)
+            self.assertEqual(len(ids), len(set(ids)))
+            self.assertEqual(ids, list(Ticket.objects.order_by(
+                *RESOURCES['tickets'].orderings[order]).values_list('pk', flat=True)))
+
+    def test_null_paid_until(self):
+        subscription_type = SubscriptionType.objects.create(description='Hosting')
+        for number in range(10):
+            subscription = Subscription.objects.create(client=self.owner, type=subscription_type,
+                                                       description=str(number))
+            if number % 3:
+                Payment.objects.create(subscription=subscription, client=self.owner, amount=Decimal('10.00'),
+                                       paid_on=date(2020, 1 + number % 2, 1))
+        for order in ('paid_until', '-paid_until'):
+            ids = self.walk('subscriptions', order)
+            self.assertEqual(len(ids), len(set(ids)))
+            self.assertCountEqual(ids, Subscription.objects.values_list('pk', flat=True))
+
+    def test_filters_and_etag(self):
+        other = self.create_client('Other')
+        ticket = self.create_ticket(other)
+        self.create_ticket()
+        response, page = self.get_json('/api/tickets/', client=other.pk)
+        self.assertEqual([row['id'] for row in page['results']], [ticket.pk])
+        self.assertEqual(page['results'][0]['client']['first_name'], 'Other')
+        response = self.client.get('/api/tickets/', {'client': other.pk}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/api/tickets/', {'order': 'problem'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/parts/').status_code, 404)
+        self.client.logout()
+        self.assertNotEqual(self.client.get('/api/tickets/').status_code, 200)
+
+    def test_no_last_modified_on_list(self):
+        ticket = self.create_ticket()
+        response, page = self.get_json('/api/tickets/')
+        self.assertNotIn('Last-Modified', response)
+        response, row = self.get_json('/api/tickets/{0}/'.format(ticket.pk))
+        self.assertIn('Last-Modified', response)
+
+
+class BulkCreateTests(APIFixtures, TestCase):
+    """
+    The valid tickets of a batch are created with their costs in the ledger, the invalid ones get their errors
+    """
+
+    def setUp(self):
+        super(BulkCreateTests, self).setUp()
+        self.other = self.create_client('Other')
+        self.part = Part.objects.create(part='Disk')
+
+    def ticket(self, owner=None, **data):
+        owner = owner or self.owner
+        return dict({'client': owner.pk, 'device': owner.device.pk, 'status': 'Open', 'problem': 'Broken'}, **data)
+
+    def test_errors_by_item(self):
+        results = create_tickets([
+            self.ticket(work_charge='20.00', charges=[{'part': self.part.pk, 'charge': '12.50'}]),
+            self.ticket(device=self.other.device.pk),
+            self.ticket(status='Missing', charges=[{'part': 0, 'charge': '1.00'}]),
+            self.ticket(charges=[{'part': self.part.pk, 'charge': 'many'}]),
+            # every charge and the parts total fit their columns but the total cost does not
+            self.ticket(work_charge='9999.99', charges=[{'part': self.part.pk, 'charge': '9999.99'}] * 100),
+            'ticket',
+            self.ticket(self.other, charges=[{'part': self.part.pk, 'charge': '5.00'}] * 2),
+        ])
+        self.assertIn('id', results[0])
+        self.assertEqual(list(results[1]['errors']), ['device'])
+        self.assertEqual(set(results[2]['errors']), {'status', 'charges.0.part'})
+        self.assertEqual(list(results[3]['errors']), ['charges.0.charge'])
+        self.assertEqual(list(results[4]['errors']), ['total_cost'])
+        self.assertEqual(list(results[5]['errors']), ['__all__'])
+        self.assertIn('id', results[6])
+        self.assertEqual(Ticket.objects.count(), 2)
+        self.assertEqual(Ticket.objects.get(pk=results[0]['id']).total_cost, Decimal('32.50'))
+        self.assertEqual(Ticket.objects.get(pk=results[6]['id']).parts_total, Decimal('10.00'))
+        for client, balance in ((self.owner, Decimal('32.50')), (self.other, Decimal('10.00'))):
+            client.refresh_from_db()
+            self.assertEqual(client.balance, balance)
+            self.assertEqual(sum(client.ledger.values_list('amount', flat=True)), balance)
+
+    def test_request(self):
+        response = self.client.post('/api/tickets/bulk/', json.dumps([self.ticket(), self.ticket(client=0)]),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['created'], 1)
+        self.assertIn('client', data['results'][1]['errors'])
+        self.assertFalse(LedgerEntry.objects.filter(amount=0).exists())
+
+
+@override_settings(CHANGES_LAG=0)
+class ChangeFeedTests(APIFixtures, TransactionTestCase):
+    """
+    A client that follows the cursor of the feed gets the updates and the deletes made after its last sync.
+    The changes are committed since the feed of postgresql reads only the finished transactions,
+    and the other databases read the changes older than CHANGES_LAG, which is 0 here.
+    """
+
+    def sync(self, cursor=None):
+        """
+        read the feed from the cursor to its end
+        :return: the ids changed, the ids deleted and the cursor to continue from
+        """
+        changed, deleted, more = [], [], True
+        while more:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            response, page = self.get_json('/api/tickets/changes/', **params)
+            changed.extend(row['id'] for row in page['changed'])
+            deleted.extend(page['deleted'])
+            cursor, more = page['cursor'], page['more']
+        return changed, deleted, cursor
+
+    def test_updates_and_deletes(self):
+        tickets = [self.create_ticket() for _ in range(5)]
+        changed, deleted, cursor = self.sync()
+        self.assertEqual(changed, [ticket.pk for ticket in tickets])
+        self.assertEqual(deleted, [])
+        # nothing new since the last sync
+        self.assertEqual(self.sync(cursor)[:2], ([], []))
+        tickets[1].problem = 'Still broken'
+        tickets[1].save()
+        removed = tickets[3].pk
+        tickets[3].delete()
+        new = self.create_ticket()
+        changed, deleted, cursor = self.sync(cursor)
+        self.assertEqual(changed, [tickets[1].pk, new.pk])
+        self.assertEqual(deleted, [removed])
+        self.assertEqual(self.sync(cursor)[:2], ([], []))
+
+    def test_bulk_update(self):
+        tickets = [self.create_ticket() for _ in range(3)]
+        changed, deleted, cursor = self.sync()
+        # the queryset updates touch updated_at too
+        Ticket.objects.filter(pk__in=[tickets[0].pk, tickets[2].pk]).update(problem='Fixed')
+        changed, deleted, cursor = self.sync(cursor)
+        self.assertCountEqual(changed, [tickets[0].pk, tickets[2].pk])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/tickets/changes/', {'cursor': 'x'})
+        self.assertEqual(response.status_code, 400)
+        if connection.vendor == 'postgresql':
+            # a cursor of the time ordering used before the transaction ids
+            cursor = encode_cursor([timezone.now(), 1, None, None])
+            self.assertEqual(self.client.get('/api/tickets/changes/', {'cursor': cursor}).status_code, 400)
+        self.assertEqual(self.client.get('/api/clients/changes/').status_code, 404)
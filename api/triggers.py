@@ -0,0 +1,36 @@
+"""
+The triggers that keep the change_id of the tables of the change feed, created by the migrations of the tables
+"""
+
+
+def create_change_id_trigger(schema_editor, table):
+    """
+    Set the change_id of every row written to the table to the id of the transaction that writes it,
+    only on postgresql. The rows written before the trigger are given the id of the transaction of the migration,
+    so the feed reads them before every change made after it. The cursors handed out before the migration
+    hold times instead of transaction ids and are refused, their clients sync again from the start.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        """
+        CREATE FUNCTION {0}_change_id() RETURNS trigger AS $$
+        BEGIN
+            NEW.change_id := txid_current();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """.format(table)
+    )
+    schema_editor.execute(
+        'CREATE TRIGGER {0}_change_id BEFORE INSERT OR UPDATE ON {0} '
+        'FOR EACH ROW EXECUTE PROCEDURE {0}_change_id()'.format(table)
+    )
+    schema_editor.execute('UPDATE {0} SET change_id = txid_current() WHERE change_id = 0'.format(table))
+
+
+def drop_change_id_trigger(schema_editor, table):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP TRIGGER {0}_change_id ON {0}'.format(table))
+    schema_editor.execute('DROP FUNCTION {0}_change_id()'.format(table))
@@ -0,0 +1,10 @@
+from django.conf.urls import url
+from api.views import resource_list, resource_detail, resource_changes, ticket_bulk_create
+
+
+urlpatterns = [
+    url(r'^tickets/bulk/$', ticket_bulk_create),
+    url(r'^(?P<name>\w+)/$', resource_list),
+    url(r'^(?P<name>\w+)/changes/$', resource_changes),
+    url(r'^(?P<name>\w+)/(?P<pk>\d+)/$', resource_detail)
+]
\ No newline at end of file
@@ -1,3 +1,274 @@
-from django.shortcuts import render
+import hashlib
+import json
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.http import HttpResponse, HttpResponseBadRequest, Http404, JsonResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag, http_date
+from django.views.decorators.http import require_safe, require_POST
+from api.bulk import create_tickets
+from api.models import Tombstone
+from api.resources import RESOURCES, FEEDS
+from utils.pagination import InvalidCursor, encode_cursor, decode_cursor, keyset_filter
 
-# Create your views here.
+# rows of a page when the limit is not given and the most a page can have
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+# the most tickets a bulk request can create
+MAX_BULK = 500
+
+
+def selected_fields(resource, params):
+    """
+    returns the fields of the resource picked by the fields parameter, all of them when it's missing.
+    A name of a nested object like client picks all of its fields.
+    """
+    if not params.get('fields'):
+        return resource.fields
+    names = params['fields'].split(',')
+    fields = OrderedDict(
+        (name, lookup) for name, lookup in resource.fields.items()
+        if any(name == picked or name.startswith(picked + '.') for picked in names)
+    )
+    unknown = [picked for picked in names if not any(
+        name == picked or name.startswith(picked + '.') for name in resource.fields
+    )]
+    if unknown:
+        raise ValueError('Unknown fields {0}'.format(','.join(unknown)))
+    return fields
+
+
+def serialize(row, fields):
+    """
+    returns the values of a row as an object, the dotted names as nested objects
+    """
+    data = OrderedDict()
+    for name, lookup in fields.items():
+        target = data
+        *parents, key = name.split('.')
+        for parent in parents:
+            target = target.setdefault(parent, OrderedDict())
+        target[key] = row[lookup]
+    return data
+
+
+def json_response(request, data, last_modified=None):
+    """
+    returns the data as json with an ETag of the content and the Last-Modified time when it's known,
+    or a 304 if the client has the same content already
+    """
+    content = json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False).encode('utf-8')
+    etag = quote_etag(hashlib.md5(content).hexdigest())
+    timestamp = int(last_modified.timestamp()) if last_modified is not None else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    if timestamp is not None:
+        response['Last-Modified'] = http_date(timestamp)
+    # the client has to revalidate every time since the data can change
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def filter_queryset(request, resource, params):
+    """
+    returns the rows of the resource matching the filter of the query string,
+    raises ValueError for the invalid values
+    """
+    queryset = resource.get_queryset()
+    for param, lookup in resource.filters.items():
+        if params.get(param):
+            queryset = queryset.filter(**{lookup: params[param]})
+    # filter the same way the admin does
+    for list_filter in resource.list_filters:
+        filtered = list_filter(request, params, resource.model, None).queryset(request, queryset)
+        if filtered is not None:
+            queryset = filtered
+    return queryset
+
+
+@require_safe
+@staff_member_required
+def resource_list(request, name):
+    """
+    Return a page of the rows of a resource. The query string accepts:
+        fields: comma separated fields to return, all of them by default
+        order: one of the orderings of the resource, id by default
+        limit: the rows of the page, up to MAX_LIMIT
+        cursor: the next cursor of the previous page
+    and the filters of the resource.
+    The pages are read with a keyset filter so every page costs the same however deep it is.
+    """
+    resource = RESOURCES.get(name)
+    if resource is None:
+        raise Http404('Unknown resource')
+    params = request.GET.dict()
+    ordering = resource.orderings.get(params.get('order', 'id'))
+    if ordering is None:
+        return HttpResponseBadRequest('Invalid order')
+    try:
+        fields = selected_fields(resource, params)
+        limit = min(int(params.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        if limit < 1:
+            raise ValueError('Invalid limit')
+        queryset = filter_queryset(request, resource, params).order_by(*ordering)
+        if params.get('cursor'):
+            values = decode_cursor(params['cursor'])
+            if len(values) != len(ordering):
+                raise InvalidCursor(params['cursor'])
+            nulls_largest = connections[queryset.db].features.nulls_order_largest
+            queryset = queryset.filter(keyset_filter(ordering, values, nulls_largest))
+        # the ordering fields come with the row to build the cursor of the next page
+        keys = [term.lstrip('-') for term in ordering]
+        # fetch one more row to know if there is a next page
+        rows = list(queryset.values(*set(fields.values()) | set(keys))[:limit + 1])
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid cursor')
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][key] for key in keys])
+    next_url = None
+    if next_cursor is not None:
+        next_params = request.GET.copy()
+        next_params['cursor'] = next_cursor
+        next_url = '{0}?{1}'.format(request.path, next_params.urlencode())
+    # no Last-Modified, a delete or a change of the filter can bring older rows to the page
+    # so only the ETag of the content tells whether the page changed
+    return json_response(request, OrderedDict([
+        ('results', [serialize(row, fields) for row in rows]),
+        ('next', next_url),
+    ]))
+
+
+@require_safe
+@staff_member_required
+def resource_detail(request, name, pk):
+    """
+    Return one row of a resource, the fields parameter picks the fields like on the list
+    """
+    resource = RESOURCES.get(name)
+    if resource is None:
+        raise Http404('Unknown resource')
+    try:
+        fields = selected_fields(resource, request.GET)
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    extra = [resource.last_modified] if resource.last_modified else []
+    row = resource.get_queryset().filter(pk=pk).values(*set(fields.values()) | set(extra)).first()
+    if row is None:
+        raise Http404('No {0} matches the id'.format(resource.model._meta.verbose_name))
+    return json_response(request, serialize(row, fields), row[resource.last_modified] if extra else None)
+
+
+def changes_bound(db):
+    """
+    Returns the field the changed rows are ordered by, the one of the tombstones and the value the feed reads up to.
+    On postgresql a trigger sets the change_id of every row written to the id of its transaction,
+    and the feed stops before the oldest transaction still running: the transactions that commit later
+    have higher ids, so however long they run their rows are never behind a cursor a client holds.
+    The other databases, used in development, have no transaction ids and the feed stays
+    CHANGES_LAG seconds behind the updated_at of the rows instead.
+    """
+    connection = connections[db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+            return 'change_id', 'change_id', cursor.fetchone()[0]
+    return 'updated_at', 'deleted_at', timezone.now() - timedelta(seconds=settings.CHANGES_LAG)
+
+
+@require_safe
+@staff_member_required
+def resource_changes(request, name):
+    """
+    Return the rows of a resource changed and the ids of the rows deleted since a cursor.
+    The query string accepts:
+        fields: comma separated fields to return, all of them by default
+        limit: the most rows and the most deletes of the page, up to MAX_LIMIT
+        cursor: the cursor of the previous page, without it the feed starts from the first row
+    Every response has the cursor to ask for the next changes with, and more is true while the feed has
+    pages left. The feed only reads the changes of the transactions that have finished, see changes_bound,
+    so a client that synced gets the changes committed after it in its next sync.
+    """
+    if name not in FEEDS:
+        raise Http404('Unknown feed')
+    resource = RESOURCES[name]
+    params = request.GET.dict()
+    queryset = resource.get_queryset()
+    changed_field, deleted_field, until = changes_bound(queryset.db)
+    ordering = [changed_field, 'pk']
+    changed = queryset.filter(**{changed_field + '__lt': until}).order_by(*ordering)
+    deleted = Tombstone.objects.filter(
+        model=resource.model._meta.model_name, **{deleted_field + '__lt': until}
+    ).order_by(deleted_field, 'pk')
+    try:
+        fields = selected_fields(resource, params)
+        limit = min(int(params.get('limit', DEFAULT_LIMIT)), MAX_LIMIT)
+        if limit < 1:
+            raise ValueError('Invalid limit')
+        # the cursor is the position in the changed rows and in the tombstones
+        position = [None] * 4
+        if params.get('cursor'):
+            position = decode_cursor(params['cursor'])
+            if len(position) != 4:
+                raise InvalidCursor(params['cursor'])
+            # the cursors of the feed ordered by time, handed out before the transaction ids, can't be continued
+            if changed_field == 'change_id' and not all(value is None or isinstance(value, int) for value in position):
+                raise InvalidCursor(params['cursor'])
+        if position[0] is not None:
+            changed = changed.filter(keyset_filter(ordering, position[:2]))
+        if position[2] is not None:
+            deleted = deleted.filter(keyset_filter([deleted_field, 'pk'], position[2:]))
+        rows = list(changed.values(*set(fields.values()) | set(ordering))[:limit + 1])
+        tombstones = list(deleted.values_list(deleted_field, 'pk', 'object_id')[:limit + 1])
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid cursor')
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    more = len(rows) > limit or len(tombstones) > limit
+    rows, tombstones = rows[:limit], tombstones[:limit]
+    if rows:
+        position[:2] = [rows[-1][changed_field], rows[-1]['pk']]
+    if tombstones:
+        position[2:] = list(tombstones[-1][:2])
+    return json_response(request, OrderedDict([
+        ('changed', [serialize(row, fields) for row in rows]),
+        ('deleted', [object_id for deleted_at, pk, object_id in tombstones]),
+        ('cursor', encode_cursor(position)),
+        ('more', more),
+    ]))
+
+
+@require_POST
+@staff_member_required
+def ticket_bulk_create(request):
+    """
+    Create a batch of tickets with their charges. The body is a json list of tickets like
+        {"client": 1, "device": 2, "status": "Open", "problem": "...", "work_charge": "20.00",
+         "charges": [{"part": 3, "charge": "12.50", "serial_number": "..."}]}
+    The valid tickets are created in one transaction and the invalid ones are skipped,
+    the response has the id or the errors of every ticket in the order of the request.
+    """
+    try:
+        rows = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid json')
+    if not isinstance(rows, list):
+        return HttpResponseBadRequest('A list of tickets is required')
+    if len(rows) > MAX_BULK:
+        return HttpResponseBadRequest('At most {0} tickets can be created at once'.format(MAX_BULK))
+    results = create_tickets(rows)
+    return JsonResponse(OrderedDict([
+        ('created', sum(1 for result in results if 'id' in result)),
+        ('results', results),
+    ]))
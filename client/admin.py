@@ -1,12 +1,25 @@
 from django.contrib import admin
-from client.models import Client, DeviceType, Device, Subscription, SubscriptionType, Payment, DeviceModel
-from datetime import datetime
-from client.adminfilters import SubscriptionExpirationFilter, SubscriptionTypeFilter
+from client.models import Client, DeviceType, Device, Subscription, SubscriptionType, Payment, DeviceModel, \
+    NotificationLog, OutboxMessage, LedgerEntry
+from client.views import PAYMENT_COLUMNS
+from utils.adminpagination import KeysetPaginationMixin
+from utils.export import export_response
+from client.adminfilters import SubscriptionExpirationFilter, SubscriptionTypeFilter, SubscriptionStatusFilter, \
+    ClientBalanceFilter
 
 
 @admin.register(Client)
 class ClientAdmin(admin.ModelAdmin):
-    pass
+    list_display = [
+        '__str__',
+        'phone',
+        'mobile',
+        'balance'
+    ]
+
+    list_filter = (
+        ClientBalanceFilter,
+    )
 
 
 @admin.register(DeviceModel)
@@ -35,7 +48,7 @@ class SubscriptionsInline(admin.TabularInline):
 
 
 @admin.register(Subscription)
-class SubscriptionAdmin(admin.ModelAdmin):
+class SubscriptionAdmin(KeysetPaginationMixin, admin.ModelAdmin):
     inlines = [
         SubscriptionsInline,
     ]
@@ -51,48 +64,51 @@ class SubscriptionAdmin(admin.ModelAdmin):
     ]
 
     list_filter = (
+        SubscriptionStatusFilter,
         SubscriptionExpirationFilter,
         SubscriptionTypeFilter
     )
 
+    def get_queryset(self, request):
+        """
+        load the client and the type with joins and calculate the payment status in the database
+        """
+        queryset = super(SubscriptionAdmin, self).get_queryset(request)
+        return queryset.select_related('client', 'type').with_payment_status()
+
     def expires_in(self, obj: Subscription):
         """
         returns the expiration date of the last payment
         """
-        last_payment = obj.active_payment()
-        if last_payment:
-            return last_payment.paid_until
+        if obj.current_paid_until:
+            return obj.current_paid_until
         else:
             return 'Never Paid'
+    expires_in.admin_order_field = 'current_paid_until'
 
     def last_payment(self, obj: Subscription):
         """
         return the last payment date
         """
-        last_payment = obj.active_payment()
-        if last_payment:
-            return last_payment.paid_on
+        if obj.last_paid_on:
+            return obj.last_paid_on
         else:
             return 'Never Paid'
+    last_payment.admin_order_field = 'last_paid_on'
 
     def subscription_status(self, obj: Subscription):
         """
         returns the status of the subscription
         """
-        last_payment = obj.active_payment()
-        if last_payment:
-            if last_payment.paid_until < datetime.date(datetime.now()):
-                return 'Expired'
-            else:
-                return 'Active'
-        else:
-            return 'Never Paid'
+        return obj.payment_status
+    subscription_status.admin_order_field = 'payment_status'
 
     def client(self, obj: Subscription):
         """
         return the full name of the client
         """
         return obj.client.full_name()
+    client.admin_order_field = 'client__last_name'
 
 
 @admin.register(SubscriptionType)
@@ -101,9 +117,11 @@ class SubscriptionTypeAdmin(admin.ModelAdmin):
 
 
 @admin.register(Payment)
-class PaymentAdmin(admin.ModelAdmin):
+class PaymentAdmin(KeysetPaginationMixin, admin.ModelAdmin):
     # exclude fields from the admin form
     exclude = ('paid_until',)
+    # load the subscription and the client of the rows with joins
+    list_select_related = ('subscription', 'client')
     # list of fields to display on the table
     list_display = [
         'subscription',
@@ -114,8 +132,67 @@ class PaymentAdmin(admin.ModelAdmin):
         'paid_until'
     ]
 
+    actions = [
+        'export_payments_csv',
+        'export_payments_jsonl'
+    ]
+
     def subscription_client(self, obj: Payment):
         """
         return the client's name
         """
         return obj.client.full_name()
+
+    def export_payments_csv(self, request, queryset):
+        """
+        exports the selected payments into a csv file
+        """
+        return export_response(queryset.order_by('pk'), PAYMENT_COLUMNS, 'csv', 'payments')
+    export_payments_csv.short_description = 'Export selected payments (CSV)'
+
+    def export_payments_jsonl(self, request, queryset):
+        """
+        exports the selected payments into a json lines file
+        """
+        return export_response(queryset.order_by('pk'), PAYMENT_COLUMNS, 'jsonl', 'payments')
+    export_payments_jsonl.short_description = 'Export selected payments (JSON lines)'
+
+
+@admin.register(NotificationLog)
+class NotificationLogAdmin(admin.ModelAdmin):
+    list_select_related = ('subscription',)
+    list_display = [
+        'subscription',
+        'offset_days',
+        'expiry_date',
+        'sent_on',
+        'attempts'
+    ]
+    list_filter = ('sent_on', 'expiry_date')
+
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = [
+        'send_to',
+        'subject',
+        'created_on',
+        'sent_on',
+        'attempts',
+        'last_error'
+    ]
+    list_filter = ('sent_on', 'created_on')
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_select_related = ('client',)
+    list_display = [
+        'client',
+        'amount',
+        'description',
+        'ticket_id',
+        'payment_id',
+        'created_on'
+    ]
+    raw_id_fields = ('client', 'ticket', 'payment')
@@ -1,6 +1,5 @@
 from django.contrib import admin
 from datetime import datetime, timedelta
-from django.db.models import Q
 from client.models import SubscriptionType
 
 
@@ -22,38 +21,62 @@ class SubscriptionExpirationFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         """
-        filter the results based on the value
+        filter the results based on the paid until date of the latest payment of every subscription
         """
         # date of today
         date = datetime.date(datetime.now())
         # filter based on the value of the filter
         if self.value() == 'week':
             week_day = date.weekday()
-            # get the from and to days
+            # get the last day of the week
             # the week is from monday to sunday
-            from_date = date - timedelta(days=week_day)
             to_date = date + timedelta(days=6 - week_day)
             # return the queryset with the right parameters
-            return queryset.filter(Q(payments__paid_until__gte=date) & Q(payments__paid_until__lte=to_date))
+            return queryset.expire_between(date, to_date)
         elif self.value() == 'month':
-            # first day of the month
-            from_date = date - timedelta(days=date.day - 1)
             # get the last day of the month
             if date.month == 12:
                 to_date = date.replace(day=31)
             else:
                 to_date = date.replace(month=date.month + 1, day=1) - timedelta(days=1)
             # return the queryset with the right parameters
-            return queryset.filter(Q(payments__paid_until__gte=date) & Q(payments__paid_until__lte=to_date))
+            return queryset.expire_between(date, to_date)
         elif self.value() == 'year':
-            # get the first and last day of the year
-            from_date = date.replace(month=1, day=1)
+            # get the last day of the year
             to_date = date.replace(month=12, day=31)
             # return the queryset with the right parameters
-            return queryset.filter(Q(payments__paid_until__gte=date) & Q(payments__paid_until__lte=to_date))
+            return queryset.expire_between(date, to_date)
         elif self.value() == 'expired':
-            # return the queryset with the right parameters
-            return queryset.filter(payments__paid_until__lte=date)
+            # the subscriptions that were not renewed
+            return queryset.expired(date)
+
+
+class SubscriptionStatusFilter(admin.SimpleListFilter):
+    # title of the filter
+    title = 'Status'
+    parameter_name = 'status'
+
+    def lookups(self, request, model_admin):
+        """
+        list of the choices for the filter
+        """
+        return (
+            ('Active', 'Active'),
+            ('Expired', 'Expired'),
+            ('Never Paid', 'Never Paid')
+        )
+
+    def queryset(self, request, queryset):
+        """
+        filter the results on the paid until date of the latest payment
+        """
+        date = datetime.date(datetime.now())
+        if self.value() == 'Active':
+            return queryset.filter(current_paid_until__gte=date)
+        elif self.value() == 'Expired':
+            return queryset.expired(date)
+        elif self.value() == 'Never Paid':
+            return queryset.filter(current_paid_until__isnull=True)
 
 
 class SubscriptionTypeFilter(admin.SimpleListFilter):
@@ -72,4 +95,25 @@ class SubscriptionTypeFilter(admin.SimpleListFilter):
         filter the results based on the value
         """
         if self.value():
-            return queryset.filter(type=self.value())
\ No newline at end of file
+            return queryset.filter(type=self.value())
+
+
+class ClientBalanceFilter(admin.SimpleListFilter):
+    # title of the filter
+    title = 'Balance'
+    parameter_name = 'balance'
+
+    def lookups(self, request, model_admin):
+        """
+        list of the choices for the filter
+        """
+        return (
+            ('outstanding', 'Outstanding'),
+        )
+
+    def queryset(self, request, queryset):
+        """
+        filter the clients that owe money
+        """
+        if self.value() == 'outstanding':
+            return queryset.outstanding()
@@ -0,0 +1,49 @@
+import time
+from django.core.management.base import BaseCommand
+from utils.notifications.localsmtp import LocalSMTPServer
+from utils.notifications.mail import MailTransport, build_message, render_notification, send_mass_mail
+
+SEND_FROM = 'hosting@d-h.gr'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark sending the notification emails to a local SMTP server, ' \
+           'with a connection for every email and with one pooled connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200, help='emails sent by every mode')
+        parser.add_argument('--handshake-delay', type=float, default=50,
+                            help='milliseconds the server waits on every new connection')
+
+    def handle(self, *args, **options):
+        server = LocalSMTPServer(handshake_delay=options['handshake_delay'] / 1000)
+        server.start()
+        try:
+            messages = [
+                ('support@d-h.gr', 'Notification {0}'.format(i), {'client': 'Benchmark', 'days': i})
+                for i in range(options['messages'])
+            ]
+            self.report('connection per email', server, lambda: self.send_one_by_one(server.port, messages))
+            self.report('pooled connection', server, lambda: send_mass_mail(
+                messages, send_from=SEND_FROM, server='127.0.0.1', port=server.port, tls=False, username=None))
+        finally:
+            server.stop()
+
+    @staticmethod
+    def send_one_by_one(port, messages):
+        """
+        send every email over a new connection like the notifications used to
+        """
+        for send_to, subject, context in messages:
+            transport = MailTransport('127.0.0.1', port, tls=False)
+            transport.send(SEND_FROM, send_to, build_message(SEND_FROM, send_to, subject, render_notification(context)))
+            transport.close()
+
+    def report(self, name, server, send):
+        connections, messages = server.connections, server.messages
+        start = time.perf_counter()
+        send()
+        elapsed = time.perf_counter() - start
+        sent = server.messages - messages
+        self.stdout.write('{0:<22} {1:>6} emails {2:>4} connections {3:>9.1f} emails/s'.format(
+            name, sent, server.connections - connections, sent / elapsed))
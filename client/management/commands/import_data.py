@@ -0,0 +1,265 @@
+import csv
+import io
+import json
+import sys
+import time
+from collections import OrderedDict
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, models, transaction
+from django.utils import timezone
+from client.models import Client, Device, DeviceModel, DeviceType, Subscription, SubscriptionType, Payment, \
+    LedgerEntry
+from storage.models import Part
+from ticket.models import Ticket, TicketStatus, Charges
+from utils.search import normalize
+
+
+class LookupMap:
+    """
+    Maps the names of the rows of a small table like the device types to their ids,
+    creating the rows of the names that don't exist yet.
+    """
+
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+        self.ids = dict(model.objects.values_list(field, 'pk'))
+
+    def get(self, name):
+        if name not in self.ids:
+            self.ids[name] = self.model.objects.create(**{self.field: name}).pk
+        return self.ids[name]
+
+
+# the tables referenced by name and the field of the name
+LOOKUP_FIELDS = {
+    DeviceModel: 'name',
+    DeviceType: 'type',
+    SubscriptionType: 'description',
+    TicketStatus: 'status',
+    Part: 'part',
+}
+
+
+class Command(BaseCommand):
+    help = 'Import clients, devices, subscriptions, payments, tickets or charges from a CSV or JSON lines file. ' \
+           'The file is read one row at a time and inserted in batches, the foreign keys are ids except for the ' \
+           'device models and types, the subscription types, the ticket statuses and the parts, which are names.'
+
+    # the columns of every entity besides the id, in the order the entities must be imported
+    entities = OrderedDict([
+        ('clients', (Client, ['first_name', 'last_name', 'phone', 'mobile', 'email', 'comment'])),
+        ('devices', (Device, ['client', 'model', 'type', 'serial_number', 'description', 'comment'])),
+        ('subscriptions', (Subscription, ['client', 'type', 'description', 'create_date'])),
+        ('payments', (Payment, ['subscription', 'duration', 'amount', 'paid_on'])),
+        ('tickets', (Ticket, ['client', 'device', 'status', 'admission_date', 'discharge_date', 'delivered',
+                              'problem', 'diagnosis', 'actions', 'work_charge'])),
+        ('charges', (Charges, ['ticket', 'part', 'charge', 'serial_number'])),
+    ])
+
+    def add_arguments(self, parser):
+        parser.add_argument('entity', choices=list(self.entities))
+        parser.add_argument('path', help='the file to import, - for the standard input')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='the format of the file, by default its extension')
+        parser.add_argument('--batch-size', type=int, default=5000, help='rows inserted by every query')
+
+    def handle(self, *args, **options):
+        model, columns = self.entities[options['entity']]
+        file_format = options['format'] or ('jsonl' if options['path'].endswith(('.jsonl', '.json')) else 'csv')
+        self.lookups = {
+            column: LookupMap(field.related_model, LOOKUP_FIELDS[field.related_model])
+            for column, field in ((column, model._meta.get_field(column)) for column in columns)
+            if field.is_relation and field.related_model in LOOKUP_FIELDS
+        }
+        self.returns_ids = connection.features.can_return_ids_from_bulk_insert
+        self.with_ids = False
+        source = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='') if options['path'] == '-' else \
+            open(options['path'], encoding='utf-8', newline='')
+        start = time.perf_counter()
+        total = 0
+        with source:
+            batch = []
+            for number, row in enumerate(self.read(source, file_format), 1):
+                batch.append(self.build(model, columns, row, number))
+                if len(batch) == options['batch_size']:
+                    total += self.insert(model, batch, start, total)
+                    batch = []
+            if batch:
+                total += self.insert(model, batch, start, total)
+        if self.with_ids:
+            # move the id sequence after the imported ids
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [model]):
+                    cursor.execute(sql)
+        elapsed = time.perf_counter() - start
+        self.stdout.write('Imported {0} {1} in {2:.1f}s, {3:.0f} rows/s'.format(
+            total, options['entity'], elapsed, total / elapsed if elapsed else 0))
+
+    @staticmethod
+    def read(source, file_format):
+        """
+        generate the rows of the file as dicts
+        """
+        if file_format == 'csv':
+            yield from csv.DictReader(source)
+            return
+        for number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as exc:
+                raise CommandError('Line {0}: {1}'.format(number, exc))
+
+    def build(self, model, columns, row, number):
+        """
+        convert a row of the file into an unsaved instance of the model
+        """
+        values = {}
+        try:
+            if row.get('id') not in (None, ''):
+                values['id'] = int(row['id'])
+                self.with_ids = True
+            elif not self.returns_ids:
+                raise CommandError('Row {0}: the id column is required on this database'.format(number))
+            for column in columns:
+                field = model._meta.get_field(column)
+                value = row.get(column)
+                if column in self.lookups:
+                    values[field.attname] = self.lookups[column].get(value) if value not in (None, '') else None
+                else:
+                    values[field.attname] = self.convert(field, value)
+        except (ValidationError, ValueError, TypeError) as exc:
+            raise CommandError('Row {0}: {1}'.format(number, exc))
+        return model(**values)
+
+    @staticmethod
+    def convert(field, value):
+        """
+        convert the value of a column to the type of the field, the empty values to its default
+        """
+        if value in (None, ''):
+            if field.null:
+                return None
+            if field.has_default():
+                return field.get_default()
+            if isinstance(field, models.DateTimeField):
+                return timezone.now()
+            if isinstance(field, models.DateField):
+                return datetime.date(datetime.now())
+            if isinstance(field, (models.CharField, models.TextField)):
+                return ''
+            raise ValidationError('{0} is required'.format(field.name))
+        # the ids of the foreign keys as the type of the primary key they reference
+        value = field.target_field.to_python(value) if field.is_relation else field.to_python(value)
+        if isinstance(value, datetime) and settings.USE_TZ and timezone.is_naive(value):
+            value = timezone.make_aware(value)
+        return value
+
+    def insert(self, model, batch, start, imported):
+        """
+        insert a batch with its derived values and report the progress
+        :return: the number of rows inserted
+        """
+        with transaction.atomic():
+            getattr(self, 'prepare_' + model._meta.model_name)(batch)
+            model.objects.bulk_create(batch)
+            getattr(self, 'update_' + model._meta.model_name)(batch)
+        imported += len(batch)
+        elapsed = time.perf_counter() - start
+        self.stdout.write('{0} rows, {1:.0f} rows/s'.format(imported, imported / elapsed if elapsed else 0))
+        return len(batch)
+
+    # the values computed before the insert, the save() of the models does the same for a single row
+
+    @staticmethod
+    def prepare_client(batch):
+        for client in batch:
+            client.search_name = normalize(" ".join([client.first_name, client.last_name]))[:61]
+
+    @staticmethod
+    def prepare_device(batch):
+        for device in batch:
+            device.search_serial = normalize(device.serial_number)[:20]
+
+    @staticmethod
+    def prepare_subscription(batch):
+        for subscription in batch:
+            if subscription.create_date is None:
+                subscription.create_date = datetime.date(datetime.now())
+
+    @staticmethod
+    def prepare_payment(batch):
+        # the client of the payments from their subscriptions, with one query
+        clients = dict(Subscription.objects.filter(
+            pk__in={payment.subscription_id for payment in batch}
+        ).values_list('pk', 'client_id'))
+        for payment in batch:
+            if payment.subscription_id not in clients:
+                raise CommandError('Subscription {0} does not exist'.format(payment.subscription_id))
+            payment.client_id = clients[payment.subscription_id]
+            payment.paid_until = payment.paid_on + relativedelta(months=payment.duration)
+
+    @staticmethod
+    def prepare_ticket(batch):
+        for ticket in batch:
+            ticket.total_cost = ticket.parts_total + ticket.work_charge
+
+    @staticmethod
+    def prepare_charges(batch):
+        # the client of the charges from their tickets, with one query
+        clients = dict(Ticket.objects.filter(
+            pk__in={charge.ticket_id for charge in batch}
+        ).values_list('pk', 'client_id'))
+        for charge in batch:
+            if charge.ticket_id not in clients:
+                raise CommandError('Ticket {0} does not exist'.format(charge.ticket_id))
+            charge.client_id = clients[charge.ticket_id]
+
+    # the rows kept up to date by the save() of the models, updated for the whole batch
+
+    @staticmethod
+    def update_client(batch):
+        pass
+
+    @staticmethod
+    def update_device(batch):
+        pass
+
+    @staticmethod
+    def update_subscription(batch):
+        pass
+
+    @staticmethod
+    def update_payment(batch):
+        Subscription.objects.filter(pk__in={payment.subscription_id for payment in batch}).refresh_payments()
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(client_id=payment.client_id, payment_id=payment.pk, amount=-payment.amount,
+                        description='Payment')
+            for payment in batch if payment.amount
+        ])
+        Client.objects.filter(pk__in={payment.client_id for payment in batch}).refresh_balance()
+
+    @staticmethod
+    def update_ticket(batch):
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(client_id=ticket.client_id, ticket_id=ticket.pk, amount=ticket.total_cost,
+                        description='Ticket')
+            for ticket in batch if ticket.total_cost
+        ])
+        Client.objects.filter(pk__in={ticket.client_id for ticket in batch}).refresh_balance()
+
+    @staticmethod
+    def update_charges(batch):
+        Ticket.objects.filter(pk__in={charge.ticket_id for charge in batch}).refresh_costs()
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(client_id=charge.client_id, ticket_id=charge.ticket_id, amount=charge.charge,
+                        description='Charge')
+            for charge in batch if charge.charge
+        ])
+        Client.objects.filter(pk__in={charge.client_id for charge in batch}).refresh_balance()
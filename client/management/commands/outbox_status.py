@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from client.models import OutboxMessage
+
+
+class Command(BaseCommand):
+    help = 'Show the queue depth and the send lag of the email outbox.'
+
+    def handle(self, *args, **options):
+        for name, value in OutboxMessage.objects.metrics().items():
+            self.stdout.write('{0:<14} {1}'.format(name, value))
@@ -0,0 +1,97 @@
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from client.models import Client, LedgerEntry, Payment
+from ticket.models import Ticket
+from utils.backfill import Backfill
+
+
+def total(queryset, field):
+    """
+    the sum of the field of the rows of the queryset that belong to each client, as a subquery
+    """
+    return Coalesce(
+        Subquery(
+            queryset.filter(client=OuterRef('pk')).order_by().values('client').annotate(
+                total=Sum(field)
+            ).values('total'),
+            output_field=models.DecimalField(max_digits=10, decimal_places=2)
+        ),
+        Value(Decimal(0))
+    )
+
+
+class Command(BaseCommand):
+    help = 'Check the ledger and the balance of the clients against their tickets and payments and repair them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='clients checked by every query')
+        parser.add_argument('--sleep', type=float, default=0, help='seconds to wait after every batch')
+        parser.add_argument('--restart', action='store_true', help='start from the first client, not the checkpoint')
+        parser.add_argument('--reseed', action='store_true',
+                            help='replace the entries of every client with one entry per ticket and payment')
+        parser.add_argument('--dry-run', action='store_true', help='report the drift without repairing it')
+
+    def handle(self, *args, **options):
+        self.options = options
+        backfill = Backfill(
+            'rebuild_ledger_reseed' if options['reseed'] else 'rebuild_ledger', Client.objects.all(),
+            batch_size=options['batch_size'], sleep=options['sleep'], checkpoint=not options['dry_run'],
+            report=self.stdout.write
+        )
+        if options['restart']:
+            backfill.reset()
+        checked, repaired = backfill.run(self.repair)
+        self.stdout.write('{0} clients checked, {1} {2}'.format(
+            checked, repaired, 'drifted' if options['dry_run'] else 'repaired'))
+
+    def repair(self, batch):
+        """
+        check the clients of a batch and repair them
+        :return: the number of clients repaired
+        """
+        # lock the clients so the entries posted meanwhile wait for the repair
+        ids = list(batch.select_for_update().values_list('pk', flat=True))
+        if self.options['reseed']:
+            if not self.options['dry_run']:
+                self.reseed(ids)
+            return len(ids)
+        repaired = 0
+        rows = Client.objects.filter(pk__in=ids).annotate(
+            expected=total(Ticket.objects.all(), 'total_cost') - total(Payment.objects.all(), 'amount'),
+            ledger_total=total(LedgerEntry.objects.all(), 'amount')
+        ).values_list('pk', 'balance', 'expected', 'ledger_total')
+        for pk, balance, expected, ledger_total in rows:
+            if balance == expected and ledger_total == expected:
+                continue
+            repaired += 1
+            self.stdout.write('Client {0}: balance {1}, ledger {2} instead of {3}'.format(
+                pk, balance, ledger_total, expected))
+            if self.options['dry_run']:
+                continue
+            # only the balance may be wrong, the entries are corrected when they don't add up
+            if ledger_total != expected:
+                LedgerEntry.objects.create(client_id=pk, amount=expected - ledger_total,
+                                           description='Ledger correction')
+            Client.objects.filter(pk=pk).update(balance=expected)
+        return repaired
+
+    @staticmethod
+    def reseed(ids):
+        """
+        replace the entries of the clients with one entry for every ticket and payment and set their balance
+        """
+        LedgerEntry.objects.filter(client_id__in=ids).delete()
+        entries = [
+            LedgerEntry(client_id=client_id, ticket_id=pk, amount=total_cost, description='Ticket')
+            for pk, client_id, total_cost in Ticket.objects.filter(client_id__in=ids).exclude(
+                total_cost=0).values_list('pk', 'client_id', 'total_cost')
+        ] + [
+            LedgerEntry(client_id=client_id, payment_id=pk, amount=-amount, description='Payment')
+            for pk, client_id, amount in Payment.objects.filter(client_id__in=ids).exclude(
+                amount=0).values_list('pk', 'client_id', 'amount')
+        ]
+        LedgerEntry.objects.bulk_create(entries)
+        Client.objects.filter(pk__in=ids).refresh_balance()
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from client.models import Subscription
+from utils.backfill import Backfill
+
+
+class Command(BaseCommand):
+    help = 'Check the current_paid_until and last_paid_on columns of the subscriptions against their payments ' \
+           'and repair the drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='subscriptions checked by every query')
+        parser.add_argument('--sleep', type=float, default=0, help='seconds to wait after every batch')
+        parser.add_argument('--restart', action='store_true',
+                            help='start from the first subscription, not the checkpoint')
+        parser.add_argument('--dry-run', action='store_true', help='report the drift without repairing it')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        backfill = Backfill(
+            'reconcile_payments', Subscription.objects.all(), batch_size=options['batch_size'],
+            sleep=options['sleep'], checkpoint=not self.dry_run, report=self.stdout.write
+        )
+        if options['restart']:
+            backfill.reset()
+        checked, drifted = backfill.run(self.repair)
+        self.stdout.write('{0} subscriptions checked, {1} {2}'.format(
+            checked, drifted, 'drifted' if self.dry_run else 'repaired'))
+
+    def repair(self, batch):
+        """
+        check the payment columns of the subscriptions of a batch and repair the drifted ones
+        :return: the number of subscriptions drifted
+        """
+        rows = batch.with_latest_payments().values_list(
+            'pk', 'current_paid_until', 'last_paid_on', 'latest_paid_until', 'latest_paid_on'
+        )
+        ids = []
+        for pk, current_paid_until, last_paid_on, latest_paid_until, latest_paid_on in rows:
+            if current_paid_until != latest_paid_until or last_paid_on != latest_paid_on:
+                ids.append(pk)
+                self.stdout.write('Subscription {0}: {1} / {2} instead of {3} / {4}'.format(
+                    pk, current_paid_until, last_paid_on, latest_paid_until, latest_paid_on))
+        if ids and not self.dry_run:
+            # refresh_payments locks the subscriptions, the payments saved meanwhile are applied after the repair
+            Subscription.objects.filter(pk__in=ids).refresh_payments()
+        return len(ids)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0008_auto_20161117_1250'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='client',
+            options={'ordering': ('last_name',)},
+        ),
+        migrations.AlterModelOptions(
+            name='device',
+            options={'ordering': ('model',)},
+        ),
+        migrations.AlterModelOptions(
+            name='devicemodel',
+            options={'ordering': ('name',)},
+        ),
+        migrations.AlterModelOptions(
+            name='devicetype',
+            options={'ordering': ('type',)},
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['subscription', 'paid_until'], name='client_paym_subscri_e5a362_idx'),
+        ),
+    ]
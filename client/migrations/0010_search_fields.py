@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0009_payment_expiration_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='search_name',
+            field=models.CharField(blank=True, default='', editable=False, max_length=61),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='search_serial',
+            field=models.CharField(blank=True, default='', editable=False, max_length=20),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:28
+from __future__ import unicode_literals
+
+from django.db import migrations
+from utils.backfill import Backfill
+from utils.search import normalize
+
+
+def normalize_fields(apps, schema_editor):
+    """
+    fill the search fields of the existing clients and devices
+    """
+    Client = apps.get_model('client', 'Client')
+    Device = apps.get_model('client', 'Device')
+
+    def normalize_names(batch):
+        for pk, first_name, last_name in batch.values_list('pk', 'first_name', 'last_name'):
+            Client.objects.filter(pk=pk).update(search_name=normalize(" ".join([first_name, last_name]))[:61])
+
+    def normalize_serials(batch):
+        for pk, serial_number in batch.values_list('pk', 'serial_number'):
+            Device.objects.filter(pk=pk).update(search_serial=normalize(serial_number)[:20])
+
+    Backfill('client_0011_search_name', Client.objects.all()).run(normalize_names)
+    Backfill('client_0011_search_serial', Device.objects.exclude(serial_number=None)).run(normalize_serials)
+
+
+class Migration(migrations.Migration):
+    # commit every batch of the backfill on its own, a stopped run continues from its checkpoint
+    atomic = False
+
+    dependencies = [
+        ('client', '0010_search_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_fields, migrations.RunPython.noop),
+    ]
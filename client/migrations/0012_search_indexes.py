@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:28
+from __future__ import unicode_literals
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+def create_indexes(apps, schema_editor):
+    """
+    create the trigram indexes of the search fields, they are only supported by postgresql
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX client_client_search_name_trgm ON client_client USING gin (search_name gin_trgm_ops)'
+    )
+    schema_editor.execute(
+        'CREATE INDEX client_device_search_serial_trgm ON client_device USING gin (search_serial gin_trgm_ops)'
+    )
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX client_client_search_name_trgm')
+    schema_editor.execute('DROP INDEX client_device_search_serial_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0011_fill_search_fields'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
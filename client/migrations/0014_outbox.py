@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0013_notification_log'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('send_from', models.CharField(max_length=254)),
+                ('send_to', models.TextField()),
+                ('subject', models.CharField(max_length=255)),
+                ('content', models.TextField()),
+                ('html', models.BooleanField(default=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent_on', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(fields=['sent_on', 'next_attempt_on'], name='client_outb_sent_on_428648_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0014_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='current_paid_until',
+            field=models.DateField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='subscription',
+            name='last_paid_on',
+            field=models.DateField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
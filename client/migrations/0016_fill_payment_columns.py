@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from utils.backfill import Backfill
+
+
+def fill_payment_columns(apps, schema_editor):
+    """
+    set the payment columns of the existing subscriptions from their payments
+    """
+    Subscription = apps.get_model('client', 'Subscription')
+    Payment = apps.get_model('client', 'Payment')
+    payments = Payment.objects.filter(subscription=OuterRef('pk'))
+
+    def fill(batch):
+        return batch.update(
+            current_paid_until=Subquery(
+                payments.order_by('-paid_until').values('paid_until')[:1], output_field=models.DateField()
+            ),
+            last_paid_on=Subquery(
+                payments.order_by('-paid_on').values('paid_on')[:1], output_field=models.DateField()
+            )
+        )
+
+    Backfill('client_0016_payment_columns', Subscription.objects.all()).run(fill)
+
+
+class Migration(migrations.Migration):
+    # commit every batch of the backfill on its own, a stopped run continues from its checkpoint
+    atomic = False
+
+    dependencies = [
+        ('client', '0015_subscription_payment_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_payment_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from utils.backfill import Backfill
+
+
+def seed_ledger(apps, schema_editor):
+    """
+    add an entry for the cost of every existing ticket and every payment, then set the balances from them
+    """
+    Client = apps.get_model('client', 'Client')
+    Payment = apps.get_model('client', 'Payment')
+    LedgerEntry = apps.get_model('client', 'LedgerEntry')
+    Ticket = apps.get_model('ticket', 'Ticket')
+
+    def ticket_entries(batch):
+        # skip the tickets posted by a run that was stopped before its checkpoint was written
+        posted = set(LedgerEntry.objects.filter(ticket__in=batch.values('pk')).values_list('ticket', flat=True))
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(client_id=client_id, ticket_id=pk, amount=total_cost, description='Ticket')
+            for pk, client_id, total_cost in batch.values_list('pk', 'client_id', 'total_cost') if pk not in posted
+        ])
+
+    def payment_entries(batch):
+        posted = set(LedgerEntry.objects.filter(payment__in=batch.values('pk')).values_list('payment', flat=True))
+        LedgerEntry.objects.bulk_create([
+            LedgerEntry(client_id=client_id, payment_id=pk, amount=-amount, description='Payment')
+            for pk, client_id, amount in batch.values_list('pk', 'client_id', 'amount') if pk not in posted
+        ])
+
+    def balances(batch):
+        return batch.update(balance=Coalesce(
+            Subquery(
+                LedgerEntry.objects.filter(client=OuterRef('pk')).order_by().values('client').annotate(
+                    total=Sum('amount')
+                ).values('total'),
+                output_field=models.DecimalField(max_digits=10, decimal_places=2)
+            ),
+            Value(0)
+        ))
+
+    Backfill('client_0018_ticket_entries', Ticket.objects.exclude(total_cost=0)).run(ticket_entries)
+    Backfill('client_0018_payment_entries', Payment.objects.exclude(amount=0)).run(payment_entries)
+    Backfill('client_0018_balances', Client.objects.all()).run(balances)
+
+
+class Migration(migrations.Migration):
+    # commit every batch of the backfill on its own, a stopped run continues from its checkpoint
+    atomic = False
+
+    dependencies = [
+        ('ticket', '0009_fill_cost_columns'),
+        ('client', '0017_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_ledger, migrations.RunPython.noop),
+    ]
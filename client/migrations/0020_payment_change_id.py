@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 14:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from api.triggers import create_change_id_trigger, drop_change_id_trigger
+
+
+def create_trigger(apps, schema_editor):
+    create_change_id_trigger(schema_editor, 'client_payment')
+
+
+def drop_trigger(apps, schema_editor):
+    drop_change_id_trigger(schema_editor, 'client_payment')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('client', '0019_payment_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='change_id',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['change_id', 'id'], name='client_paym_change__40f404_idx'),
+        ),
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
@@ -1,9 +1,44 @@
-from django.db import models
-from django.db.models.signals import pre_save
+from collections import OrderedDict
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery, Case, When, Value, F, Min, Max, Avg, Count, Sum, \
+    ExpressionWrapper
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_save, post_delete
 from django.dispatch import receiver
 from dateutil.relativedelta import relativedelta
-from datetime import datetime
-from utils.notifications.mail import send_mail
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.utils import timezone
+from utils.changes import ChangeTrackingQuerySet, tracked_fields
+from utils.notifications.mail import render_notification
+from utils.search import normalize
+
+
+class ClientQuerySet(models.QuerySet):
+    """
+    QuerySet for the clients
+    """
+
+    def outstanding(self):
+        """
+        returns the clients that owe money, the largest balance first
+        """
+        return self.filter(balance__gt=0).order_by('-balance', 'pk')
+
+    def refresh_balance(self):
+        """
+        set the balance of the clients to the sum of their ledger entries with one update
+        :return: the number of clients updated
+        """
+        return self.update(balance=Coalesce(
+            Subquery(
+                LedgerEntry.objects.filter(client=OuterRef('pk')).order_by().values('client').annotate(
+                    total=Sum('amount')
+                ).values('total'),
+                output_field=models.DecimalField(max_digits=10, decimal_places=2)
+            ),
+            Value(Decimal(0))
+        ))
 
 
 class Client(models.Model):
@@ -19,7 +54,12 @@ class Client(models.Model):
     mobile = models.CharField(max_length=14, blank=True, default="")
     email = models.EmailField(blank=True, default="")
     comment = models.TextField(max_length=300, blank=True, default="")
-    balance = models.DecimalField(max_digits=6, decimal_places=2, default=0)
+    # the sum of the ledger entries of the client, what the client owes when positive
+    balance = models.DecimalField(max_digits=10, decimal_places=2, default=0, editable=False, db_index=True)
+    # the normalized full name used by the trigram search
+    search_name = models.CharField(max_length=61, blank=True, default="", editable=False)
+
+    objects = ClientQuerySet.as_manager()
 
     class Meta:
         ordering = ('last_name',)
@@ -27,9 +67,36 @@ class Client(models.Model):
     def __str__(self):
         return self.full_name()
 
+    def save(self, *args, **kwargs):
+        """
+        Override the default save method of the model to keep the search name up to date
+        """
+        self.search_name = normalize(" ".join([self.first_name, self.last_name]))[:61]
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and ('first_name' in update_fields or 'last_name' in update_fields):
+            update_fields = kwargs['update_fields'] = set(update_fields) | {'search_name'}
+        # the balance is only updated by the ledger, never from a client loaded before it changed
+        if not self._state.adding and not kwargs.get('force_insert'):
+            if update_fields is None:
+                update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+            kwargs['update_fields'] = [field for field in update_fields if field != 'balance']
+        super(Client, self).save(*args, **kwargs)
+
     def full_name(self):
         return " ".join([self.last_name, self.first_name])
 
+    def notify_expirations(self, notices):
+        """
+        queue one email with all the expiring subscriptions of the client
+        :param notices: list of (subscription, days)
+        """
+        subject = '{0} - {1} subscriptions ending soon'.format(self.full_name(), len(notices))
+        context = {
+            'client': self,
+            'notices': [subscription.notice_context(days) for subscription, days in notices]
+        }
+        OutboxMessage.queue('support@d-h.gr', subject, context, template_name='notification_digest.html')
+
     def phone_number(self):
         if self.phone:
             home = "Σταθερο: {}".format(self.phone)
@@ -98,6 +165,8 @@ class Device(models.Model):
     description = models.CharField(max_length=20, null=True, blank=True)
     comment = models.TextField(max_length=200, null=True, blank=True)
     type = models.ForeignKey(DeviceType, related_name='devices')
+    # the normalized serial number used by the trigram search
+    search_serial = models.CharField(max_length=20, blank=True, default="", editable=False)
 
     class Meta:
         ordering = ('model',)
@@ -105,6 +174,16 @@ class Device(models.Model):
     def __str__(self):
         return " ".join([self.client.full_name(), self.serial_number, '-', self.model.name])
 
+    def save(self, *args, **kwargs):
+        """
+        Override the default save method of the model to keep the search serial number up to date
+        """
+        self.search_serial = normalize(self.serial_number)[:20]
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'serial_number' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'search_serial'}
+        super(Device, self).save(*args, **kwargs)
+
 
 class SubscriptionType(models.Model):
     """
@@ -116,6 +195,87 @@ class SubscriptionType(models.Model):
         return self.description
 
 
+class SubscriptionQuerySet(models.QuerySet):
+    """
+    QuerySet for the subscriptions
+    """
+
+    def with_payment_status(self):
+        """
+        annotate the subscriptions with their payment status calculated in the database
+        from the paid until date of the latest payment: Active, Expired or Never Paid
+        """
+        date = datetime.date(datetime.now())
+        return self.annotate(
+            payment_status=Case(
+                When(current_paid_until__gte=date, then=Value('Active')),
+                When(current_paid_until__isnull=False, then=Value('Expired')),
+                default=Value('Never Paid'),
+                output_field=models.CharField(max_length=10)
+            )
+        )
+
+    def expire_between(self, from_date, to_date):
+        """
+        returns the subscriptions whose latest payment runs out between the two dates
+        """
+        return self.filter(current_paid_until__gte=from_date, current_paid_until__lte=to_date)
+
+    def expired(self, date):
+        """
+        returns the subscriptions whose latest payment ran out before the date
+        """
+        return self.filter(current_paid_until__lt=date)
+
+    @staticmethod
+    def latest_payments():
+        """
+        returns the paid until date and the payment date of the latest payment of a subscription as subqueries,
+        by the names of the columns that keep them
+        """
+        payments = Payment.objects.filter(subscription=OuterRef('pk')).order_by()
+        return {
+            'current_paid_until': Subquery(
+                payments.order_by('-paid_until').values('paid_until')[:1], output_field=models.DateField()
+            ),
+            'last_paid_on': Subquery(
+                payments.order_by('-paid_on').values('paid_on')[:1], output_field=models.DateField()
+            ),
+        }
+
+    def with_latest_payments(self):
+        """
+        get the paid until date and the payment date of the latest payment of the subscriptions from their payments,
+        as latest_paid_until and latest_paid_on. Used to check the current_paid_until and last_paid_on columns.
+        """
+        latest = self.latest_payments()
+        return self.annotate(latest_paid_until=latest['current_paid_until'], latest_paid_on=latest['last_paid_on'])
+
+    def refresh_payments(self):
+        """
+        Set the current_paid_until and last_paid_on columns of the subscriptions from their payments with one update.
+        The subscriptions are locked first, so when two transactions change the payments of a subscription
+        the second one waits for the first to commit and its update reads the payments of both.
+        :return: the number of subscriptions updated
+        """
+        with transaction.atomic(using=self.db):
+            # lock in the order of the ids so two transactions never wait for each other
+            list(self.select_for_update().order_by('pk').values_list('pk', flat=True))
+            return self.update(**self.latest_payments())
+
+    def expire_on(self, dates):
+        """
+        Returns the subscriptions whose latest payment runs out on any of the dates, in one query
+        with the client, the type and the amount of the latest payment as expiring_amount.
+        """
+        return self.filter(current_paid_until__in=list(dates)).annotate(
+            expiring_amount=Subquery(
+                Payment.objects.filter(subscription=OuterRef('pk')).order_by('-paid_until').values('amount')[:1],
+                output_field=models.DecimalField(max_digits=6, decimal_places=2)
+            )
+        ).select_related('client', 'type')
+
+
 class Subscription(models.Model):
     """
     Model for client subscriptions
@@ -125,20 +285,40 @@ class Subscription(models.Model):
     type = models.ForeignKey(SubscriptionType, related_name='subscriptions')
     description = models.CharField(max_length=50)
     create_date = models.DateField(null=True, blank=True)
+    # the paid until date of the latest payment and the date of the latest payment, kept up to date by the payments
+    current_paid_until = models.DateField(null=True, blank=True, editable=False, db_index=True)
+    last_paid_on = models.DateField(null=True, blank=True, editable=False, db_index=True)
+
+    objects = SubscriptionQuerySet.as_manager()
+
+    # the columns that are only updated in the database
+    PAYMENT_FIELDS = ('current_paid_until', 'last_paid_on')
 
     def __str__(self):
         return " - ".join([str(self.id), self.description])
 
-    def notify_expiration(self, days):
-        subject = '{0} subscription - {1} ending in {2} days'.format(self.client.full_name(), self.description, days)
-        context = {
+    def notice_context(self, days):
+        """
+        returns the values of the expiration notice of the subscription
+        :return: dict
+        """
+        # the subscriptions of Subscription.objects.expire_on() come with their latest payment
+        if hasattr(self, 'expiring_amount'):
+            paid_until, amount = self.current_paid_until, self.expiring_amount
+        else:
+            payment = self.active_payment()
+            paid_until, amount = payment.paid_until, payment.amount
+        return {
             'client': self.client,
             'subscription': " - ".join([self.type.description, self.description]),
-            'expiration_date': self.active_payment().paid_until.strftime("%d-%m-%Y"),
-            'price': "".join([str(self.active_payment().amount), '€']),
+            'expiration_date': paid_until.strftime("%d-%m-%Y"),
+            'price': "".join([str(amount), '€']),
             'days': days
         }
-        send_mail('support@d-h.gr', subject, context)
+
+    def notify_expiration(self, days):
+        subject = '{0} subscription - {1} ending in {2} days'.format(self.client.full_name(), self.description, days)
+        OutboxMessage.queue('support@d-h.gr', subject, self.notice_context(days))
 
     def paid_for(self, sub_months=None, start_now=False):
         # check if the the start date is counting from the expiration day of today
@@ -166,7 +346,9 @@ class Subscription(models.Model):
         Get the active payment of the subscription
         """
         date = datetime.date(datetime.now())
-        return self.payments.filter(paid_until__gte=date).first()
+        if self.current_paid_until is None or self.current_paid_until < date:
+            return None
+        return self.payments.filter(paid_until=self.current_paid_until).order_by('-pk').first()
 
     # static methods
     @staticmethod
@@ -176,7 +358,8 @@ class Subscription(models.Model):
         :param days: integer
         :return:
         """
-        return Subscription.objects.filter(payments__paid_until=datetime.now() + relativedelta(days=days))
+        date = datetime.date(datetime.now() + relativedelta(days=days))
+        return Subscription.objects.expire_on([date])
 
     def save(self, *args, **kwargs):
         """
@@ -184,6 +367,12 @@ class Subscription(models.Model):
         """
         if self.create_date is None:
             self.create_date = datetime.now()
+        # the payment columns are never written from a subscription loaded before its payments changed
+        if not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+            kwargs['update_fields'] = [field for field in update_fields if field not in self.PAYMENT_FIELDS]
         super(Subscription, self).save(*args, **kwargs)
 
 
@@ -207,6 +396,22 @@ class Payment(models.Model):
     amount = models.DecimalField(max_digits=6, decimal_places=2)
     paid_on = models.DateField()
     paid_until = models.DateField(blank=True)
+    # the time of the last change, for the Last-Modified of the api
+    updated_at = models.DateTimeField(auto_now=True)
+    # the id of the transaction of the last change, set by a trigger on postgresql and read by the change feed
+    change_id = models.BigIntegerField(default=0, editable=False)
+
+    objects = ChangeTrackingQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # the latest payment of a subscription
+            models.Index(fields=['subscription', 'paid_until']),
+            # the changes since a time
+            models.Index(fields=['updated_at', 'id']),
+            # the changes since a transaction
+            models.Index(fields=['change_id', 'id']),
+        ]
 
     def __str__(self):
         return " ".join([self.client.full_name(), self.subscription.description])
@@ -214,12 +419,203 @@ class Payment(models.Model):
     def save(self, *args, **kwargs):
         self.paid_until = self.paid_on + relativedelta(months=self.duration)
         self.client = self.subscription.client
-        # run the super
-        super(Payment, self).save(*args, **kwargs)
+        loaded = getattr(self, '_loaded', None)
+        kwargs['update_fields'] = tracked_fields(kwargs.get('update_fields'))
+        with transaction.atomic(using=kwargs.get('using')):
+            # run the super
+            super(Payment, self).save(*args, **kwargs)
+            # update the subscriptions the payment was and is now part of
+            subscriptions = {self.subscription_id, loaded[0] if loaded else self.subscription_id}
+            Subscription.objects.filter(pk__in=subscriptions).refresh_payments()
+            # credit the client with the payment, or with the change of the payment
+            amount = Decimal(self.amount)
+            if loaded and loaded[1] != self.client_id:
+                LedgerEntry.post(loaded[1], loaded[2], payment_id=self.pk, description='Payment moved')
+            elif loaded:
+                amount -= loaded[2]
+            LedgerEntry.post(self.client_id, -amount, payment_id=self.pk, description='Payment')
+        self._loaded = (self.subscription_id, self.client_id, Decimal(self.amount))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Payment, cls).from_db(db, field_names, values)
+        # keep the loaded values to apply only the changes to the subscription and the ledger
+        instance._loaded = (
+            instance.__dict__.get('subscription_id'), instance.__dict__.get('client_id'), instance.__dict__.get('amount')
+        )
+        return instance
+
+
+@receiver(post_delete, sender=Payment)
+def remove_payment(sender, instance, **kwargs):
+    """
+    update the payment columns of the subscription of the deleted payment and reverse its ledger entries
+    """
+    Subscription.objects.filter(pk=instance.subscription_id).refresh_payments()
+    LedgerEntry.reverse(instance.client_id, payment_id=instance.pk, description='Payment deleted')
 
 
+class NotificationLog(models.Model):
+    """
+    One row for every expiration notice of a subscription, so that each notice is sent exactly once
+    however many times the scan runs and however many workers send them.
+    """
+    subscription = models.ForeignKey(Subscription, related_name='notifications')
+    offset_days = models.IntegerField()
+    expiry_date = models.DateField()
+    created_on = models.DateTimeField(auto_now_add=True)
+    # set in the transaction that queues the email of the notice
+    sent_on = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
 
+    class Meta:
+        unique_together = ('subscription', 'offset_days', 'expiry_date')
 
+    def __str__(self):
+        return " - ".join([str(self.subscription_id), str(self.expiry_date), str(self.offset_days)])
 
 
+class OutboxQuerySet(models.QuerySet):
+    """
+    QuerySet for the outbox messages
+    """
 
+    def pending(self):
+        """
+        returns the messages that haven't been sent and can be tried now, oldest first
+        """
+        return self.filter(
+            sent_on__isnull=True, attempts__lt=OutboxMessage.MAX_ATTEMPTS, next_attempt_on__lte=timezone.now()
+        ).order_by('id')
+
+    def metrics(self):
+        """
+        returns the state of the outbox:
+        depth: the number of unsent messages
+        failed: the unsent messages that have failed at least once
+        abandoned: the messages that failed too many times to be tried again
+        oldest_age: the seconds the oldest unsent message is waiting
+        send_lag_avg, send_lag_max: the seconds from queueing to sending of the messages sent in the last hour
+        :return: dict
+        """
+        now = timezone.now()
+        unsent = self.filter(sent_on__isnull=True).aggregate(
+            depth=Count('id'),
+            failed=Count(Case(When(attempts__gt=0, then=Value(1)))),
+            abandoned=Count(Case(When(attempts__gte=OutboxMessage.MAX_ATTEMPTS, then=Value(1)))),
+            oldest=Min('created_on')
+        )
+        lag = ExpressionWrapper(F('sent_on') - F('created_on'), output_field=models.DurationField())
+        sent = self.filter(sent_on__gte=now - timedelta(hours=1)).aggregate(
+            send_lag_avg=Avg(lag, output_field=models.DurationField()), send_lag_max=Max(lag)
+        )
+        return OrderedDict([
+            ('depth', unsent['depth']),
+            ('failed', unsent['failed']),
+            ('abandoned', unsent['abandoned']),
+            ('oldest_age', (now - unsent['oldest']).total_seconds() if unsent['oldest'] else 0),
+            ('send_lag_avg', sent['send_lag_avg'].total_seconds() if sent['send_lag_avg'] else 0),
+            ('send_lag_max', sent['send_lag_max'].total_seconds() if sent['send_lag_max'] else 0),
+        ])
+
+
+class OutboxMessage(models.Model):
+    """
+    Email waiting to be delivered by the outbox worker.
+    It's written in the transaction of the change that triggers it so the email is queued only if the change
+    is committed, and it stays here with the error of the last attempt until it's delivered.
+    """
+    # the attempts after which a message is left for the admins
+    MAX_ATTEMPTS = 10
+
+    send_from = models.CharField(max_length=254)
+    send_to = models.TextField()
+    subject = models.CharField(max_length=255)
+    # the rendered notification
+    content = models.TextField()
+    html = models.BooleanField(default=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    next_attempt_on = models.DateTimeField(default=timezone.now)
+    sent_on = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+
+    objects = OutboxQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # the pending messages
+            models.Index(fields=['sent_on', 'next_attempt_on']),
+        ]
+
+    def __str__(self):
+        return " - ".join([self.send_to, self.subject])
+
+    @staticmethod
+    def queue(send_to, subject, context, send_from='hosting@d-h.gr', html=True, template_name='notification.html'):
+        """
+        render the notification template and add it to the outbox
+        :return: OutboxMessage
+        """
+        return OutboxMessage.objects.create(
+            send_from=send_from,
+            send_to=send_to if isinstance(send_to, str) else ",".join(send_to),
+            subject=subject,
+            content=render_notification(context, template_name),
+            html=html
+        )
+
+
+class LedgerEntry(models.Model):
+    """
+    Append only ledger of what the clients owe: the ticket costs are added and the subscription payments
+    are subtracted. Changes are recorded as new entries with the difference, and the balance of the client
+    is the sum of the amounts of the entries, kept up to date with every entry.
+    """
+    client = models.ForeignKey(Client, related_name='ledger')
+    # detached by LedgerEntry.reverse() when the ticket or the payment is deleted
+    ticket = models.ForeignKey('ticket.Ticket', related_name='ledger', null=True, blank=True,
+                               on_delete=models.DO_NOTHING)
+    payment = models.ForeignKey(Payment, related_name='ledger', null=True, blank=True, on_delete=models.DO_NOTHING)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    description = models.CharField(max_length=100, blank=True, default="")
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return " ".join([str(self.client_id), str(self.amount), self.description])
+
+    @staticmethod
+    def post(client_id, amount, ticket_id=None, payment_id=None, description=""):
+        """
+        add an entry to the ledger and the amount to the balance of the client, in one transaction
+        """
+        if not amount:
+            return None
+        with transaction.atomic():
+            entry = LedgerEntry.objects.create(
+                client_id=client_id, ticket_id=ticket_id, payment_id=payment_id, amount=amount, description=description
+            )
+            Client.objects.filter(pk=client_id).update(balance=F('balance') + amount)
+        return entry
+
+    @staticmethod
+    def reverse(client_id, ticket_id=None, payment_id=None, description=""):
+        """
+        Cancel the entries of a ticket or a payment that is deleted with an entry for the opposite of their sum.
+        The entries, including the ones written while the ticket was deleted with its charges,
+        are detached from the ticket or the payment before the foreign keys are checked at the commit.
+        """
+        entries = LedgerEntry.objects.filter(ticket_id=ticket_id) if ticket_id else \
+            LedgerEntry.objects.filter(payment_id=payment_id)
+        with transaction.atomic():
+            total = entries.aggregate(total=Sum('amount'))['total']
+            entries.update(ticket=None, payment=None)
+            LedgerEntry.post(client_id, -(total or 0), description=description)
+
+
+@receiver(post_delete, sender=Client)
+def remove_client_ledger(sender, instance, **kwargs):
+    """
+    remove the entries written for the client while its tickets and payments were being deleted with it
+    """
+    LedgerEntry.objects.filter(client_id=instance.pk).delete()
@@ -1,15 +1,208 @@
+import smtplib
+from datetime import datetime, timedelta
 from celery.schedules import crontab
 from celery.task import periodic_task
-from client.models import Subscription
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from cream.celery import app
+from client.models import Subscription, NotificationLog, OutboxMessage
+from utils.notifications.mail import is_connection_error, send_content
+
+# the days before the expiration that the clients get notified
+NOTIFY_DAYS = [14, 7, 2, 1]
+
+# subscriptions handled by every step of the scan
+CHUNK_SIZE = 500
+
+# the longest wait between the retries of a notice in seconds
+MAX_RETRY_DELAY = 60 * 60
+
+# the rate limit units in celery format as the number of their periods in a minute
+RATE_UNITS = {'s': 60, 'm': 1, 'h': 1 / 60}
 
 
 @periodic_task(run_every=crontab(minute=0, hour=9))
 def schedule():
-    days_to_fetch = [14, 7, 2, 1]
-    # get all the notifications that expire in 7, 2, 1 days
-    for days in days_to_fetch:
-        # query the database for any expiring subscriptions
-        qset = Subscription.expire_in_days(days)
-        if qset:
-            for sub in qset:
-                sub.notify_expiration(days)
\ No newline at end of file
+    """
+    Find the subscriptions that expire in any of the notification days, record a NotificationLog
+    for each notice and queue a task to send every notice that hasn't been sent yet.
+    In the digest mode the notices of a client are queued together and sent in one email.
+    Running it again the same day queues only the notices left unsent.
+    """
+    today = datetime.date(datetime.now())
+    digest = settings.EXPIRATION_NOTICE_MODE == 'digest'
+    # get the days before the expiration for each of the notification dates
+    days_to_fetch = {today + relativedelta(days=days): days for days in NOTIFY_DAYS}
+    # query the database once for the subscriptions expiring on any of the dates
+    # and read them in chunks so the memory stays the same however many they are
+    subscriptions = Subscription.objects.expire_on(days_to_fetch).order_by('client_id', 'pk')
+    subscriptions = subscriptions.values_list('pk', 'current_paid_until', 'client_id').iterator()
+    # a chunk has all the subscriptions of its clients so every client gets one digest
+    for chunk in chunked(subscriptions, CHUNK_SIZE, key=lambda row: row[2]):
+        keys = {(pk, days_to_fetch[expires_on], expires_on) for pk, expires_on, client_id in chunk}
+        unsent = record_notifications(keys)
+        if not digest:
+            for log_id, subscription_id in unsent:
+                send_expiration_notice.delay(log_id)
+            continue
+        clients = {pk: client_id for pk, expires_on, client_id in chunk}
+        digests = {}
+        for log_id, subscription_id in unsent:
+            digests.setdefault(clients[subscription_id], []).append(log_id)
+        for log_ids in digests.values():
+            send_expiration_digest.delay(log_ids)
+
+
+def chunked(rows, size, key=None):
+    """
+    Split the rows into lists of about size rows.
+    When a key is given the consecutive rows with the same key are kept in the same list.
+    """
+    chunk = []
+    for row in rows:
+        if len(chunk) >= size and (key is None or key(row) != key(chunk[-1])):
+            yield chunk
+            chunk = []
+        chunk.append(row)
+    if chunk:
+        yield chunk
+
+
+def record_notifications(keys):
+    """
+    Create the missing NotificationLog rows of the (subscription, offset days, expiry date) keys.
+    :return: the ids and the subscriptions of the rows of the keys that haven't been sent
+    """
+    logs = NotificationLog.objects.filter(
+        subscription_id__in={key[0] for key in keys}, expiry_date__in={key[2] for key in keys}
+    )
+    existing = set(logs.values_list('subscription_id', 'offset_days', 'expiry_date'))
+    missing = [
+        NotificationLog(subscription_id=subscription_id, offset_days=offset_days, expiry_date=expiry_date)
+        for subscription_id, offset_days, expiry_date in keys - existing
+    ]
+    try:
+        with transaction.atomic():
+            NotificationLog.objects.bulk_create(missing)
+    except IntegrityError:
+        # another scan created some of them in the meantime
+        for log in missing:
+            NotificationLog.objects.get_or_create(
+                subscription_id=log.subscription_id, offset_days=log.offset_days, expiry_date=log.expiry_date
+            )
+    unsent = logs.filter(sent_on__isnull=True).values_list('pk', 'subscription_id', 'offset_days', 'expiry_date')
+    return [(row[0], row[1]) for row in unsent if row[1:] in keys]
+
+
+@app.task(bind=True, ignore_result=True, max_retries=8)
+def send_expiration_notice(self, log_id):
+    """
+    Queue the email of the expiration notice of a NotificationLog once.
+    The log is locked and marked as sent in the transaction that writes the email to the outbox,
+    so of the workers running it at the same time only one queues the email and a failure leaves both undone.
+    """
+    try:
+        with transaction.atomic():
+            log = NotificationLog.objects.select_for_update().filter(pk=log_id, sent_on__isnull=True).first()
+            if log is None:
+                # sent already
+                return
+            # the subscription with its latest payment, unless it has been renewed since the scan
+            sub = Subscription.objects.expire_on([log.expiry_date]).filter(pk=log.subscription_id).first()
+            if sub is None:
+                return
+            sub.notify_expiration(log.offset_days)
+            log.sent_on = timezone.now()
+            log.attempts += 1
+            log.save(update_fields=['sent_on', 'attempts'])
+    except DatabaseError as exc:
+        raise self.retry(exc=exc, countdown=min(60 * 2 ** self.request.retries, MAX_RETRY_DELAY))
+
+
+@app.task(bind=True, ignore_result=True, max_retries=8)
+def send_expiration_digest(self, log_ids):
+    """
+    Queue one email with the expiration notices of the NotificationLogs of a client.
+    The notices sent already or whose subscription has been renewed since the scan are left out.
+    """
+    try:
+        with transaction.atomic():
+            logs = list(NotificationLog.objects.select_for_update().filter(pk__in=log_ids, sent_on__isnull=True))
+            if not logs:
+                return
+            # the subscriptions with their latest payment and client
+            subscriptions = Subscription.objects.expire_on({log.expiry_date for log in logs}).filter(
+                pk__in=[log.subscription_id for log in logs]
+            ).in_bulk()
+            notices = [
+                (subscriptions[log.subscription_id], log) for log in logs
+                if log.subscription_id in subscriptions and
+                subscriptions[log.subscription_id].current_paid_until == log.expiry_date
+            ]
+            if not notices:
+                return
+            notices.sort(key=lambda notice: (notice[1].expiry_date, notice[0].pk))
+            notices[0][0].client.notify_expirations([(sub, log.offset_days) for sub, log in notices])
+            NotificationLog.objects.filter(pk__in=[log.pk for sub, log in notices]).update(
+                sent_on=timezone.now(), attempts=F('attempts') + 1
+            )
+    except DatabaseError as exc:
+        raise self.retry(exc=exc, countdown=min(60 * 2 ** self.request.retries, MAX_RETRY_DELAY))
+
+
+def per_minute(rate_limit):
+    """
+    returns the number of a rate limit in celery format like 30/m per minute, at least one
+    """
+    count, _, unit = rate_limit.partition('/')
+    return max(1, int(float(count) * RATE_UNITS[unit or 's']))
+
+
+@periodic_task(run_every=crontab(minute='*'), ignore_result=True)
+def deliver_outbox(batch_size=100, limit=None):
+    """
+    Send the pending emails of the outbox over one connection.
+    The task runs every minute and sends at most limit emails, by default the NOTIFICATION_RATE_LIMIT
+    per minute, so the provider never gets more than its limit and the rest wait for the next run.
+    Every batch is locked with SELECT ... FOR UPDATE SKIP LOCKED so several workers can drain the outbox together,
+    each one skipping the messages another one is sending.
+    :return: the number of emails sent
+    """
+    if limit is None:
+        limit = per_minute(settings.NOTIFICATION_RATE_LIMIT)
+    delivered = attempted = 0
+    while attempted < limit:
+        with transaction.atomic():
+            batch = list(OutboxMessage.objects.pending().select_for_update(skip_locked=True)[
+                :min(batch_size, limit - attempted)
+            ])
+            if not batch:
+                break
+            sent, failed = [], []
+            for message in batch:
+                attempted += 1
+                try:
+                    send_content(message.send_to.split(','), message.subject, message.content, message.send_from,
+                                 html=message.html)
+                except (smtplib.SMTPException, OSError) as exc:
+                    failed.append((message, exc))
+                    if is_connection_error(exc):
+                        # the server can't be reached, leave the rest for the next run
+                        break
+                else:
+                    sent.append(message.pk)
+            OutboxMessage.objects.filter(pk__in=sent).update(sent_on=timezone.now(), attempts=F('attempts') + 1)
+            for message, exc in failed:
+                # try again later, waiting longer after every failure
+                delay = min(60 * 2 ** message.attempts, MAX_RETRY_DELAY)
+                OutboxMessage.objects.filter(pk=message.pk).update(
+                    attempts=F('attempts') + 1, last_error=str(exc),
+                    next_attempt_on=timezone.now() + timedelta(seconds=delay)
+                )
+        delivered += len(sent)
+        if failed and is_connection_error(failed[-1][1]):
+            break
+    return delivered
@@ -1,3 +1,678 @@
-from django.test import TestCase
+import csv
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
+from dateutil.relativedelta import relativedelta
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from client.admin import SubscriptionAdmin
+from client.models import Client, Device, Subscription, SubscriptionType, Payment, NotificationLog, OutboxMessage, \
+    LedgerEntry
+from client.tasks import (
+    chunked, deliver_outbox, per_minute, record_notifications, schedule, send_expiration_digest, send_expiration_notice
+)
+from ticket.models import Ticket
+from utils.backfill import Backfill
+from utils.notifications import mail
+from utils.notifications.localsmtp import LocalSMTPServer
 
-# Create your tests here.
+
+class SubscriptionFixtures:
+    """
+    Creates the subscriptions of a test with their payments
+    """
+
+    def setUp(self):
+        super(SubscriptionFixtures, self).setUp()
+        self.today = date.today()
+        self.subscription_type = SubscriptionType.objects.create(description='Hosting')
+
+    def create_subscription(self, name, *paid_until, **client_fields):
+        """
+        create a client with a subscription and a yearly payment for every paid until date
+        """
+        client = Client.objects.create(first_name=name, last_name=client_fields.pop('last_name', name),
+                                       **client_fields)
+        subscription = Subscription.objects.create(client=client, type=self.subscription_type, description=name)
+        for until in paid_until:
+            self.pay(subscription, until)
+        return subscription
+
+    @staticmethod
+    def pay(subscription, paid_until, amount=Decimal('10.00')):
+        return Payment.objects.create(subscription=subscription, client=subscription.client, duration=12,
+                                      amount=amount, paid_on=paid_until - relativedelta(months=12))
+
+
+class AdminFixtures:
+    """
+    Logs in a superuser
+    """
+
+    def setUp(self):
+        super(AdminFixtures, self).setUp()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def changelist(self, url, **params):
+        """
+        :return: the ids of the rows of the changelist and the number of queries it took
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return [row.pk for row in response.context['cl'].result_list], len(queries)
+
+
+class SubscriptionStatusTests(SubscriptionFixtures, AdminFixtures, TestCase):
+    """
+    The status, the last payment and the expiration of the subscriptions are calculated in the database
+    """
+
+    def setUp(self):
+        super(SubscriptionStatusTests, self).setUp()
+        self.active = self.create_subscription('Active', self.today + timedelta(days=30))
+        self.expired = self.create_subscription('Expired', self.today - timedelta(days=1))
+        self.never_paid = self.create_subscription('Never')
+        # an expired payment followed by a renewal
+        self.renewed = self.create_subscription('Renewed', self.today - timedelta(days=400), self.today)
+
+    def test_payment_status(self):
+        statuses = dict(Subscription.objects.with_payment_status().values_list('pk', 'payment_status'))
+        self.assertEqual(statuses, {
+            self.active.pk: 'Active', self.expired.pk: 'Expired', self.never_paid.pk: 'Never Paid',
+            self.renewed.pk: 'Active',
+        })
+
+    def test_status_filter(self):
+        url = '/admin/client/subscription/'
+        self.assertCountEqual(self.changelist(url, status='Active')[0], [self.active.pk, self.renewed.pk])
+        self.assertEqual(self.changelist(url, status='Expired')[0], [self.expired.pk])
+        self.assertEqual(self.changelist(url, status='Never Paid')[0], [self.never_paid.pk])
+
+    def test_constant_queries(self):
+        url = '/admin/client/subscription/'
+        rows, few = self.changelist(url)
+        for number in range(10):
+            self.create_subscription('More{0}'.format(number), self.today + timedelta(days=number),
+                                     self.today - timedelta(days=number))
+        rows, many = self.changelist(url)
+        self.assertEqual(len(rows), 14)
+        self.assertEqual(many, few)
+
+
+class SubscriptionExpirationFilterTests(SubscriptionFixtures, AdminFixtures, TestCase):
+    """
+    The expiration filter looks at the latest payment of every subscription only and lists it once
+    """
+
+    def test_latest_payment_only(self):
+        # expired once but renewed for a long time
+        renewed = self.create_subscription('Renewed', self.today - timedelta(days=30), self.today + timedelta(days=700))
+        # expires today after two earlier payments
+        expiring = self.create_subscription(
+            'Expiring', self.today - timedelta(days=800), self.today - timedelta(days=400), self.today)
+        expired = self.create_subscription('Expired', self.today - timedelta(days=400), self.today - timedelta(days=1))
+        self.create_subscription('Never')
+        url = '/admin/client/subscription/'
+        for period in ('week', 'month', 'year'):
+            self.assertEqual(self.changelist(url, payments=period)[0], [expiring.pk])
+        self.assertEqual(self.changelist(url, payments='expired')[0], [expired.pk])
+        self.assertNotIn(renewed.pk, Subscription.objects.expire_between(
+            self.today - timedelta(days=60), self.today + timedelta(days=365)).values_list('pk', flat=True))
+
+
+class SubscriptionChangeListTests(SubscriptionFixtures, AdminFixtures, TestCase):
+    """
+    The keyset pages of the subscriptions have every row once, also when the sorted values are tied or null
+    """
+
+    def setUp(self):
+        super(SubscriptionChangeListTests, self).setUp()
+        # three clients share every last name and half of the subscriptions are never paid
+        for number in range(12):
+            paid_until = [date(2021, 1 + number % 3, 1)] if number % 2 else []
+            self.create_subscription(str(number), *paid_until, last_name='Name{0}'.format(number % 4))
+
+    def walk(self, query, link):
+        """
+        follow the next_url or the previous_url links from a page
+        :return: the query string of the last page and the ids of the subscriptions of every page
+        """
+        pages = []
+        with mock.patch.object(SubscriptionAdmin, 'list_per_page', 5):
+            while query:
+                changelist = self.client.get('/admin/client/subscription/' + query).context['cl']
+                pages.append([subscription.pk for subscription in changelist.result_list])
+                query, last = getattr(changelist, link), query
+        return last, pages
+
+    def assertWalk(self, order):
+        last, pages = self.walk('?o={0}'.format(order), 'next_url')
+        shown = [pk for page in pages for pk in page]
+        self.assertGreater(len(pages), 1)
+        self.assertCountEqual(shown, Subscription.objects.values_list('pk', flat=True))
+        # and back from the last page to the first
+        _, previous_pages = self.walk(last, 'previous_url')
+        self.assertEqual(previous_pages, pages[::-1])
+
+    def test_client_order(self):
+        self.assertWalk('1')
+        self.assertWalk('-1')
+
+    def test_paid_until_order(self):
+        self.assertWalk('7')
+        self.assertWalk('-7')
+
+
+class ExpirationScanTests(SubscriptionFixtures, TestCase):
+    """
+    The daily scan finds the subscriptions expiring in every notification day with one query
+    """
+
+    def setUp(self):
+        super(ExpirationScanTests, self).setUp()
+        self.expiring = {
+            days: self.create_subscription('In{0}'.format(days), self.today + timedelta(days=days))
+            for days in (14, 7, 2, 1)
+        }
+        self.create_subscription('Later', self.today + timedelta(days=3))
+        # its first payment expires in a week but it has been renewed
+        self.create_subscription('Renewed', self.today + timedelta(days=7), self.today + timedelta(days=372))
+
+    def scan(self):
+        """
+        :return: the notification logs queued by the scan and the queries that read the subscriptions
+        """
+        with mock.patch('client.tasks.send_expiration_notice.delay') as delay, \
+                CaptureQueriesContext(connection) as queries:
+            schedule()
+        scans = [query for query in queries if query['sql'].startswith('SELECT') and
+                 'FROM "client_subscription"' in query['sql']]
+        return sorted(call[0][0] for call in delay.call_args_list), scans
+
+    def test_single_scan(self):
+        queued, scans = self.scan()
+        logs = NotificationLog.objects.order_by('pk')
+        self.assertEqual(queued, [log.pk for log in logs])
+        self.assertEqual(
+            {(log.subscription_id, log.offset_days, log.expiry_date) for log in logs},
+            {(sub.pk, days, self.today + timedelta(days=days)) for days, sub in self.expiring.items()}
+        )
+        self.assertEqual(len(scans), 1)
+
+    def test_chunked(self):
+        rows = [(1, 'a'), (2, 'a'), (3, 'b'), (4, 'b'), (5, 'b'), (6, 'c')]
+        self.assertEqual([len(chunk) for chunk in chunked(rows, 2)], [2, 2, 2])
+        # the rows of a key are never split
+        self.assertEqual([len(chunk) for chunk in chunked(rows, 3, key=lambda row: row[1])], [5, 1])
+
+
+class PaymentColumnsTests(SubscriptionFixtures, TestCase):
+    """
+    The subscriptions keep the dates of their latest payment as their payments change
+    """
+
+    def setUp(self):
+        super(PaymentColumnsTests, self).setUp()
+        self.subscription = self.create_subscription('Site')
+        self.other = self.create_subscription('Other')
+
+    def assertLatest(self, subscription, paid_until, paid_on):
+        subscription = Subscription.objects.get(pk=subscription.pk)
+        self.assertEqual((subscription.current_paid_until, subscription.last_paid_on), (paid_until, paid_on))
+
+    def reconcile(self, *args):
+        output = StringIO()
+        # the command warns that it runs in the transaction of the test
+        with self.assertLogs('utils.backfill', 'WARNING'):
+            call_command('reconcile_payments', *args, stdout=output)
+        return output.getvalue()
+
+    def test_payments(self):
+        later = self.pay(self.subscription, date(2022, 3, 1))
+        self.assertLatest(self.subscription, date(2022, 3, 1), date(2021, 3, 1))
+        # an older payment entered afterwards
+        earlier = self.pay(self.subscription, date(2021, 3, 1))
+        self.assertLatest(self.subscription, date(2022, 3, 1), date(2021, 3, 1))
+        later.subscription = self.other
+        later.save()
+        self.assertLatest(self.subscription, date(2021, 3, 1), date(2020, 3, 1))
+        self.assertLatest(self.other, date(2022, 3, 1), date(2021, 3, 1))
+        earlier.delete()
+        self.assertLatest(self.subscription, None, None)
+        self.assertIn('0 drifted', self.reconcile('--dry-run'))
+
+    def test_subscription_loaded_before_payment(self):
+        subscription = Subscription.objects.get(pk=self.subscription.pk)
+        self.pay(self.subscription, date(2022, 3, 1))
+        subscription.description = 'Renamed'
+        subscription.save()
+        self.assertLatest(self.subscription, date(2022, 3, 1), date(2021, 3, 1))
+
+    def test_reconcile(self):
+        self.pay(self.subscription, date(2022, 3, 1))
+        Subscription.objects.filter(pk=self.subscription.pk).update(current_paid_until=None)
+        self.assertIn('2 subscriptions checked, 1 drifted', self.reconcile('--dry-run'))
+        self.assertLatest(self.subscription, None, date(2021, 3, 1))
+        self.assertIn('2 subscriptions checked, 1 repaired', self.reconcile())
+        self.assertLatest(self.subscription, date(2022, 3, 1), date(2021, 3, 1))
+
+
+class LedgerTests(SubscriptionFixtures, TestCase):
+    """
+    The payments are subtracted from the balance of the clients through their ledger
+    """
+
+    def setUp(self):
+        super(LedgerTests, self).setUp()
+        self.subscription = self.create_subscription('Site')
+        self.other = self.create_subscription('Other')
+
+    def balance(self, subscription):
+        client = Client.objects.get(pk=subscription.client_id)
+        self.assertEqual(client.ledger.aggregate(total=Sum('amount'))['total'] or Decimal(0), client.balance)
+        return client.balance
+
+    def rebuild(self, *args):
+        output = StringIO()
+        # the command warns that it runs in the transaction of the test
+        with self.assertLogs('utils.backfill', 'WARNING'):
+            call_command('rebuild_ledger', *args, stdout=output)
+        return output.getvalue()
+
+    def test_payments(self):
+        payment = self.pay(self.subscription, date(2022, 3, 1), Decimal('50.00'))
+        self.assertEqual(self.balance(self.subscription), Decimal('-50.00'))
+        payment.amount = Decimal('60.00')
+        payment.save()
+        # saved again without changes
+        payment.save()
+        self.assertEqual(self.balance(self.subscription), Decimal('-60.00'))
+        payment.subscription = self.other
+        payment.save()
+        self.assertEqual((self.balance(self.subscription), self.balance(self.other)), (0, Decimal('-60.00')))
+        payment.delete()
+        self.assertEqual(self.balance(self.other), 0)
+        self.assertFalse(LedgerEntry.objects.filter(amount=0).exists())
+        self.assertIn('2 clients checked, 0 drifted', self.rebuild('--dry-run'))
+
+    def test_rebuild(self):
+        self.pay(self.subscription, date(2022, 3, 1), Decimal('50.00'))
+        self.pay(self.other, date(2022, 3, 1), Decimal('20.00'))
+        Client.objects.filter(pk=self.subscription.client_id).update(balance=0)
+        LedgerEntry.objects.filter(client_id=self.other.client_id).delete()
+        self.assertIn('2 clients checked, 2 repaired', self.rebuild())
+        self.assertEqual((self.balance(self.subscription), self.balance(self.other)),
+                         (Decimal('-50.00'), Decimal('-20.00')))
+        self.assertIn('2 clients checked, 0 repaired', self.rebuild())
+        self.rebuild('--reseed')
+        self.assertEqual(LedgerEntry.objects.count(), 2)
+        self.assertEqual(self.balance(self.subscription), Decimal('-50.00'))
+
+
+class ImportDataTests(TestCase):
+    """
+    The imported rows keep their values and get the values the save() of their models would give them
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def import_data(self, entity, name, content, *args):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as data:
+            data.write(content)
+        output = StringIO()
+        call_command('import_data', entity, path, *args, stdout=output)
+        return output.getvalue()
+
+    def test_import(self):
+        self.import_data('clients', 'clients.csv', 'id,first_name,last_name,phone\n1,Γιώργος,Παπαδόπουλος,\n2,B,B,21\n')
+        self.import_data('devices', 'devices.csv', 'id,client,model,type,serial_number\n1,1,ThinkPad,Laptop,SN-1\n'
+                                                   '2,2,ThinkPad,Laptop,SN-2\n')
+        self.import_data('subscriptions', 'subscriptions.jsonl', '{"id": 1, "client": 1, "type": "Hosting", '
+                                                                 '"description": "Site"}\n')
+        self.import_data('payments', 'payments.jsonl', '{"id": 1, "subscription": 1, "amount": "50.00", '
+                                                       '"paid_on": "2021-03-01", "duration": 12}\n\n', '--batch-size', '1')
+        self.import_data('tickets', 'tickets.csv', 'id,client,device,status,admission_date,problem,work_charge\n'
+                                                   '1,1,1,Open,2019-05-02 10:30,Broken,20.00\n2,2,2,Open,,Slow,\n')
+        output = self.import_data('charges', 'charges.csv', 'id,ticket,part,charge\n1,1,Disk,12.50\n')
+        self.assertIn('Imported 1 charges', output)
+
+        client = Client.objects.get(pk=1)
+        self.assertEqual((client.search_name, client.phone), ('γιωργοσ παπαδοπουλοσ', ''))
+        self.assertEqual(client.balance, Decimal('-17.50'))
+        self.assertEqual(Device.objects.get(pk=2).search_serial, 'sn-2')
+        subscription = Subscription.objects.get(pk=1)
+        self.assertEqual((subscription.create_date, subscription.type.description), (date.today(), 'Hosting'))
+        self.assertEqual(subscription.current_paid_until, date(2022, 3, 1))
+        imported, defaulted = Ticket.objects.order_by('pk')
+        self.assertEqual(imported.admission_date, timezone.make_aware(datetime(2019, 5, 2, 10, 30)))
+        self.assertLess(timezone.now() - defaulted.admission_date, timedelta(minutes=1))
+        self.assertEqual((imported.parts_total, imported.total_cost), (Decimal('12.50'), Decimal('32.50')))
+        self.assertEqual(defaulted.work_charge, 0)
+        # the ids go on after the imported ones
+        self.assertEqual(Client.objects.create(first_name='C', last_name='C').pk, 3)
+
+    def test_invalid_rows(self):
+        with self.assertRaisesMessage(CommandError, 'Row 2:'):
+            self.import_data('clients', 'clients.jsonl', '{"id": 1, "first_name": "A", "last_name": "A"}\n'
+                                                         '{"id": "x", "first_name": "B", "last_name": "B"}\n')
+        with self.assertRaisesMessage(CommandError, 'Subscription 7 does not exist'):
+            self.import_data('payments', 'payments.csv', 'id,subscription,amount,paid_on\n1,7,10,2021-01-01\n')
+        self.assertFalse(Payment.objects.exists())
+
+
+class ExportPaymentsTests(SubscriptionFixtures, AdminFixtures, TestCase):
+    """
+    The payments are exported with the expiration filter of the admin
+    """
+
+    def test_export(self):
+        expiring = self.create_subscription('Expiring', self.today)
+        self.create_subscription('Later', self.today + timedelta(days=400))
+        response = self.client.get('/clients/payments/export', {'payments': 'year'})
+        rows = list(csv.DictReader(StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+        self.assertEqual([int(row['subscription_id']) for row in rows], [expiring.pk])
+        self.assertEqual((rows[0]['subscription_type'], rows[0]['amount']), ('Hosting', '10.00'))
+        self.assertEqual(self.client.get('/clients/payments/export', {'format': 'xml'}).status_code, 400)
+
+
+class BackfillTests(TransactionTestCase):
+    """
+    A backfill commits every batch and continues after the last committed one when it runs again
+    """
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        override = override_settings(BACKFILL_CHECKPOINT_DIR=directory)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.ids = [Client.objects.create(first_name=str(number), last_name='Name').pk for number in range(7)]
+        self.handled = []
+
+    def backfill(self):
+        return Backfill('test', Client.objects.all(), batch_size=2, report=lambda message: None)
+
+    def handler(self, fail_on=None):
+        def handle(batch):
+            ids = list(batch.values_list('pk', flat=True))
+            batch.update(comment='done')
+            if fail_on in ids:
+                raise RuntimeError('stopped')
+            self.handled.extend(ids)
+            return len(ids)
+        return handle
+
+    def test_resume(self):
+        backfill = self.backfill()
+        with self.assertRaises(RuntimeError):
+            backfill.run(self.handler(fail_on=self.ids[4]))
+        self.assertEqual(backfill.load(), (self.ids[3], 4))
+        # the batch that failed was rolled back and the ones before it stay committed
+        self.assertEqual(list(Client.objects.filter(comment='done').values_list('pk', flat=True)), self.ids[:4])
+        self.assertEqual(self.backfill().run(self.handler()), (3, 3))
+        self.assertEqual(self.handled, self.ids)
+        # finished, the next run starts over
+        self.assertFalse(os.path.exists(backfill.checkpoint_path))
+        self.assertEqual(self.backfill().run(self.handler()), (7, 7))
+
+    def test_reset(self):
+        backfill = self.backfill()
+        backfill.save(self.ids[3], 4)
+        backfill.reset()
+        self.assertEqual(backfill.run(self.handler()), (7, 7))
+
+    def test_inside_transaction(self):
+        with self.assertLogs('utils.backfill', 'WARNING'), transaction.atomic():
+            backfill = self.backfill()
+            with self.assertRaises(RuntimeError):
+                backfill.run(self.handler(fail_on=self.ids[4]))
+        self.assertEqual(backfill.load(), (None, 0))
+
+
+class MailTransportTests(TestCase):
+    """
+    The emails are sent over one open connection, opened again when the server has dropped it
+    """
+
+    def setUp(self):
+        self.server = LocalSMTPServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.transport = mail.MailTransport('127.0.0.1', self.server.port, tls=False)
+        self.addCleanup(self.transport.close)
+
+    def send(self):
+        self.transport.send('hosting@d-h.gr', ['support@d-h.gr'], mail.build_message(
+            'hosting@d-h.gr', 'support@d-h.gr', 'Notification', 'Content'))
+
+    def drop_connection(self, exc):
+        """
+        make the open connection fail the next message with the error
+        """
+        self.transport.open()
+        self.transport.connection.sendmail = mock.Mock(side_effect=exc)
+
+    def test_one_connection(self):
+        for number in range(3):
+            self.send()
+        self.assertEqual((self.server.connections, self.server.messages), (1, 3))
+
+    def test_reconnect(self):
+        for exc in (smtplib.SMTPResponseException(421, b'Service not available'),
+                    smtplib.SMTPServerDisconnected(), ConnectionResetError()):
+            self.drop_connection(exc)
+            self.send()
+        self.assertEqual((self.server.connections, self.server.messages), (4, 3))
+
+    def test_rejected_message(self):
+        self.drop_connection(smtplib.SMTPResponseException(550, b'Mailbox unavailable'))
+        with self.assertRaises(smtplib.SMTPResponseException):
+            self.send()
+        self.assertEqual((self.server.connections, self.server.messages), (1, 0))
+        self.assertFalse(mail.is_connection_error(smtplib.SMTPRecipientsRefused({})))
+
+    def test_settings(self):
+        self.addCleanup(lambda: [transport.close() for transport in mail._local.transports.values()])
+        with override_settings(EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server.port, EMAIL_USE_TLS=False,
+                               EMAIL_HOST_USER=''):
+            mail.send_mail('support@d-h.gr', 'Notification', {'client': 'Test', 'days': 7})
+            mail.send_content(['support@d-h.gr'], 'Notification', 'Content')
+            self.assertIs(mail.get_transport(), mail.get_transport())
+        self.assertEqual((self.server.connections, self.server.messages), (1, 2))
+
+
+class NotificationLogTests(SubscriptionFixtures, TestCase):
+    """
+    Every expiration notice is recorded and sent once however many times the scan and the tasks run
+    """
+
+    def setUp(self):
+        super(NotificationLogTests, self).setUp()
+        self.week = self.create_subscription('Week', self.today + timedelta(days=7))
+        self.day = self.create_subscription('Day', self.today + timedelta(days=1))
+
+    def scan(self):
+        """
+        :return: the ids of the logs queued by the scan
+        """
+        with mock.patch('client.tasks.send_expiration_notice.delay') as delay:
+            schedule()
+        return sorted(call[0][0] for call in delay.call_args_list)
+
+    def test_scan_again(self):
+        queued = self.scan()
+        self.assertEqual(len(queued), 2)
+        # the notices that weren't sent are queued again without new logs
+        self.assertEqual(self.scan(), queued)
+        send_expiration_notice(queued[0])
+        self.assertEqual(self.scan(), queued[1:])
+        self.assertEqual(NotificationLog.objects.count(), 2)
+
+    def test_send_once(self):
+        log_id = self.scan()[0]
+        send_expiration_notice(log_id)
+        send_expiration_notice(log_id)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+        log = NotificationLog.objects.get(pk=log_id)
+        self.assertIsNotNone(log.sent_on)
+        self.assertEqual(log.attempts, 1)
+
+    def test_renewed_after_scan(self):
+        queued = self.scan()
+        self.pay(self.week, self.today + timedelta(days=372))
+        for log_id in queued:
+            send_expiration_notice(log_id)
+        self.assertEqual(OutboxMessage.objects.count(), 1)
+        self.assertEqual(NotificationLog.objects.get(subscription=self.week).sent_on, None)
+
+    def test_concurrent_scan(self):
+        key = (self.week.pk, 7, self.today + timedelta(days=7))
+        # another scan has created the log after this one looked for it
+        with mock.patch.object(NotificationLog.objects, 'bulk_create', side_effect=IntegrityError):
+            NotificationLog.objects.create(subscription_id=key[0], offset_days=key[1], expiry_date=key[2])
+            unsent = record_notifications({key})
+        self.assertEqual(unsent, [(NotificationLog.objects.get().pk, self.week.pk)])
+
+
+@override_settings(EXPIRATION_NOTICE_MODE='digest')
+class DigestTests(SubscriptionFixtures, TestCase):
+    """
+    In the digest mode every client gets one email with all its expiring subscriptions
+    """
+
+    def setUp(self):
+        super(DigestTests, self).setUp()
+        self.week = self.create_subscription('Site', self.today + timedelta(days=7))
+        client = self.week.client
+        self.day = Subscription.objects.create(client=client, type=self.subscription_type, description='Mail')
+        self.pay(self.day, self.today + timedelta(days=1))
+        self.other = self.create_subscription('Other', self.today + timedelta(days=14))
+
+    def scan(self):
+        """
+        :return: the log ids of every digest queued by the scan by subscription
+        """
+        with mock.patch('client.tasks.send_expiration_digest.delay') as delay:
+            schedule()
+        return [
+            sorted(NotificationLog.objects.filter(pk__in=call[0][0]).values_list('subscription_id', flat=True))
+            for call in delay.call_args_list
+        ], [call[0][0] for call in delay.call_args_list]
+
+    def test_digest_per_client(self):
+        subscriptions, digests = self.scan()
+        self.assertCountEqual(subscriptions, [sorted([self.week.pk, self.day.pk]), [self.other.pk]])
+        for log_ids in digests:
+            send_expiration_digest(log_ids)
+            send_expiration_digest(log_ids)
+        self.assertEqual(sorted(OutboxMessage.objects.values_list('subject', flat=True)), [
+            'Other Other - 1 subscriptions ending soon', 'Site Site - 2 subscriptions ending soon'
+        ])
+        self.assertFalse(NotificationLog.objects.filter(sent_on__isnull=True).exists())
+        # nothing left for the next scan
+        self.assertEqual(self.scan()[1], [])
+
+    def test_renewed_after_scan(self):
+        subscriptions, digests = self.scan()
+        self.pay(self.week, self.today + timedelta(days=372))
+        for log_ids in digests:
+            send_expiration_digest(log_ids)
+        message = OutboxMessage.objects.get(subject__startswith='Site')
+        self.assertEqual(message.subject, 'Site Site - 1 subscriptions ending soon')
+        self.assertIn('Hosting - Mail', message.content)
+        self.assertNotIn('Hosting - Site', message.content)
+
+
+class OutboxTests(TestCase):
+    """
+    The outbox sends the pending emails up to the rate limit and tries the failed ones again later
+    """
+
+    def setUp(self):
+        self.messages = [
+            OutboxMessage.queue('support@d-h.gr', 'Notification {0}'.format(number), {'client': 'Test', 'days': number})
+            for number in range(5)
+        ]
+        patcher = mock.patch('client.tasks.send_content')
+        self.send_content = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pending(self):
+        return list(OutboxMessage.objects.pending().values_list('pk', flat=True))
+
+    def test_rate_limit(self):
+        self.assertEqual(per_minute('30/m'), 30)
+        self.assertEqual(per_minute('2/s'), 120)
+        self.assertEqual(per_minute('1/h'), 1)
+        with override_settings(NOTIFICATION_RATE_LIMIT='3/m'):
+            self.assertEqual(deliver_outbox(batch_size=2), 3)
+        self.assertEqual(self.pending(), [message.pk for message in self.messages[3:]])
+        self.assertEqual(deliver_outbox(), 2)
+        self.assertEqual(self.pending(), [])
+        self.assertEqual(self.send_content.call_count, 5)
+        self.assertEqual(self.send_content.call_args[0][1], 'Notification 4')
+
+    def test_failed_message(self):
+        self.send_content.side_effect = [None, smtplib.SMTPRecipientsRefused({}), None, None, None]
+        self.assertEqual(deliver_outbox(), 4)
+        failed = OutboxMessage.objects.get(pk=self.messages[1].pk)
+        self.assertIsNone(failed.sent_on)
+        self.assertEqual(failed.attempts, 1)
+        self.assertNotEqual(failed.last_error, '')
+        self.assertGreater(failed.next_attempt_on, timezone.now())
+        self.assertEqual(self.pending(), [])
+
+    def test_connection_error(self):
+        self.send_content.side_effect = [None, ConnectionRefusedError()]
+        self.assertEqual(deliver_outbox(batch_size=2), 1)
+        # the rest wait for the next run
+        self.assertEqual(self.send_content.call_count, 2)
+        self.assertEqual(self.pending(), [message.pk for message in self.messages[2:]])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'SKIP LOCKED needs postgresql')
+class OutboxSkipLockedTests(TransactionTestCase):
+    """
+    A worker skips the messages that another worker is sending
+    """
+
+    def test_skip_locked(self):
+        messages = [OutboxMessage.queue('support@d-h.gr', 'Notification', {'days': number}) for number in range(3)]
+        locked, release = threading.Event(), threading.Event()
+
+        def other_worker():
+            try:
+                with transaction.atomic():
+                    OutboxMessage.objects.select_for_update().get(pk=messages[0].pk)
+                    locked.set()
+                    release.wait(10)
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        try:
+            locked.wait(10)
+            with mock.patch('client.tasks.send_content') as send_content:
+                self.assertEqual(deliver_outbox(), 2)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(send_content.call_count, 2)
+        self.assertEqual(list(OutboxMessage.objects.pending().values_list('pk', flat=True)), [messages[0].pk])
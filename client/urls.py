@@ -0,0 +1,7 @@
+from django.conf.urls import url
+from client.views import export_payments
+
+
+urlpatterns = [
+    url(r'^payments/export$', export_payments)
+]
\ No newline at end of file
@@ -1,3 +1,41 @@
-from django.shortcuts import render
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponseBadRequest
+from client.models import Subscription, Payment
+from client.adminfilters import SubscriptionExpirationFilter
+from utils.export import CONTENT_TYPES, export_response
 
-# Create your views here.
+# the columns of the export as (header, field)
+PAYMENT_COLUMNS = [
+    ('id', 'pk'),
+    ('client_id', 'client_id'),
+    ('client_first_name', 'client__first_name'),
+    ('client_last_name', 'client__last_name'),
+    ('subscription_id', 'subscription_id'),
+    ('subscription_type', 'subscription__type__description'),
+    ('subscription_description', 'subscription__description'),
+    ('duration', 'duration'),
+    ('amount', 'amount'),
+    ('paid_on', 'paid_on'),
+    ('paid_until', 'paid_until'),
+]
+
+
+@staff_member_required
+def export_payments(request):
+    """
+    Export the payments of the subscriptions matching the filter of the query string.
+    The filter accepts:
+        payments: week, month, year or expired, same as the admin filter of the expiration
+        format: csv (default) or jsonl
+    """
+    params = request.GET.dict()
+    file_format = params.get('format', 'csv')
+    if file_format not in CONTENT_TYPES:
+        return HttpResponseBadRequest('Invalid format')
+    queryset = Payment.objects.all()
+    # filter the subscriptions the same way the admin does
+    expiration = SubscriptionExpirationFilter(request, params, Subscription, None)
+    subscriptions = expiration.queryset(request, Subscription.objects.all())
+    if subscriptions is not None:
+        queryset = queryset.filter(subscription__in=subscriptions.values('pk'))
+    return export_response(queryset.order_by('pk'), PAYMENT_COLUMNS, file_format, 'payments')
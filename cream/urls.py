@@ -15,10 +15,13 @@ Including another URLconf
 """
 from django.conf.urls import url, include
 from django.contrib import admin
-from dashboard.views import show_ip
+from dashboard.views import show_ip, outbox_status
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^getIP/', show_ip),
-    url(r'^tickets/', include('ticket.urls'))
+    url(r'^outbox/', outbox_status),
+    url(r'^tickets/', include('ticket.urls')),
+    url(r'^clients/', include('client.urls')),
+    url(r'^api/', include('api.urls'))
 ]
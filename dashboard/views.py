@@ -1,8 +1,18 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from client.models import OutboxMessage
 import socket
 
 
 # show the ip of the server
 def show_ip(request):
     return HttpResponse(socket.gethostbyname(socket.gethostname()))
+
+
+@staff_member_required
+def outbox_status(request):
+    """
+    the queue depth and the send lag of the email outbox as json
+    """
+    return JsonResponse(OutboxMessage.objects.metrics())
@@ -1,6 +1,16 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connections
+from django.db.models import Q
+from django.db.models.functions import Greatest
+from client.models import Client, Device
 from ticket.models import Ticket, TicketStatus, Charges
 from ticket.adminfilters import TicketDeliveredFilter
+from ticket.views import tickets_response, TICKET_COLUMNS, CHARGE_COLUMNS
+from utils.export import export_response
+from utils.search import normalize
+from utils.adminpagination import KeysetPaginationMixin
 
 
 class ChargesInline(admin.TabularInline):
@@ -8,7 +18,7 @@ class ChargesInline(admin.TabularInline):
 
 
 @admin.register(Ticket)
-class TicketAdmin(admin.ModelAdmin):
+class TicketAdmin(KeysetPaginationMixin, admin.ModelAdmin):
     """
     Admin class for the Ticket class.
     """
@@ -20,7 +30,7 @@ class TicketAdmin(admin.ModelAdmin):
         'date_admitted',
         'device_model',
         'device_serial_number',
-        'total_cost',
+        'total_cost_display',
         'delivered',
         'ticket_pdf'
     ]
@@ -29,6 +39,8 @@ class TicketAdmin(admin.ModelAdmin):
         ChargesInline
     ]
 
+    readonly_fields = ('parts_total', 'total_cost')
+
     list_filter = (
         TicketDeliveredFilter,
     )
@@ -39,6 +51,46 @@ class TicketAdmin(admin.ModelAdmin):
         'device__serial_number'
     ]
 
+    actions = [
+        'print_tickets_pdf',
+        'print_tickets_zip',
+        'export_tickets_csv',
+        'export_tickets_jsonl',
+        'export_charges_csv'
+    ]
+
+    def get_queryset(self, request):
+        """
+        load the related rows of the list with joins
+        """
+        queryset = super(TicketAdmin, self).get_queryset(request)
+        return queryset.select_related('client', 'device', 'device__model', 'status')
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        On postgresql search the normalized client names and serial numbers through their trigram indexes,
+        matching parts of them and misspelled ones, and rank the results by similarity.
+        The other databases use the default search.
+        """
+        term = normalize(search_term)
+        if not term or connections[queryset.db].vendor != 'postgresql':
+            return super(TicketAdmin, self).get_search_results(request, queryset, search_term)
+        # find the clients and the devices first so that each search uses its own index
+        clients = Client.objects.filter(Q(search_name__contains=term) | Q(search_name__trigram_similar=term))
+        devices = Device.objects.filter(Q(search_serial__contains=term) | Q(search_serial__trigram_similar=term))
+        queryset = queryset.filter(
+            Q(client__in=clients.values('pk')) | Q(device__in=devices.values('pk'))
+        ).annotate(
+            search_rank=Greatest(
+                TrigramSimilarity('client__search_name', term),
+                TrigramSimilarity('device__search_serial', term)
+            )
+        )
+        # keep the ordering picked by the user
+        if ORDER_VAR not in request.GET:
+            queryset = queryset.order_by('-search_rank', '-pk')
+        return queryset, False
+
     def client_name(self, obj):
         """
         returns the full name of the client associated with the ticket
@@ -78,6 +130,7 @@ class TicketAdmin(admin.ModelAdmin):
         return obj.status.status
     # set the description of the field
     ticket_status.short_description = "Status"
+    ticket_status.admin_order_field = 'status__status'
 
     def ticket_pdf(self, obj):
         """
@@ -94,13 +147,50 @@ class TicketAdmin(admin.ModelAdmin):
         return obj.admission_date.strftime("%d-%m-%Y")
     date_admitted.short_description = 'Date Admitted'
 
-    def total_cost(self, obj):
+    def total_cost_display(self, obj):
         """
         returns the total cost of the ticket including the parts used.
         """
-        return "{0} €".format(obj.total_cost())
+        return "{0} €".format(obj.total_cost)
+
+    total_cost_display.short_description = "Total Cost"
+    total_cost_display.admin_order_field = 'total_cost'
+
+    def print_tickets_pdf(self, request, queryset):
+        """
+        prints the selected tickets into one pdf file
+        """
+        return tickets_response(queryset, 'pdf')
+    print_tickets_pdf.short_description = 'Print selected tickets (PDF)'
 
-    total_cost.short_description = "Total Cost"
+    def print_tickets_zip(self, request, queryset):
+        """
+        prints the selected tickets into a zip file with a pdf for each ticket
+        """
+        return tickets_response(queryset, 'zip')
+    print_tickets_zip.short_description = 'Print selected tickets (ZIP)'
+
+    def export_tickets_csv(self, request, queryset):
+        """
+        exports the selected tickets into a csv file
+        """
+        return export_response(queryset.order_by('pk'), TICKET_COLUMNS, 'csv', 'tickets')
+    export_tickets_csv.short_description = 'Export selected tickets (CSV)'
+
+    def export_tickets_jsonl(self, request, queryset):
+        """
+        exports the selected tickets into a json lines file
+        """
+        return export_response(queryset.order_by('pk'), TICKET_COLUMNS, 'jsonl', 'tickets')
+    export_tickets_jsonl.short_description = 'Export selected tickets (JSON lines)'
+
+    def export_charges_csv(self, request, queryset):
+        """
+        exports the charges of the selected tickets into a csv file
+        """
+        charges = Charges.objects.filter(ticket__in=queryset.values('pk')).order_by('pk')
+        return export_response(charges, CHARGE_COLUMNS, 'csv', 'charges')
+    export_charges_csv.short_description = 'Export the charges of selected tickets (CSV)'
 
 
 @admin.register(TicketStatus)
@@ -0,0 +1,180 @@
+import os
+from collections import OrderedDict
+import resource
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction, reset_queries
+from django.utils import timezone
+from client.models import Client, Device, DeviceModel, DeviceType
+from storage.models import Part
+from ticket.models import Ticket, TicketStatus, Charges
+from utils.pdf.ticket import TicketPDF
+
+GREEK_TEXT = 'Ο υπολογιστής δεν ανάβει μετά από διακοπή ρεύματος, ελέγχθηκε το τροφοδοτικό και η μητρική. '
+LATIN_TEXT = 'The laptop does not power on after a power cut, checked the power supply and the motherboard. '
+
+
+class Rollback(Exception):
+    """
+    raised to roll back the fixtures created in the database
+    """
+
+
+def current_rss():
+    """
+    returns the resident memory of the process in KiB
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        # no procfs, fall back to the peak memory
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, percent):
+    """
+    returns the percentile of a sorted list with the nearest rank method
+    """
+    index = max(0, int(round(percent / 100 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the rendering of the ticket pdf with fixture tickets of different sizes.'
+
+    # name, number of charges, text of the problem, diagnosis and actions
+    fixtures = [
+        ('0 charges', 0, GREEK_TEXT),
+        ('10 charges', 10, GREEK_TEXT),
+        ('100 charges', 100, GREEK_TEXT),
+        ('1000 charges', 1000, GREEK_TEXT),
+        ('long text', 10, GREEK_TEXT * 4 + LATIN_TEXT * 4),
+        ('latin text', 10, LATIN_TEXT),
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50,
+                            help='renders of every fixture for the latency figures')
+        parser.add_argument('--soak', type=int, default=10000,
+                            help='consecutive renders used to measure the memory growth, 0 to skip')
+        parser.add_argument('--soak-fixture', default='10 charges',
+                            help='the fixture rendered by the soak test')
+        parser.add_argument('--database', action='store_true',
+                            help='store the fixtures in the database, roll them back at the end, '
+                                 'and load the ticket on every render')
+
+    def handle(self, *args, **options):
+        if not options['database']:
+            self.run(self.memory_fixtures(), options)
+            return
+        try:
+            with transaction.atomic():
+                self.run(self.database_fixtures(), options)
+                raise Rollback()
+        except Rollback:
+            pass
+
+    @staticmethod
+    def load(fixture):
+        """
+        returns the ticket of the fixture, the in memory tickets are used as they are
+        and the stored ones are loaded the way the views load them.
+        """
+        if isinstance(fixture, Ticket):
+            return fixture
+        return Ticket.objects.for_pdf().get(pk=fixture)
+
+    def run(self, fixtures, options):
+        """
+        Run the benchmark for the fixtures, a dict of fixture names to tickets or ticket ids.
+        """
+        self.stdout.write('{0:<14}{1:>10}{2:>10}{3:>10}{4:>12}'.format('fixture', 'docs/s', 'p50 ms', 'p99 ms', 'bytes'))
+        for name, fixture in fixtures.items():
+            timings = []
+            size = 0
+            for _ in range(options['iterations']):
+                started = time.perf_counter()
+                size = self.render(self.load(fixture))
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+            self.stdout.write('{0:<14}{1:>10.1f}{2:>10.1f}{3:>10.1f}{4:>12}'.format(
+                name, len(timings) / sum(timings), percentile(timings, 50) * 1000,
+                percentile(timings, 99) * 1000, size
+            ))
+        if options['soak']:
+            fixture = fixtures[options['soak_fixture']]
+            # warm up so the fonts and the images don't count as growth
+            self.render(self.load(fixture))
+            rss_before = current_rss()
+            started = time.perf_counter()
+            for _ in range(options['soak']):
+                self.render(self.load(fixture))
+            elapsed = time.perf_counter() - started
+            rss_after = current_rss()
+            self.stdout.write('soak: {0} renders of "{1}" in {2:.1f} s, {3:.1f} docs/s, '
+                              'RSS {4} KiB -> {5} KiB ({6:+d} KiB)'.format(
+                                  options['soak'], options['soak_fixture'], elapsed, options['soak'] / elapsed,
+                                  rss_before, rss_after, rss_after - rss_before
+                              ))
+
+    @staticmethod
+    def render(ticket):
+        """
+        Render the ticket the way the views stream it.
+        :return: the size of the pdf
+        """
+        # the debug mode keeps every query in memory
+        reset_queries()
+        return sum(len(chunk) for chunk in TicketPDF(ticket).stream())
+
+    def memory_fixtures(self):
+        """
+        Build the fixture tickets without touching the database.
+        """
+        fixtures = OrderedDict()
+        for number, (name, charges, text) in enumerate(self.fixtures, 1):
+            client = Client(id=number, first_name='Γιώργος', last_name='Παπαδόπουλος', phone='2101234567',
+                            mobile='6971234567')
+            device = Device(id=number, client=client, model=DeviceModel(name='Dell Latitude E7450'),
+                            serial_number='SN{0:08d}'.format(number), type=DeviceType(type='Laptop'))
+            ticket = Ticket(id=number, client=client, device=device, status=TicketStatus(status='Open'),
+                            problem=text, diagnosis=text, actions=text, work_charge=Decimal('25.00'))
+            ticket.admission_date = ticket.discharge_date = timezone.now()
+            part = Part(part='Τροφοδοτικό 65W')
+            rows = [Charges(ticket=ticket, part=part, charge=Decimal('12.50'), serial_number='P{0:06d}'.format(i))
+                    for i in range(charges)]
+            # set the charges the same way prefetch_related does
+            queryset = Charges.objects.all()
+            queryset._result_cache = rows
+            queryset._prefetch_done = True
+            ticket._prefetched_objects_cache = {'charges': queryset}
+            ticket.parts_total = sum(row.charge for row in rows)
+            ticket.total_cost = ticket.parts_total + ticket.work_charge
+            fixtures[name] = ticket
+        return fixtures
+
+    def database_fixtures(self):
+        """
+        Store the fixture tickets in the database.
+        """
+        device_type, _ = DeviceType.objects.get_or_create(type='Laptop')
+        device_model, _ = DeviceModel.objects.get_or_create(name='Dell Latitude E7450')
+        status, _ = TicketStatus.objects.get_or_create(status='Open')
+        part = Part.objects.create(part='Τροφοδοτικό 65W')
+        fixtures = OrderedDict()
+        for name, charges, text in self.fixtures:
+            client = Client.objects.create(first_name='Γιώργος', last_name='Παπαδόπουλος', phone='2101234567',
+                                           mobile='6971234567')
+            device = Device.objects.create(client=client, model=device_model, type=device_type)
+            ticket = Ticket.objects.create(client=client, device=device, status=status, problem=text,
+                                           diagnosis=text, actions=text, work_charge=Decimal('25.00'),
+                                           discharge_date=timezone.now())
+            Charges.objects.bulk_create([
+                Charges(ticket=ticket, part=part, charge=Decimal('12.50'), serial_number='P{0:06d}'.format(i))
+                for i in range(charges)
+            ])
+            Ticket.objects.filter(pk=ticket.pk).refresh_costs()
+            fixtures[name] = ticket.pk
+        return fixtures
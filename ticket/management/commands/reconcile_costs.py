@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from client.models import LedgerEntry
+from ticket.models import Ticket
+from utils.backfill import Backfill
+
+
+class Command(BaseCommand):
+    help = 'Check the parts_total and total_cost columns of the tickets against their charges and repair the drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='tickets checked by every query')
+        parser.add_argument('--sleep', type=float, default=0, help='seconds to wait after every batch')
+        parser.add_argument('--restart', action='store_true', help='start from the first ticket, not the checkpoint')
+        parser.add_argument('--dry-run', action='store_true', help='report the drift without repairing it')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        backfill = Backfill(
+            'reconcile_costs', Ticket.objects.all(), batch_size=options['batch_size'], sleep=options['sleep'],
+            checkpoint=not self.dry_run, report=self.stdout.write
+        )
+        if options['restart']:
+            backfill.reset()
+        checked, drifted = backfill.run(self.repair)
+        self.stdout.write('{0} tickets checked, {1} {2}'.format(
+            checked, drifted, 'drifted' if self.dry_run else 'repaired'))
+
+    def repair(self, batch):
+        """
+        check the costs of the tickets of a batch and repair the drifted ones
+        :return: the number of tickets drifted
+        """
+        rows = batch.with_costs().values_list(
+            'pk', 'client_id', 'parts_total', 'total_cost', 'parts_cost_sum', 'total_cost_sum'
+        )
+        ids = []
+        for pk, client_id, parts_total, total_cost, parts_cost_sum, total_cost_sum in rows:
+            if parts_total != parts_cost_sum or total_cost != total_cost_sum:
+                ids.append(pk)
+                self.stdout.write('Ticket {0}: {1} / {2} instead of {3} / {4}'.format(
+                    pk, parts_total, total_cost, parts_cost_sum, total_cost_sum))
+        if ids and not self.dry_run:
+            # lock the tickets so the charges saved meanwhile are added after the repair
+            list(Ticket.objects.select_for_update().filter(pk__in=ids).values_list('pk', flat=True))
+            tickets = Ticket.objects.filter(pk__in=ids)
+            tickets.refresh_costs()
+            # bring what the ledger has for the tickets to their total cost, read again under the lock
+            ledger = dict(LedgerEntry.objects.filter(ticket_id__in=ids).order_by().values('ticket').annotate(
+                total=Sum('amount')).values_list('ticket', 'total'))
+            for pk, client_id, total_cost in tickets.values_list('pk', 'client_id', 'total_cost'):
+                LedgerEntry.post(client_id, total_cost - ledger.get(pk, 0), ticket_id=pk,
+                                 description='Cost correction')
+        return len(ids)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 13:38
+from __future__ import unicode_literals
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from utils.backfill import Backfill
+
+
+def fill_costs(apps, schema_editor):
+    """
+    set the cost columns of the existing tickets from their charges
+    """
+    Ticket = apps.get_model('ticket', 'Ticket')
+    Charges = apps.get_model('ticket', 'Charges')
+    parts_total = Coalesce(
+        Subquery(
+            Charges.objects.filter(ticket=OuterRef('pk')).order_by().values('ticket').annotate(
+                total=Sum('charge')
+            ).values('total'),
+            output_field=models.DecimalField(max_digits=8, decimal_places=2)
+        ),
+        Value(Decimal(0))
+    )
+    Backfill('ticket_0009_cost_columns', Ticket.objects.all()).run(
+        lambda batch: batch.update(parts_total=parts_total, total_cost=parts_total + F('work_charge'))
+    )
+
+
+class Migration(migrations.Migration):
+    # commit every batch of the backfill on its own, a stopped run continues from its checkpoint
+    atomic = False
+
+    dependencies = [
+        ('ticket', '0008_cost_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_costs, migrations.RunPython.noop),
+    ]
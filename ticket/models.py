@@ -1,6 +1,17 @@
-from django.db import models
-from client.models import Client, Device
+from django.db import models, transaction
+from django.db.models import Sum, F, Value, ExpressionWrapper, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from decimal import Decimal
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from client.models import Client, Device, LedgerEntry
 from storage.models import Part
+from utils.changes import ChangeTrackingQuerySet, tracked_fields
+from utils.pdf import cache
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class TicketStatus(models.Model):
@@ -14,13 +25,59 @@ class TicketStatus(models.Model):
         return self.status
 
 
+class TicketQuerySet(ChangeTrackingQuerySet):
+    """
+    QuerySet for the tickets
+    """
+
+    def for_pdf(self):
+        """
+        load everything printed on the pdf along with the tickets
+        """
+        return self.select_related('client', 'device', 'device__model').prefetch_related(
+            models.Prefetch('charges', queryset=Charges.objects.select_related('part'))
+        )
+
+    def with_costs(self):
+        """
+        calculate the cost of the parts and the total cost of the tickets from their charges,
+        as parts_cost_sum and total_cost_sum. Used to check the parts_total and total_cost columns.
+        """
+        return self.annotate(
+            parts_cost_sum=Coalesce(
+                Sum('charges__charge'), Value(Decimal(0)), output_field=models.DecimalField(max_digits=8, decimal_places=2)
+            )
+        ).annotate(
+            total_cost_sum=ExpressionWrapper(
+                F('parts_cost_sum') + F('work_charge'), output_field=models.DecimalField(max_digits=8, decimal_places=2)
+            )
+        )
+
+    def refresh_costs(self):
+        """
+        set the parts_total and total_cost columns of the tickets from their charges with one update
+        :return: the number of tickets updated
+        """
+        parts_total = Coalesce(
+            Subquery(
+                Charges.objects.filter(ticket=OuterRef('pk')).order_by().values('ticket').annotate(
+                    total=Sum('charge')
+                ).values('total'),
+                output_field=models.DecimalField(max_digits=8, decimal_places=2)
+            ),
+            Value(Decimal(0))
+        )
+        return self.update(parts_total=parts_total, total_cost=parts_total + F('work_charge'))
+
+
 class Ticket(models.Model):
     """
     Model for the tickets opened for the clients.
     """
     client = models.ForeignKey(Client, related_name='tickets')
     device = models.ForeignKey(Device, related_name='tickets')
-    admission_date = models.DateTimeField(auto_now_add=True)
+    # the time the ticket is created, unless it's imported with its own
+    admission_date = models.DateTimeField(default=timezone.now, editable=False, blank=True)
     discharge_date = models.DateTimeField(blank=True, null=True)
     status = models.ForeignKey(TicketStatus, related_name='tickets')
     delivered = models.BooleanField(default=False)
@@ -29,22 +86,72 @@ class Ticket(models.Model):
     actions = models.TextField(max_length=600, blank=True, default="")
     work_charge = models.DecimalField(max_digits=6, decimal_places=2, blank=True, default=0)
     parts = models.ManyToManyField(Part, through='Charges', through_fields=('ticket', 'part'), related_name='tickets')
+    # the sum of the charges and the total with the work charge, kept up to date by the charges
+    parts_total = models.DecimalField(max_digits=8, decimal_places=2, default=0, editable=False)
+    total_cost = models.DecimalField(max_digits=8, decimal_places=2, default=0, editable=False, db_index=True)
+    # the time of the last change, for the Last-Modified of the api
+    updated_at = models.DateTimeField(auto_now=True)
+    # the id of the transaction of the last change, set by a trigger on postgresql and read by the change feed
+    change_id = models.BigIntegerField(default=0, editable=False)
+
+    objects = TicketQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # the pages of the tickets ordered by admission date
+            models.Index(fields=['admission_date', 'id']),
+            # the changes since a time
+            models.Index(fields=['updated_at', 'id']),
+            # the changes since a transaction
+            models.Index(fields=['change_id', 'id']),
+        ]
+
+    # the columns that are only updated in the database
+    COST_FIELDS = ('parts_total', 'total_cost')
 
     def __str__(self):
         return "{} - {}".format(self.client, self.device)
 
-    def parts_cost(self):
-        """
-        calculate the total cost of the parts used in the ticket
-        """
-        return sum([x.charge for x in self.charges.all()])
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Ticket, cls).from_db(db, field_names, values)
+        # keep the loaded work charge and client to know what changed on save
+        instance._loaded = (instance.__dict__.get('work_charge'), instance.__dict__.get('client_id'))
+        return instance
 
-    def total_cost(self):
+    def save(self, *args, **kwargs):
         """
-        return the total cost of the ticket
-        :return: decimal
+        Override the default save method of the model so that the cost columns are never written from
+        a ticket loaded before its charges changed. They are updated in the database when the work charge changes,
+        and the changes of the cost are added to the ledger of the client.
         """
-        return sum([self.parts_cost(), self.work_charge])
+        if self._state.adding or kwargs.get('force_insert'):
+            self.total_cost = self.parts_total + Decimal(self.work_charge)
+            with transaction.atomic(using=kwargs.get('using')):
+                super(Ticket, self).save(*args, **kwargs)
+                LedgerEntry.post(self.client_id, self.total_cost, ticket_id=self.pk, description='Ticket')
+            self._loaded = (self.work_charge, self.client_id)
+            return
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            update_fields = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+        kwargs['update_fields'] = tracked_fields([field for field in update_fields if field not in self.COST_FIELDS])
+        work_charge, client_id = getattr(self, '_loaded', (self.work_charge, self.client_id))
+        with transaction.atomic(using=kwargs.get('using')):
+            super(Ticket, self).save(*args, **kwargs)
+            if 'client' in kwargs['update_fields'] and client_id is not None and self.client_id != client_id:
+                # move what the ticket costs to the new client
+                owed = LedgerEntry.objects.filter(ticket_id=self.pk, client_id=client_id).aggregate(
+                    total=Sum('amount'))['total']
+                LedgerEntry.post(client_id, -(owed or 0), ticket_id=self.pk, description='Ticket moved')
+                LedgerEntry.post(self.client_id, owed, ticket_id=self.pk, description='Ticket moved')
+            if 'work_charge' in kwargs['update_fields'] and work_charge is not None and \
+                    self.work_charge != work_charge:
+                Ticket.objects.filter(pk=self.pk).update(total_cost=F('parts_total') + F('work_charge'))
+                self.refresh_from_db(fields=self.COST_FIELDS)
+                LedgerEntry.post(self.client_id, Decimal(self.work_charge) - work_charge, ticket_id=self.pk,
+                                 description='Work charge')
+        self._loaded = (self.work_charge, self.client_id)
 
     def discharge_full_date(self):
         if self.discharge_date:
@@ -60,3 +167,104 @@ class Charges(models.Model):
     part = models.ForeignKey(Part, on_delete=models.CASCADE, related_name='charges')
     charge = models.DecimalField(max_digits=6, decimal_places=2)
     serial_number = models.CharField(max_length=30, blank=True, default="")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Charges, cls).from_db(db, field_names, values)
+        # keep the loaded ticket and charge to apply only the difference to the ticket costs
+        instance._loaded_costs = (instance.__dict__.get('ticket_id'), instance.__dict__.get('charge'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        """
+        Override the default save method of the model to add the change of the charge to the costs of the ticket
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and not {'ticket', 'ticket_id', 'charge'} & set(update_fields):
+            super(Charges, self).save(*args, **kwargs)
+            return
+        with transaction.atomic(using=kwargs.get('using')):
+            super(Charges, self).save(*args, **kwargs)
+            ticket_id, charge = getattr(self, '_loaded_costs', (None, None))
+            if ticket_id is not None and charge is not None:
+                add_ticket_costs(ticket_id, -charge)
+            add_ticket_costs(self.ticket_id, Decimal(self.charge))
+        self._loaded_costs = (self.ticket_id, Decimal(self.charge))
+
+
+def add_ticket_costs(ticket_id, amount):
+    """
+    add the amount to the parts total and the total cost of the ticket in the database
+    and to the ledger of the client
+    """
+    if amount:
+        Ticket.objects.filter(pk=ticket_id).update(
+            parts_total=F('parts_total') + amount, total_cost=F('total_cost') + amount
+        )
+        client_id = Ticket.objects.filter(pk=ticket_id).values_list('client_id', flat=True).first()
+        if client_id is not None:
+            LedgerEntry.post(client_id, amount, ticket_id=ticket_id, description='Charge')
+
+
+@receiver(post_delete, sender=Ticket)
+def reverse_ticket_ledger(sender, instance, **kwargs):
+    """
+    cancel what the deleted ticket cost the client
+    """
+    LedgerEntry.reverse(instance.client_id, ticket_id=instance.pk, description='Ticket deleted')
+
+
+@receiver([post_save, post_delete], sender=Ticket)
+def invalidate_ticket_pdf(sender, instance, **kwargs):
+    """
+    remove the cached pdf of the ticket
+    """
+    cache.invalidate([instance.pk])
+
+
+@receiver(post_save, sender=Ticket)
+def prerender_ticket_pdf(sender, instance, **kwargs):
+    """
+    render the pdf in the background once the ticket is discharged or delivered,
+    since it's going to be printed soon.
+    """
+    if instance.discharge_date or instance.delivered:
+        # wait for the charges saved along with the ticket
+        transaction.on_commit(lambda: schedule_pdf(instance.pk))
+
+
+def schedule_pdf(ticket_id):
+    """
+    queue the pdf render of the ticket, the pdf is rendered on demand if the broker is down
+    """
+    from ticket.tasks import render_pdf
+    try:
+        render_pdf.delay(ticket_id)
+    except Exception:
+        logger.exception('Could not queue the pdf of ticket %s', ticket_id)
+
+
+@receiver(post_delete, sender=Charges)
+def remove_charge_costs(sender, instance, **kwargs):
+    """
+    subtract the deleted charge from the costs of the ticket
+    """
+    ticket_id, charge = getattr(instance, '_loaded_costs', (instance.ticket_id, instance.charge))
+    add_ticket_costs(ticket_id, -Decimal(charge))
+
+
+@receiver([post_save, post_delete], sender=Charges)
+def invalidate_charges_pdf(sender, instance, **kwargs):
+    """
+    remove the cached pdf of the ticket the charge belongs to
+    """
+    cache.invalidate([instance.ticket_id])
+
+
+@receiver([post_save, post_delete], sender=Client)
+@receiver([post_save, post_delete], sender=Device)
+def invalidate_related_pdf(sender, instance, **kwargs):
+    """
+    remove the cached pdf of all the tickets of the client or the device
+    """
+    cache.invalidate(Ticket.objects.filter(**{sender._meta.model_name: instance.pk}).values_list('pk', flat=True))
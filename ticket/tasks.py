@@ -0,0 +1,18 @@
+from cream.celery import app
+from ticket.models import Ticket
+from utils.pdf.ticket import TicketPDF
+from utils.pdf import cache
+
+
+@app.task(ignore_result=True)
+def render_pdf(ticket_id):
+    """
+    Render the pdf of the ticket into the pdf cache unless a fresh file exists already.
+    """
+    ticket = Ticket.objects.for_pdf().filter(pk=ticket_id).first()
+    if ticket is None:
+        # the ticket was deleted before the task run
+        return
+    fingerprint = cache.ticket_fingerprint(ticket)
+    if cache.get(ticket.id, fingerprint) is None:
+        cache.store(TicketPDF(ticket), ticket.id, fingerprint)
@@ -1,3 +1,619 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import tracemalloc
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from unittest import mock, skipUnless
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from client.models import Client, Device, DeviceModel, DeviceType, LedgerEntry
+from storage.models import Part
+from ticket.models import Ticket, TicketQuerySet, TicketStatus, Charges
+from ticket.tasks import render_pdf
+from ticket.views import tickets_response, zip_stream
+from utils.export import buffered
+from utils.pdf import cache
+from utils.pdf.stream import CHUNK_SIZE, PDFStream
+from utils.pdf.ticket import TicketPDF
+from utils.search import normalize
 
-# Create your tests here.
+
+class TicketFixtures:
+    """
+    Creates the status, the part and the clients with their devices the tickets of a test need
+    """
+
+    def setUp(self):
+        super(TicketFixtures, self).setUp()
+        self.status = TicketStatus.objects.create(status='Open')
+        self.part = Part.objects.create(part='Disk')
+        self.device_type = DeviceType.objects.create(type='Laptop')
+        self.device_model = DeviceModel.objects.create(name='ThinkPad')
+        self.client_a = self.create_client('A')
+        self.client_b = self.create_client('B')
+
+    def create_client(self, name):
+        client = Client.objects.create(first_name=name, last_name=name)
+        client.device = Device.objects.create(
+            client=client, model=self.device_model, serial_number='SN' + name, type=self.device_type
+        )
+        return client
+
+    def create_ticket(self, client=None, **fields):
+        client = client or self.client_a
+        fields.setdefault('problem', 'Broken')
+        return Ticket.objects.create(client=client, device=client.device, status=self.status, **fields)
+
+
+class PDFCacheFixtures(TicketFixtures):
+    """
+    Renders the pdf files into a cache directory of the test
+    """
+
+    def setUp(self):
+        super(PDFCacheFixtures, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        settings = override_settings(PDF_CACHE_DIR=self.cache_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def cached_files(self):
+        return sorted(os.listdir(self.cache_dir))
+
+
+class PrintPDFTests(PDFCacheFixtures, TestCase):
+    """
+    The pdf of a ticket is rendered once for every version of the ticket and revalidated with its ETag
+    """
+
+    def setUp(self):
+        super(PrintPDFTests, self).setUp()
+        self.ticket = self.create_ticket(work_charge=20)
+        Charges.objects.create(ticket=self.ticket, part=self.part, charge=10)
+        self.url = '/tickets/{0}/print'.format(self.ticket.pk)
+
+    def get_pdf(self, **headers):
+        response = self.client.get(self.url, **headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, content
+
+    def test_conditional_get(self):
+        response, content = self.get_pdf()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(content.startswith(b'%PDF'))
+        self.assertEqual(self.cached_files(), ['{0}-{1}.pdf'.format(self.ticket.pk, response['ETag'].strip('"'))])
+        with mock.patch.object(TicketPDF, 'render') as render:
+            again, content = self.get_pdf(HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again['ETag'], response['ETag'])
+            # a client without the file gets the cached one
+            self.assertEqual(self.get_pdf()[0].status_code, 200)
+            render.assert_not_called()
+
+    def test_changed_ticket(self):
+        response, content = self.get_pdf()
+        ticket = Ticket.objects.get(pk=self.ticket.pk)
+        ticket.diagnosis = 'Disk failure'
+        ticket.save()
+        # the save removes the file of the old version
+        self.assertEqual(self.cached_files(), [])
+        changed, content = self.get_pdf(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        self.assertEqual(len(self.cached_files()), 1)
+
+    def test_file_removed_before_open(self):
+        ticket = Ticket.objects.for_pdf().get(pk=self.ticket.pk)
+        fingerprint = cache.ticket_fingerprint(ticket)
+        # the file is found but removed by another process before it's opened
+        missing = cache.cache_path(ticket.pk, fingerprint)
+        with mock.patch.object(cache, 'get', return_value=missing):
+            with cache.open_pdf(TicketPDF(ticket), ticket.pk, fingerprint) as pdf_file:
+                self.assertTrue(pdf_file.read().startswith(b'%PDF'))
+        self.assertTrue(os.path.exists(missing))
+
+    def test_zip_of_cached_files(self):
+        other = self.create_ticket(self.client_b)
+        self.get_pdf()
+        with mock.patch.object(cache, 'store', wraps=cache.store) as store:
+            content = b''.join(zip_stream(Ticket.objects.for_pdf().order_by('pk')))
+        # only the ticket that was not cached is rendered
+        self.assertEqual([call[0][1] for call in store.call_args_list], [other.pk])
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ['ticket-{0}.pdf'.format(self.ticket.pk),
+                                                  'ticket-{0}.pdf'.format(other.pk)])
+            self.assertTrue(archive.read('ticket-{0}.pdf'.format(other.pk)).startswith(b'%PDF'))
+
+
+class TicketPDFTests(TicketFixtures, TestCase):
+    """
+    The renders share the fonts and the page template but nothing of the document
+    """
+
+    def setUp(self):
+        super(TicketPDFTests, self).setUp()
+        self.tickets = [self.create_ticket(), self.create_ticket(self.client_b, work_charge=15)]
+        Charges.objects.create(ticket=self.tickets[1], part=self.part, charge=10)
+        self.tickets = list(Ticket.objects.for_pdf().order_by('pk'))
+        # the same document gives the same bytes
+        invariant = mock.patch('reportlab.rl_config.invariant', 1)
+        invariant.start()
+        self.addCleanup(invariant.stop)
+
+    @staticmethod
+    def render(ticket):
+        return TicketPDF(ticket).render(io.BytesIO()).getvalue()
+
+    def test_concurrent_renders(self):
+        expected = [self.render(ticket) for ticket in self.tickets]
+        self.assertNotEqual(expected[0], expected[1])
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(self.render, self.tickets * 8))
+        # which renders differ from the render of the same ticket alone
+        self.assertEqual([number for number, result in enumerate(results) if result != expected[number % 2]], [])
+
+    def test_fonts_registered_once(self):
+        TicketPDF.setup()
+        with mock.patch('utils.pdf.ticket.pdfmetrics.registerFont') as register:
+            self.render(self.tickets[0])
+        register.assert_not_called()
+
+    def test_statistics(self):
+        pdf = TicketPDF(self.tickets[1])
+        pdf.render(io.BytesIO())
+        self.assertGreater(pdf.render_time, 0)
+        self.assertGreaterEqual(pdf.peak_memory, 0)
+        tracemalloc.start()
+        try:
+            pdf.render(io.BytesIO())
+        finally:
+            tracemalloc.stop()
+        # the render allocates the whole document
+        self.assertGreater(pdf.peak_memory, 0)
+        self.assertLessEqual(pdf.memory_growth, pdf.peak_memory)
+
+
+def page_count(content):
+    """
+    returns the number of pages of a pdf made by reportlab
+    """
+    return content.count(b'/Type /Page') - content.count(b'/Type /Pages')
+
+
+class PrintTicketsTests(PDFCacheFixtures, TestCase):
+    """
+    Many tickets are printed into one pdf or a zip file from the admin actions or the filter url
+    """
+
+    def setUp(self):
+        super(PrintTicketsTests, self).setUp()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+        self.tickets = [self.create_ticket(delivered=number % 2 == 0) for number in range(3)]
+        for ticket in self.tickets:
+            Charges.objects.create(ticket=ticket, part=self.part, charge=5)
+
+    def get(self, **params):
+        response = self.client.get('/tickets/print', params)
+        if response.streaming:
+            response.content_bytes = b''.join(response.streaming_content)
+        return response
+
+    def test_admin_actions(self):
+        ids = [ticket.pk for ticket in self.tickets[:2]]
+        response = self.client.post('/admin/ticket/ticket/', {'action': 'print_tickets_pdf', '_selected_action': ids})
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(page_count(b''.join(response.streaming_content)), 2)
+        response = self.client.post('/admin/ticket/ticket/', {'action': 'print_tickets_zip', '_selected_action': ids})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.namelist(), ['ticket-{0}.pdf'.format(pk) for pk in ids])
+
+    def test_filter(self):
+        response = self.get(delivered='true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(page_count(response.content_bytes), 2)
+        response = self.get(id='{0},{1}'.format(self.tickets[1].pk, self.tickets[2].pk), format='zip')
+        with zipfile.ZipFile(io.BytesIO(response.content_bytes)) as archive:
+            self.assertEqual(len(archive.namelist()), 2)
+        today = timezone.localdate().isoformat()
+        self.assertEqual(page_count(self.get(**{'from': today, 'to': today}).content_bytes), 3)
+
+    def test_invalid_filter(self):
+        self.assertEqual(self.get(id='a').status_code, 400)
+        self.assertEqual(self.get(**{'from': '2020-13-01'}).status_code, 400)
+        self.assertEqual(self.get(format='doc').status_code, 400)
+        self.assertEqual(self.get(id='0').status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.get().status_code, 302)
+
+    def test_constant_queries(self):
+        counts = []
+        for tickets in (self.tickets[:1], self.tickets):
+            with CaptureQueriesContext(connection) as queries:
+                b''.join(tickets_response(Ticket.objects.filter(pk__in=[ticket.pk for ticket in tickets])))
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+
+class RenderPDFTaskTests(PDFCacheFixtures, TestCase):
+    """
+    The pdf of a ticket is rendered in the background once the ticket is discharged or delivered
+    """
+
+    def setUp(self):
+        super(RenderPDFTaskTests, self).setUp()
+        self.ticket = self.create_ticket()
+        # run the callbacks of the commit right away, the test case never commits
+        on_commit = mock.patch('django.db.transaction.on_commit', side_effect=lambda callback, using=None: callback())
+        on_commit.start()
+        self.addCleanup(on_commit.stop)
+
+    def test_render(self):
+        render_pdf(self.ticket.pk)
+        self.assertEqual(len(self.cached_files()), 1)
+        with mock.patch.object(cache, 'store') as store:
+            render_pdf(self.ticket.pk)
+        # the file is fresh already
+        store.assert_not_called()
+        # a ticket deleted before the task run
+        render_pdf(0)
+
+    def test_scheduled_on_discharge(self):
+        with mock.patch.object(render_pdf, 'delay') as delay:
+            self.ticket.diagnosis = 'Disk failure'
+            self.ticket.save()
+            delay.assert_not_called()
+            self.ticket.discharge_date = timezone.now()
+            self.ticket.save()
+            delay.assert_called_once_with(self.ticket.pk)
+            self.create_ticket(delivered=True)
+            self.assertEqual(delay.call_count, 2)
+
+    def test_broker_down(self):
+        with mock.patch.object(render_pdf, 'delay', side_effect=OSError('Connection refused')):
+            with self.assertLogs('ticket.models', 'ERROR'):
+                self.create_ticket(delivered=True)
+        # the pdf is rendered on demand instead
+        response = self.client.get('/tickets/{0}/print'.format(self.ticket.pk))
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+
+class StreamTests(PDFCacheFixtures, TestCase):
+    """
+    The pdf and zip files are handed out in chunks instead of one buffer
+    """
+
+    def setUp(self):
+        super(StreamTests, self).setUp()
+        for number in range(3):
+            self.create_ticket(problem='Broken ' * 100)
+        self.tickets = Ticket.objects.for_pdf().order_by('pk')
+        invariant = mock.patch('reportlab.rl_config.invariant', 1)
+        invariant.start()
+        self.addCleanup(invariant.stop)
+
+    def test_pdf_stream(self):
+        output = PDFStream(chunk_size=4)
+        output.write(b'0123456789')
+        output.write(b'ab')
+        self.assertEqual(list(output.chunks()), [b'0123', b'4567', b'89', b'ab'])
+        # what was handed out is forgotten
+        self.assertEqual(list(output.chunks()), [])
+
+    def test_stream_many(self):
+        chunks = list(TicketPDF.stream_many(self.tickets))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) <= CHUNK_SIZE for chunk in chunks))
+        self.assertEqual(b''.join(chunks), TicketPDF.render_many(self.tickets, io.BytesIO()).getvalue())
+
+    def test_render_response(self):
+        ticket = self.tickets[0]
+        response = TicketPDF(ticket).render()
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), TicketPDF(ticket).render(io.BytesIO()).getvalue())
+
+    def test_zip_sent_while_rendered(self):
+        with mock.patch.object(cache, 'store', wraps=cache.store) as store:
+            chunks = zip_stream(self.tickets)
+            first = next(chunks)
+            # the first file is sent before the other tickets are rendered
+            self.assertEqual(store.call_count, 1)
+            content = first + b''.join(chunks)
+        self.assertEqual(store.call_count, 3)
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(len(archive.namelist()), 3)
+        response = tickets_response(Ticket.objects.all(), 'zip')
+        self.assertTrue(response.streaming)
+
+
+class BenchmarkPDFTests(TestCase):
+    """
+    The benchmark renders every fixture and leaves nothing in the database
+    """
+
+    def test_benchmark(self):
+        for options in ([], ['--database']):
+            output = io.StringIO()
+            call_command('benchmark_pdf', '--iterations', '1', '--soak', '2', *options, stdout=output)
+            lines = output.getvalue().splitlines()
+            self.assertEqual([line.split('  ')[0] for line in lines[1:7]], [
+                '0 charges', '10 charges', '100 charges', '1000 charges', 'long text', 'latin text'
+            ])
+            self.assertTrue(lines[7].startswith('soak: 2 renders of "10 charges"'))
+        self.assertFalse(Ticket.objects.exists())
+        self.assertFalse(Client.objects.exists())
+
+
+class TicketAdminTests(TicketFixtures, TestCase):
+    """
+    The changelist of the tickets loads its rows with a constant number of queries
+    """
+
+    def setUp(self):
+        super(TicketAdminTests, self).setUp()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+
+    def changelist(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/ticket/ticket/', params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_constant_queries(self):
+        ticket = self.create_ticket(work_charge=20)
+        Charges.objects.create(ticket=ticket, part=self.part, charge=Decimal('5.50'))
+        response, few = self.changelist()
+        self.assertContains(response, '25.50 €')
+        for number in range(20):
+            ticket = self.create_ticket(self.client_b if number % 2 else self.client_a)
+            Charges.objects.create(ticket=ticket, part=self.part, charge=number)
+        response, many = self.changelist()
+        self.assertEqual(many, few)
+
+    def test_total_cost_order(self):
+        for work_charge in (30, 10, 20):
+            self.create_ticket(work_charge=work_charge)
+        response, queries = self.changelist(o='8')
+        self.assertEqual([ticket.total_cost for ticket in response.context['cl'].result_list], [10, 20, 30])
+
+
+class TicketSearchTests(TicketFixtures, TestCase):
+    """
+    The tickets are searched by the normalized names of their clients and serial numbers of their devices
+    """
+
+    def setUp(self):
+        super(TicketSearchTests, self).setUp()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+        self.greek = self.create_client('Γιώργος')
+        self.greek.last_name = 'Παπαδόπουλος'
+        self.greek.save(update_fields=['last_name'])
+        self.tickets = [self.create_ticket(client) for client in (self.client_a, self.client_b, self.greek)]
+
+    def search(self, term):
+        response = self.client.get('/admin/ticket/ticket/', {'q': term})
+        return [ticket.pk for ticket in response.context['cl'].result_list]
+
+    def test_normalized_fields(self):
+        self.assertEqual(normalize('Παπαδόπουλος  Γιώργος'), 'παπαδοπουλοσ γιωργοσ')
+        self.assertEqual(Client.objects.get(pk=self.greek.pk).search_name, 'γιωργοσ παπαδοπουλοσ')
+        device = Device.objects.get(pk=self.client_b.device.pk)
+        device.serial_number = 'ab-12 CD'
+        device.save(update_fields=['serial_number'])
+        self.assertEqual(Device.objects.get(pk=device.pk).search_serial, 'ab-12 cd')
+
+    def test_search(self):
+        self.assertEqual(self.search('SNB'), [self.tickets[1].pk])
+        self.assertEqual(self.search('Παπαδόπουλος'), [self.tickets[2].pk])
+
+    @skipUnless(connection.vendor == 'postgresql', 'the trigram search needs postgresql')
+    def test_similar_names(self):
+        # without the accents and misspelled
+        self.assertEqual(self.search('παπαδοπουλς'), [self.tickets[2].pk])
+        self.assertEqual(self.search('Papadopoulos'), [])
+
+
+class ChargesTests(TicketFixtures, TestCase):
+    """
+    The cost columns of the tickets and the ledger of the clients follow the charges
+    """
+
+    def setUp(self):
+        super(ChargesTests, self).setUp()
+        self.ticket = self.create_ticket(work_charge=Decimal('20.00'))
+
+    def assertConsistent(self):
+        """
+        the cost columns match the charges, the ledger and the balance of every client match the tickets
+        and the reconciliations find no drift
+        """
+        for ticket in Ticket.objects.all():
+            parts_total = ticket.charges.aggregate(total=Sum('charge'))['total'] or Decimal(0)
+            self.assertEqual(ticket.parts_total, parts_total)
+            self.assertEqual(ticket.total_cost, parts_total + ticket.work_charge)
+        for client in Client.objects.all():
+            expected = client.tickets.aggregate(total=Sum('total_cost'))['total'] or Decimal(0)
+            self.assertEqual(client.ledger.aggregate(total=Sum('amount'))['total'] or Decimal(0), expected)
+            self.assertEqual(client.balance, expected)
+        self.assertFalse(LedgerEntry.objects.filter(amount=0).exists())
+        output = io.StringIO()
+        # the commands warn that they run in the transaction of the test
+        with self.assertLogs('utils.backfill', 'WARNING'):
+            call_command('reconcile_costs', '--dry-run', stdout=output)
+            call_command('rebuild_ledger', '--dry-run', stdout=output)
+        self.assertIn('tickets checked, 0 drifted', output.getvalue())
+        self.assertIn('clients checked, 0 drifted', output.getvalue())
+
+    def test_add_change_and_delete_charges(self):
+        charge = Charges.objects.create(ticket=self.ticket, part=self.part, charge=Decimal('12.50'))
+        Charges.objects.create(ticket=self.ticket, part=self.part, charge=Decimal('7.50'))
+        self.assertConsistent()
+        self.assertEqual(Ticket.objects.get(pk=self.ticket.pk).total_cost, Decimal('40.00'))
+        charge.charge = Decimal('2.50')
+        charge.save()
+        self.assertConsistent()
+        charge.delete()
+        self.assertConsistent()
+        self.assertEqual(Ticket.objects.get(pk=self.ticket.pk).total_cost, Decimal('27.50'))
+
+    def test_charge_loaded_twice(self):
+        charge = Charges.objects.create(ticket=self.ticket, part=self.part, charge=Decimal('10.00'))
+        first, second = Charges.objects.get(pk=charge.pk), Charges.objects.get(pk=charge.pk)
+        first.charge = Decimal('15.00')
+        first.save()
+        # the second copy only adds the difference from what it loaded
+        second.serial_number = 'X1'
+        second.save(update_fields=['serial_number'])
+        self.assertConsistent()
+
+    def test_move_charge_to_other_ticket(self):
+        other = self.create_ticket(self.client_b)
+        charge = Charges.objects.create(ticket=self.ticket, part=self.part, charge=Decimal('30.00'))
+        charge.ticket = other
+        charge.save()
+        self.assertConsistent()
+        self.assertEqual(Ticket.objects.get(pk=other.pk).total_cost, Decimal('30.00'))
+        self.assertEqual(Client.objects.get(pk=self.client_b.pk).balance, Decimal('30.00'))
+
+    def test_ticket_changes(self):
+        Charges.objects.create(ticket=self.ticket, part=self.part, charge=Decimal('5.00'))
+        # a ticket loaded before the charge keeps the costs of the database
+        ticket = Ticket.objects.get(pk=self.ticket.pk)
+        Charges.objects.create(ticket=self.ticket, part=self.part, charge=Decimal('5.00'))
+        ticket.work_charge = Decimal('25.00')
+        ticket.save()
+        self.assertConsistent()
+        self.assertEqual(Ticket.objects.get(pk=ticket.pk).total_cost, Decimal('35.00'))
+        ticket.client = self.client_b
+        ticket.device = self.client_b.device
+        ticket.save()
+        self.assertConsistent()
+
+    def test_delete_ticket(self):
+        Charges.objects.create(ticket=self.ticket, part=self.part, charge=Decimal('5.00'))
+        self.ticket.delete()
+        self.assertConsistent()
+        self.assertEqual(Client.objects.get(pk=self.client_a.pk).balance, 0)
+
+
+class ReconcileCostsTests(TicketFixtures, TestCase):
+    """
+    The reconciliation repairs the cost columns that drifted from the charges and corrects the ledger
+    """
+
+    def setUp(self):
+        super(ReconcileCostsTests, self).setUp()
+        self.ticket = self.create_ticket(work_charge=Decimal('20.00'))
+        Charges.objects.create(ticket=self.ticket, part=self.part, charge=Decimal('10.00'))
+        # changed behind the back of the charges
+        Ticket.objects.filter(pk=self.ticket.pk).update(parts_total=0, total_cost=Decimal('25.00'))
+
+    def reconcile(self):
+        output = io.StringIO()
+        with self.assertLogs('utils.backfill', 'WARNING'):
+            call_command('reconcile_costs', stdout=output)
+        return output.getvalue()
+
+    def assertRepaired(self, total_cost):
+        ticket = Ticket.objects.get(pk=self.ticket.pk)
+        self.assertEqual(ticket.total_cost, total_cost)
+        ledger = LedgerEntry.objects.filter(ticket=ticket).aggregate(total=Sum('amount'))['total']
+        self.assertEqual(ledger, total_cost)
+        self.assertEqual(Client.objects.get(pk=self.client_a.pk).balance, total_cost)
+
+    def test_repair(self):
+        self.assertIn('1 tickets checked, 1 repaired', self.reconcile())
+        self.assertRepaired(Decimal('30.00'))
+        self.assertIn('1 tickets checked, 0 repaired', self.reconcile())
+
+    def test_charge_saved_during_repair(self):
+        refresh_costs = TicketQuerySet.refresh_costs
+
+        def charge_first(queryset):
+            # a charge saved after the drift was found and before the tickets were locked
+            Charges.objects.create(ticket=self.ticket, part=self.part, charge=Decimal('5.00'))
+            return refresh_costs(queryset)
+
+        with mock.patch.object(TicketQuerySet, 'refresh_costs', autospec=True, side_effect=charge_first):
+            self.reconcile()
+        self.assertRepaired(Decimal('35.00'))
+
+
+class ExportTests(TicketFixtures, TestCase):
+    """
+    The tickets and their charges are exported as csv or json lines streamed from one query
+    """
+
+    def setUp(self):
+        super(ExportTests, self).setUp()
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(self.user)
+        self.tickets = [self.create_ticket(delivered=number % 2 == 0) for number in range(3)]
+        for ticket in self.tickets:
+            Charges.objects.create(ticket=ticket, part=self.part, charge=Decimal('5.00'))
+
+    def export(self, url, **params):
+        """
+        :return: the response with its content and the number of queries it took
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+            self.assertTrue(response.streaming)
+            response.text = b''.join(response.streaming_content).decode('utf-8')
+        return response, len(queries)
+
+    def test_csv(self):
+        response, few = self.export('/tickets/export', delivered='true')
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="tickets.csv"')
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        self.assertEqual([int(row['id']) for row in rows], [self.tickets[0].pk, self.tickets[2].pk])
+        self.assertEqual((rows[0]['device_model'], rows[0]['total_cost']), ('ThinkPad', '5.00'))
+        for number in range(5):
+            self.create_ticket(delivered=True)
+        response, many = self.export('/tickets/export', delivered='true')
+        self.assertEqual(many, few)
+
+    def test_jsonl(self):
+        response, queries = self.export('/tickets/charges/export', format='jsonl')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([row['ticket_id'] for row in rows], [ticket.pk for ticket in self.tickets])
+        self.assertEqual((rows[0]['part'], rows[0]['charge']), ('Disk', '5.00'))
+
+    def test_admin_actions(self):
+        ids = [ticket.pk for ticket in self.tickets[1:]]
+        response = self.client.post('/admin/ticket/ticket/', {'action': 'export_tickets_jsonl', '_selected_action': ids})
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], ids)
+        response = self.client.post('/admin/ticket/ticket/', {'action': 'export_charges_csv', '_selected_action': ids})
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 3)
+
+    def test_invalid_request(self):
+        self.assertEqual(self.client.get('/tickets/export', {'format': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get('/tickets/export', {'from': 'yesterday'}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get('/tickets/export').status_code, 302)
+
+    def test_buffered(self):
+        lines = ['{0:>9}\n'.format(number) for number in range(25)]
+        chunks = list(buffered(iter(lines), size=100))
+        self.assertEqual([len(chunk) for chunk in chunks], [100, 100, 50])
+        self.assertEqual(''.join(chunks), ''.join(lines))
@@ -1,7 +1,10 @@
 from django.conf.urls import url, include
-from ticket.views import print_pdf
+from ticket.views import print_pdf, print_tickets, export_tickets, export_charges
 
 
 urlpatterns = [
-    url(r'(?P<pk>\d+)/print', print_pdf)
+    url(r'(?P<pk>\d+)/print', print_pdf),
+    url(r'^print$', print_tickets),
+    url(r'^export$', export_tickets),
+    url(r'^charges/export$', export_charges)
 ]
\ No newline at end of file
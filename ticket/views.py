@@ -1,14 +1,177 @@
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponse
-from ticket.models import Ticket
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse, Http404, HttpResponseBadRequest
+from django.contrib.admin.views.decorators import staff_member_required
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_date
+from django.utils.http import quote_etag
+from ticket.models import Ticket, Charges
+from ticket.adminfilters import TicketDeliveredFilter
 from utils.pdf.ticket import TicketPDF
+from utils.pdf.stream import PDFStream
+from utils.pdf import cache
+from utils.export import CONTENT_TYPES, export_response
+import zipfile
+
+# the columns of the exports as (header, field)
+TICKET_COLUMNS = [
+    ('id', 'pk'),
+    ('client_id', 'client_id'),
+    ('client_first_name', 'client__first_name'),
+    ('client_last_name', 'client__last_name'),
+    ('client_phone', 'client__phone'),
+    ('client_mobile', 'client__mobile'),
+    ('device_id', 'device_id'),
+    ('device_model', 'device__model__name'),
+    ('device_serial_number', 'device__serial_number'),
+    ('status', 'status__status'),
+    ('admission_date', 'admission_date'),
+    ('discharge_date', 'discharge_date'),
+    ('delivered', 'delivered'),
+    ('work_charge', 'work_charge'),
+    ('parts_total', 'parts_total'),
+    ('total_cost', 'total_cost'),
+]
+
+CHARGE_COLUMNS = [
+    ('id', 'pk'),
+    ('ticket_id', 'ticket_id'),
+    ('client_id', 'ticket__client_id'),
+    ('part', 'part__part'),
+    ('serial_number', 'serial_number'),
+    ('charge', 'charge'),
+]
 
 
 def print_pdf(request, pk):
-    ticket = Ticket.objects.get(pk=pk)
-    pdf = TicketPDF(ticket)
-    return pdf.render()
+    # load everything printed on the pdf with the ticket
+    ticket = get_object_or_404(Ticket.objects.for_pdf(), pk=pk)
+    fingerprint = cache.ticket_fingerprint(ticket)
+    etag = quote_etag(fingerprint)
+    # answer the conditional requests of the browser without touching the file
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        # serve the file rendered in the background, wait for it if it's being rendered right now
+        # and render it here if it's still missing
+        pdf_file = cache.open_pdf(TicketPDF(ticket), ticket.id, fingerprint, settings.PDF_RENDER_TIMEOUT)
+        response = FileResponse(pdf_file, content_type='application/pdf')
+        response['Content-Disposition'] = 'inline; filename="ticket.pdf"'
+    response['ETag'] = etag
+    # the browser has to revalidate the pdf every time since the ticket can change
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+@staff_member_required
+def print_tickets(request):
+    """
+    Print all the tickets matching the filter of the query string into one pdf or a zip of pdf files.
+    The filter accepts:
+        id: comma separated ticket ids
+        delivered: true or false, same as the admin filter
+        from, to: the admission date range as YYYY-MM-DD
+        format: pdf (default) or zip
+    """
+    params = request.GET.dict()
+    try:
+        queryset = filter_tickets(request, params)
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    if params.get('format', 'pdf') not in ('pdf', 'zip'):
+        return HttpResponseBadRequest('Invalid format')
+    if not queryset.exists():
+        raise Http404('No tickets matched the filter')
+    return tickets_response(queryset, params.get('format', 'pdf'))
+
+
+def filter_tickets(request, params):
+    """
+    returns the tickets matching the filter of the query string,
+    raises ValueError for the invalid values
+    """
+    queryset = Ticket.objects.all()
+    if params.get('id'):
+        try:
+            ids = [int(pk) for pk in params['id'].split(',')]
+        except ValueError:
+            raise ValueError('Invalid ticket id')
+        queryset = queryset.filter(pk__in=ids)
+    # filter by the delivery status the same way the admin does
+    delivered = TicketDeliveredFilter(request, params, Ticket, None)
+    filtered = delivered.queryset(request, queryset)
+    if filtered is not None:
+        queryset = filtered
+    for param, lookup in (('from', 'admission_date__date__gte'), ('to', 'admission_date__date__lte')):
+        if params.get(param):
+            date = parse_date(params[param])
+            if date is None:
+                raise ValueError('Invalid date {0}'.format(params[param]))
+            queryset = queryset.filter(**{lookup: date})
+    return queryset
+
+
+@staff_member_required
+def export_tickets(request):
+    """
+    Export the tickets matching the filter of the query string, with their client, device, status and costs.
+    The filter is the same as the one of print_tickets and format is csv (default) or jsonl.
+    """
+    params = request.GET.dict()
+    file_format = params.get('format', 'csv')
+    if file_format not in CONTENT_TYPES:
+        return HttpResponseBadRequest('Invalid format')
+    try:
+        queryset = filter_tickets(request, params)
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    return export_response(queryset.order_by('pk'), TICKET_COLUMNS, file_format, 'tickets')
+
+
+@staff_member_required
+def export_charges(request):
+    """
+    Export the charges of the tickets matching the filter of the query string.
+    The filter is the same as the one of print_tickets and format is csv (default) or jsonl.
+    """
+    params = request.GET.dict()
+    file_format = params.get('format', 'csv')
+    if file_format not in CONTENT_TYPES:
+        return HttpResponseBadRequest('Invalid format')
+    try:
+        tickets = filter_tickets(request, params)
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    charges = Charges.objects.filter(ticket__in=tickets.values('pk')).order_by('pk')
+    return export_response(charges, CHARGE_COLUMNS, file_format, 'charges')
+
+
+def tickets_response(queryset, file_format='pdf'):
+    """
+    returns a response with the tickets in one pdf or in a zip file with a pdf for each ticket.
+    The tickets, clients, devices and charges are loaded with a constant number of queries.
+    The zip file is streamed while it's generated, the pdf is sent from a temporary file once it's rendered.
+    """
+    tickets = queryset.for_pdf().order_by('id')
+    if file_format == 'zip':
+        response = StreamingHttpResponse(zip_stream(tickets), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="tickets.zip"'
+    else:
+        response = StreamingHttpResponse(TicketPDF.stream_many(tickets), content_type='application/pdf')
+        response['Content-Disposition'] = 'inline; filename="tickets.pdf"'
+    return response
 
-    # if ticket:
-    #     return HttpResponse(ticket)
 
+def zip_stream(tickets):
+    """
+    Generate a zip file with the pdf of every ticket, sending every file as soon as it's added.
+    """
+    output = PDFStream()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+        for ticket in tickets:
+            # reuse the cached pdf files when the ticket has not changed
+            fingerprint = cache.ticket_fingerprint(ticket)
+            with cache.open_pdf(TicketPDF(ticket), ticket.id, fingerprint) as pdf_file:
+                archive.writestr('ticket-{0}.pdf'.format(ticket.id), pdf_file.read())
+            yield from output.chunks()
+    # the central directory of the zip file
+    yield from output.chunks()
@@ -0,0 +1,118 @@
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.db import connections
+from django.db.models import ForeignKey
+from django.core.exceptions import FieldDoesNotExist
+from utils.pagination import EstimatedCountPaginator, InvalidCursor, decode_cursor, encode_cursor, \
+    keyset_filter, keyset_values, reverse_ordering, estimate_count
+
+# query string parameter of the cursor
+CURSOR_VAR = 'cursor'
+
+
+class KeysetChangeList(ChangeList):
+    """
+    ChangeList that pages by cursors made of the ordering values and the id of the rows
+    instead of an OFFSET, so every page costs the same however deep it is.
+    The cursor of the next page points after the last row of the page
+    and the one of the previous page before its first row.
+    """
+
+    def get_filters_params(self, params=None):
+        params = super(KeysetChangeList, self).get_filters_params(params)
+        params.pop(CURSOR_VAR, None)
+        return params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # the cursor belongs to the current ordering and filters, the other links drop it
+        if not new_params or CURSOR_VAR not in new_params:
+            remove = list(remove or []) + [CURSOR_VAR]
+        return super(KeysetChangeList, self).get_query_string(new_params, remove)
+
+    def keyset_ordering(self):
+        """
+        returns the ordering of the queryset as field names the cursors can follow, or None if it can't be followed.
+        A foreign key is sorted by the ordering of the related model so it's replaced by the fields of that ordering.
+        """
+        ordering = []
+        for term in self.queryset.query.order_by:
+            if not isinstance(term, str):
+                return None
+            descending = term.startswith('-')
+            name = term.lstrip('-')
+            try:
+                field = self.lookup_opts.get_field(name)
+            except FieldDoesNotExist:
+                field = None
+            if isinstance(field, ForeignKey) and field.related_model._meta.ordering:
+                for related_term in field.related_model._meta.ordering:
+                    if not isinstance(related_term, str) or related_term == '?':
+                        return None
+                    prefix = '-' if related_term.startswith('-') != descending else ''
+                    ordering.append(prefix + name + '__' + related_term.lstrip('-'))
+            else:
+                ordering.append(term)
+        return ordering
+
+    def get_results(self, request):
+        self.previous_url = self.next_url = None
+        ordering = self.keyset_ordering()
+        # the template shows the default page links when the ordering can't be followed
+        self.keyset = ordering is not None
+        if ordering is None:
+            return super(KeysetChangeList, self).get_results(request)
+        queryset = self.queryset.order_by(*ordering)
+        nulls_largest = connections[queryset.db].features.nulls_order_largest
+        cursor = request.GET.get(CURSOR_VAR)
+        backwards = False
+        if cursor:
+            try:
+                backwards = cursor.startswith('-')
+                values = decode_cursor(cursor.lstrip('-'))
+            except InvalidCursor:
+                raise IncorrectLookupParameters
+            if backwards:
+                # the rows before the cursor are the rows after it in the opposite ordering
+                before = queryset.filter(keyset_filter(reverse_ordering(ordering), values, nulls_largest))
+                page = queryset.filter(pk__in=before.order_by(*reverse_ordering(ordering)).values('pk')[:self.list_per_page])
+            else:
+                page = queryset.filter(keyset_filter(ordering, values, nulls_largest))[:self.list_per_page]
+        else:
+            page = queryset[:self.list_per_page]
+        rows = list(page)
+
+        # the cursors of the pages around this one
+        if rows:
+            values = keyset_values(queryset, ordering, [rows[0], rows[-1]])
+            first, last = values[rows[0].pk], values[rows[-1].pk]
+            if (cursor and not backwards) or \
+                    queryset.filter(keyset_filter(reverse_ordering(ordering), first, nulls_largest)).exists():
+                self.previous_url = self.get_query_string({CURSOR_VAR: '-' + encode_cursor(first)})
+            if (cursor and backwards) or queryset.filter(keyset_filter(ordering, last, nulls_largest)).exists():
+                self.next_url = self.get_query_string({CURSOR_VAR: encode_cursor(last)})
+
+        paginator = self.model_admin.get_paginator(request, queryset, self.list_per_page)
+        self.result_count = paginator.count
+        self.show_full_result_count = self.model_admin.show_full_result_count
+        if self.show_full_result_count:
+            self.full_result_count = estimate_count(self.root_queryset)
+        else:
+            self.full_result_count = None
+        self.show_admin_actions = not self.show_full_result_count or bool(self.full_result_count)
+        self.result_list = page
+        self.can_show_all = False
+        self.multi_page = bool(self.previous_url or self.next_url)
+        self.paginator = paginator
+
+
+class KeysetPaginationMixin:
+    """
+    Opt-in keyset pagination with estimated totals for the changelist of a ModelAdmin
+    """
+    change_list_template = 'admin/keyset_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        return EstimatedCountPaginator(queryset, per_page, orphans, allow_empty_first_page)
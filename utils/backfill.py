@@ -0,0 +1,122 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+# rows handled by every batch
+BATCH_SIZE = 1000
+
+
+class Backfill:
+    """
+    Walks the rows of a queryset in primary key ranges and hands every range to a function,
+    committing each batch on its own so the rows are never locked for longer than one batch.
+    The last primary key done is kept in a checkpoint file of the database, so a backfill that was stopped
+    continues after the last committed batch when it runs again against the same database.
+    It works the same in the RunPython of a migration, which must be non atomic for the batches
+    to be committed, and in a management command.
+    """
+
+    def __init__(self, name, queryset, batch_size=BATCH_SIZE, sleep=0, checkpoint=True, report=None):
+        """
+        :param name: identifies the checkpoint of the backfill
+        :param queryset: the rows to walk, the batches are ranges of its primary keys
+        :param sleep: seconds to wait after every batch to leave room to the rest of the queries
+        :param checkpoint: keep the progress in a file to resume from it
+        :param report: function called with the progress messages, by default they are logged
+        """
+        self.name = name
+        self.queryset = queryset
+        self.batch_size = batch_size
+        self.sleep = sleep
+        self.checkpoint = checkpoint
+        self.report = report or logger.info
+
+    @property
+    def checkpoint_path(self):
+        """
+        the path of the checkpoint of the backfill in the database of the queryset, so the checkpoint
+        left by a run against one database, like the development one, is never read by a run against another one
+        """
+        database = connections[self.queryset.db].settings_dict
+        key = hashlib.sha1(repr((database['HOST'], database['PORT'], database['NAME'])).encode('utf-8')).hexdigest()
+        return os.path.join(settings.BACKFILL_CHECKPOINT_DIR, '{0}-{1}-{2}.json'.format(
+            self.name, self.queryset.db, key[:12]))
+
+    def load(self):
+        """
+        returns the last primary key done and the rows done so far, from the checkpoint if there is one
+        """
+        if not self.checkpoint or not os.path.exists(self.checkpoint_path):
+            return None, 0
+        with open(self.checkpoint_path) as checkpoint:
+            state = json.load(checkpoint)
+        return state['last_pk'], state['done']
+
+    def save(self, last_pk, done):
+        """
+        write the checkpoint, replacing the file in one step so a stopped process never leaves half of it
+        """
+        if not self.checkpoint:
+            return
+        os.makedirs(settings.BACKFILL_CHECKPOINT_DIR, exist_ok=True)
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'w') as checkpoint:
+            json.dump({'last_pk': last_pk, 'done': done}, checkpoint)
+        os.replace(tmp, self.checkpoint_path)
+
+    def reset(self):
+        """
+        forget the checkpoint so the next run starts from the first row
+        """
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def batches(self, after=None):
+        """
+        generate the last primary key, the size and the queryset of the consecutive ranges of batch_size rows
+        """
+        queryset = self.queryset.order_by('pk')
+        while True:
+            remaining = queryset if after is None else queryset.filter(pk__gt=after)
+            ids = list(remaining.values_list('pk', flat=True)[:self.batch_size])
+            if not ids:
+                return
+            yield ids[-1], len(ids), self.queryset.filter(pk__gte=ids[0], pk__lte=ids[-1])
+            after = ids[-1]
+
+    def run(self, handler):
+        """
+        Call the handler with the queryset of every batch, in a transaction of its own.
+        :param handler: function of the batch queryset, it may return the number of rows it changed
+        :return: the number of rows walked and the number changed
+        """
+        if connections[self.queryset.db].in_atomic_block:
+            # a checkpoint would outlive the batches if the outer transaction is rolled back
+            logger.warning('%s: running inside a transaction, the batches are committed together with it', self.name)
+            self.checkpoint = False
+        last_pk, done = self.load()
+        if last_pk is not None:
+            self.report('{0}: resuming after {1}, {2} rows done before'.format(self.name, last_pk, done))
+        changed = 0
+        walked = 0
+        start = time.perf_counter()
+        for last_pk, count, batch in self.batches(last_pk):
+            with transaction.atomic(using=self.queryset.db):
+                changed += handler(batch) or 0
+            walked += count
+            done += count
+            self.save(last_pk, done)
+            elapsed = time.perf_counter() - start
+            self.report('{0}: {1} rows, {2:.0f} rows/s'.format(self.name, done, walked / elapsed if elapsed else 0))
+            if self.sleep:
+                time.sleep(self.sleep)
+        # finished, the next run starts over
+        if self.checkpoint:
+            self.reset()
+        return walked, changed
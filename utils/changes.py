@@ -0,0 +1,22 @@
+from django.db import models
+from django.utils import timezone
+
+
+class ChangeTrackingQuerySet(models.QuerySet):
+    """
+    QuerySet of a model with an updated_at field that sets it on the rows of every update(),
+    auto_now only covers save() and the change feed would miss the bulk updates.
+    """
+
+    def update(self, **kwargs):
+        kwargs.setdefault('updated_at', timezone.now())
+        return super(ChangeTrackingQuerySet, self).update(**kwargs)
+
+
+def tracked_fields(update_fields):
+    """
+    returns the update_fields of a save() with updated_at added, so saving some of the fields still marks the change
+    """
+    if update_fields is None or 'updated_at' in update_fields:
+        return update_fields
+    return list(update_fields) + ['updated_at']
@@ -0,0 +1,73 @@
+import csv
+import json
+from collections import OrderedDict
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+# size of the pieces sent to the client
+CHUNK_SIZE = 64 * 1024
+
+# the content types of the export formats
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+class Echo:
+    """
+    File object that returns what is written to it, so the csv writer formats a row without keeping it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(header, rows):
+    """
+    generate the header and the rows as csv lines
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(header, rows):
+    """
+    generate the rows as json objects, one in every line
+    """
+    for row in rows:
+        yield json.dumps(OrderedDict(zip(header, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def buffered(lines, size=CHUNK_SIZE):
+    """
+    join the lines into pieces of about size characters so every row is not sent on its own
+    """
+    buffer = []
+    length = 0
+    for line in lines:
+        buffer.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def export_response(queryset, columns, file_format='csv', filename='export'):
+    """
+    returns a response that streams the rows of the queryset as csv or json lines.
+    Only the values of the columns are fetched, through a server side cursor on postgresql,
+    so the memory stays the same however many the rows are and the first rows are sent right away.
+    :param columns: list of (header, field lookup)
+    """
+    header = [name for name, lookup in columns]
+    rows = queryset.values_list(*[lookup for name, lookup in columns]).iterator()
+    lines = csv_lines(header, rows) if file_format == 'csv' else jsonl_lines(header, rows)
+    response = StreamingHttpResponse(buffered(lines), content_type=CONTENT_TYPES[file_format])
+    response['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(filename, file_format)
+    return response
@@ -0,0 +1,84 @@
+import socketserver
+import threading
+import time
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks the part of SMTP that smtplib uses to send a message: EHLO, MAIL, RCPT, DATA, RSET, NOOP and QUIT.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server.smtp
+        with server.lock:
+            server.connections += 1
+        if server.handshake_delay:
+            time.sleep(server.handshake_delay)
+        self.reply('220 localhost ESMTP')
+        for line in self.rfile:
+            command = line.decode('ascii', 'replace').strip().split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self.reply('250-localhost')
+                self.reply('250 8BITMIME')
+            elif command in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                # the message ends with a line with a single dot
+                for data in self.rfile:
+                    if data.rstrip(b'\r\n') == b'.':
+                        break
+                with server.lock:
+                    server.messages += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class LocalSMTPServer:
+    """
+    SMTP server on the local machine that accepts and counts the messages without delivering them.
+    It stands in for the real provider when the sending of the emails is benchmarked offline.
+    The handshake delay is added to every new connection to play the part of the STARTTLS and login round trips.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, handshake_delay=0):
+        self.handshake_delay = handshake_delay
+        self.connections = 0
+        self.messages = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingTCPServer((host, port), SMTPHandler)
+        self.server.smtp = self
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        """
+        serve in a background thread
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        close the server and wait for the thread to finish
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
@@ -1,30 +1,167 @@
+import os
 import smtplib
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.utils import COMMASPACE
+from django.conf import settings
 from django.template import loader
 
+# the errors after which the connection is opened again and the message is sent once more
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError)
 
-def send_mail(send_to, subject, context, send_from='hosting@d-h.gr', server="smtp.office365.com", port=587,
-                          tls=True, html=True,
-                          username='kostas@d-h.gr', password='7419km!*'):
+# the reply of a server that closes the connection, office365 sends it to a connection left idle
+SERVICE_NOT_AVAILABLE = 421
+
+
+def is_connection_error(exc):
+    """
+    returns whether the error means the connection is lost and the message can be sent again over a new one
+    """
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code == SERVICE_NOT_AVAILABLE
+    return isinstance(exc, CONNECTION_ERRORS)
+
+
+class MailTransport:
+    """
+    Keeps one SMTP connection open, with STARTTLS and login done once, and sends many messages over it.
+    When the server has dropped the connection it reconnects and sends the message again.
+    """
+
+    def __init__(self, server, port, tls=True, username=None, password=None, timeout=30):
+        self.server = server
+        self.port = int(port)
+        self.tls = tls
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.connection = None
+        self.pid = None
+
+    def open(self):
+        """
+        open the connection if it's not open already
+        """
+        if self.connection is not None and self.pid == os.getpid():
+            return
+        # a connection inherited from the parent process belongs to it, start a new one
+        self.connection = None
+        connection = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            if self.tls:
+                connection.starttls()
+            if self.username is not None:
+                connection.login(self.username, self.password)
+        except Exception:
+            connection.close()
+            raise
+        self.connection = connection
+        self.pid = os.getpid()
+
+    def close(self):
+        """
+        close the connection, ignoring the errors of a connection the server has dropped already
+        """
+        if self.connection is None:
+            return
+        try:
+            if self.pid == os.getpid():
+                self.connection.quit()
+        except (smtplib.SMTPException, OSError):
+            self.connection.close()
+        finally:
+            self.connection = None
+
+    def send(self, send_from, send_to, message):
+        """
+        send a message, reconnecting once if the connection was lost
+        """
+        self.open()
+        try:
+            self.connection.sendmail(send_from, send_to, message)
+        except (smtplib.SMTPException, OSError) as exc:
+            if not is_connection_error(exc):
+                raise
+            self.close()
+            self.open()
+            self.connection.sendmail(send_from, send_to, message)
+
+
+# the transports of the current thread, a celery worker keeps them between the tasks
+_local = threading.local()
+
+
+def get_transport(server=None, port=None, tls=None, username=None, password=None):
     """
-    Send an email with office365 or any other provider.
+    returns the open transport of the thread for the server and the user, creating it the first time.
+    Without a server the connection of the EMAIL_ settings is used.
+    :return: MailTransport
+    """
+    if server is None:
+        server, port, tls = settings.EMAIL_HOST, settings.EMAIL_PORT, settings.EMAIL_USE_TLS
+        username, password = settings.EMAIL_HOST_USER or None, settings.EMAIL_HOST_PASSWORD
+    if not hasattr(_local, 'transports'):
+        _local.transports = {}
+    key = (server, int(port), tls, username)
+    transport = _local.transports.get(key)
+    if transport is None or transport.password != password:
+        transport = _local.transports[key] = MailTransport(server, port, tls, username, password)
+    return transport
+
+
+def render_notification(context, template_name='notification.html'):
+    """
+    render the notification template
+    :return: string
+    """
+    return loader.render_to_string(template_name, context, using=None)
+
+
+def build_message(send_from, send_to, subject, content, html=True):
+    """
+    build the email message of a rendered content
+    :return: string
     """
     msg = MIMEMultipart()
     msg['From'] = send_from
     msg['To'] = send_to if isinstance(send_to, str) else COMMASPACE.join(send_to)
     msg['Subject'] = subject
 
-    content = loader.render_to_string('notification.html', context, using=None)
-
     msg.attach(MIMEText(content, 'html' if html else 'plain'))
-    smtp = smtplib.SMTP(server, int(port))
+    return msg.as_string()
 
-    if tls:
-        smtp.starttls()
 
-    if username is not None:
-        smtp.login(username, password)
-    smtp.sendmail(send_from, send_to, msg.as_string())
-    smtp.close()
+def send_mail(send_to, subject, context, send_from=None, server=None, port=None, tls=None, html=True,
+              username=None, password=None):
+    """
+    Send an email with the notification template rendered with the context, over the open connection of the thread.
+    Without a server it's sent with the EMAIL_ settings, from DEFAULT_FROM_EMAIL unless send_from is given.
+    """
+    send_content(send_to, subject, render_notification(context), send_from, server, port, tls, html, username, password)
+
+
+def send_content(send_to, subject, content, send_from=None, server=None, port=None, tls=None, html=True,
+                 username=None, password=None):
+    """
+    Send an email with a content rendered already, over the open connection of the thread.
+    Without a server it's sent with the EMAIL_ settings, from DEFAULT_FROM_EMAIL unless send_from is given.
+    """
+    send_from = send_from or settings.DEFAULT_FROM_EMAIL
+    transport = get_transport(server, port, tls, username, password)
+    transport.send(send_from, send_to, build_message(send_from, send_to, subject, content, html))
+
+
+def send_mass_mail(messages, send_from=None, server=None, port=None, tls=None, html=True, username=None, password=None):
+    """
+    Send many emails over one connection, with the EMAIL_ settings unless a server is given.
+    :param messages: iterable of (send_to, subject, context)
+    :return: the number of emails sent
+    """
+    send_from = send_from or settings.DEFAULT_FROM_EMAIL
+    transport = get_transport(server, port, tls, username, password)
+    sent = 0
+    for send_to, subject, context in messages:
+        transport.send(send_from, send_to, build_message(send_from, send_to, subject, render_notification(context), html))
+        sent += 1
+    return sent
@@ -0,0 +1,133 @@
+import base64
+import datetime
+import json
+from functools import reduce
+from operator import and_, or_
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+# below this number of rows the exact count is cheap enough
+ESTIMATE_THRESHOLD = 1000
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    JSON encoder that keeps the microseconds of the times, DjangoJSONEncoder cuts them to milliseconds
+    and the rows of the same millisecond would be repeated on the next page
+    """
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(CursorEncoder, self).default(o)
+
+
+class InvalidCursor(Exception):
+    """
+    raised when a cursor can't be decoded
+    """
+
+
+def encode_cursor(values):
+    """
+    encode the ordering values of a row into an url safe cursor
+    :return: string
+    """
+    data = json.dumps(values, cls=CursorEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    decode a cursor made by encode_cursor
+    :return: list
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return values
+
+
+def reverse_ordering(ordering):
+    """
+    returns the ordering with every field in the opposite direction
+    """
+    return [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+
+
+def keyset_filter(ordering, values, nulls_largest=True):
+    """
+    Build the filter of the rows that come after a row in the ordering.
+    The ordering is a list of field names like the arguments of order_by() and must end with a unique field,
+    the values are the values of these fields on the row.
+    nulls_largest tells if the database sorts nulls after the other values like postgresql does.
+    :return: Q
+    """
+    conditions = []
+    equal = []
+    for term, value in zip(ordering, values):
+        descending = term.startswith('-')
+        field = term.lstrip('-')
+        # do the values after this one include the nulls or are they all nulls
+        if value is None:
+            after = Q(**{field + '__isnull': False}) if descending == nulls_largest else None
+        else:
+            after = Q(**{field + ('__lt' if descending else '__gt'): value})
+            if descending != nulls_largest:
+                after |= Q(**{field + '__isnull': True})
+        if after is not None:
+            conditions.append(reduce(and_, equal + [after]))
+        equal.append(Q(**{field + '__isnull': True}) if value is None else Q(**{field: value}))
+    if not conditions:
+        # nothing comes after the last row
+        return Q(pk__in=[])
+    return reduce(or_, conditions)
+
+
+def keyset_values(queryset, ordering, rows):
+    """
+    returns the values of the ordering fields for each of the rows, with one query
+    :return: dict of primary keys to lists of values
+    """
+    fields = [term.lstrip('-') for term in ordering]
+    values = queryset.order_by().filter(pk__in=[row.pk for row in rows]).values_list('pk', *fields)
+    return {row[0]: list(row[1:]) for row in values}
+
+
+def estimate_count(queryset):
+    """
+    On postgresql returns the number of rows the planner expects the queryset to return,
+    taken from its statistics without running the query. Small results are counted exactly.
+    The other databases always count exactly.
+    :return: int
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.order_by().values('pk').query.get_compiler(queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+    if estimate < ESTIMATE_THRESHOLD:
+        return queryset.count()
+    return estimate
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that takes the number of objects from the planner statistics instead of a COUNT(*)
+    """
+
+    @cached_property
+    def count(self):
+        return estimate_count(self.object_list)
@@ -0,0 +1,139 @@
+import glob
+import hashlib
+import os
+import tempfile
+import time
+from django.conf import settings
+
+# bump the version when the layout of the pdf changes to invalidate the old files.
+CACHE_VERSION = 1
+
+
+def model_state(obj):
+    """
+    returns the values of all the concrete fields of a model instance
+    :return: list
+    """
+    return [(field.attname, getattr(obj, field.attname)) for field in obj._meta.concrete_fields]
+
+
+def ticket_fingerprint(ticket):
+    """
+    Hash everything that is printed on the ticket pdf.
+    The ticket must have its client, device and charges loaded.
+    :return: string
+    """
+    state = [
+        CACHE_VERSION,
+        model_state(ticket),
+        model_state(ticket.client),
+        model_state(ticket.device),
+        ticket.device.model.name if ticket.device.model else None,
+        [(model_state(charge), charge.part.part) for charge in ticket.charges.all()]
+    ]
+    return hashlib.sha1(repr(state).encode('utf-8')).hexdigest()
+
+
+def cache_path(ticket_id, fingerprint):
+    """
+    returns the path of the cached pdf file of a ticket
+    """
+    return os.path.join(settings.PDF_CACHE_DIR, '{0}-{1}.pdf'.format(ticket_id, fingerprint))
+
+
+def get(ticket_id, fingerprint):
+    """
+    returns the path of the cached pdf if it exists or None
+    """
+    path = cache_path(ticket_id, fingerprint)
+    if os.path.exists(path):
+        return path
+    return None
+
+
+def store(pdf, ticket_id, fingerprint):
+    """
+    Render the TicketPDF into the cache and remove any older files of the ticket.
+    :return: the path of the stored file
+    """
+    os.makedirs(settings.PDF_CACHE_DIR, exist_ok=True)
+    path = cache_path(ticket_id, fingerprint)
+    # mark the render as in progress for the processes that need the same file
+    open(path + '.lock', 'w').close()
+    # render to a temporary file first so that readers never see a half written pdf
+    tmp = tempfile.NamedTemporaryFile(dir=settings.PDF_CACHE_DIR, suffix='.tmp', delete=False)
+    try:
+        with tmp:
+            pdf.render(tmp)
+        os.replace(tmp.name, path)
+    except Exception:
+        os.remove(tmp.name)
+        raise
+    finally:
+        remove(path + '.lock')
+    invalidate([ticket_id], keep=path)
+    return path
+
+
+def wait(ticket_id, fingerprint, timeout):
+    """
+    Wait for a render of the same ticket that is in progress in another process.
+    Locks older than the timeout are left by crashed renders and are ignored.
+    :return: the path of the file or None if it wasn't rendered in time
+    """
+    lock = cache_path(ticket_id, fingerprint) + '.lock'
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if time.time() - os.path.getmtime(lock) > timeout:
+                break
+        except FileNotFoundError:
+            # no render in progress
+            break
+        time.sleep(0.1)
+    return get(ticket_id, fingerprint)
+
+
+def open_pdf(pdf, ticket_id, fingerprint, timeout=0):
+    """
+    Open the cached pdf of a ticket, waiting up to timeout seconds for a render in progress
+    and rendering it when it's missing.
+    The file can be removed by an invalidation or a newer render between finding it and opening it,
+    then it's rendered again. Once open the file stays readable even if it's removed.
+    :return: the pdf file opened for reading
+    """
+    path = get(ticket_id, fingerprint)
+    if path is None and timeout:
+        path = wait(ticket_id, fingerprint, timeout)
+    for attempt in range(2):
+        if path is not None:
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                pass
+        path = store(pdf, ticket_id, fingerprint)
+    # the ticket keeps changing while it's rendered, serve this render without caching it
+    output = tempfile.TemporaryFile()
+    pdf.render(output)
+    output.seek(0)
+    return output
+
+
+def invalidate(ticket_ids, keep=None):
+    """
+    Remove the cached pdf files of the given tickets.
+    """
+    for ticket_id in ticket_ids:
+        for path in glob.glob(cache_path(ticket_id, '*')):
+            if path != keep:
+                remove(path)
+
+
+def remove(path):
+    """
+    remove a file that might have been removed by another process already
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
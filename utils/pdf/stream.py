@@ -0,0 +1,43 @@
+from collections import deque
+
+# size of the pieces sent to the client
+CHUNK_SIZE = 64 * 1024
+
+
+class PDFStream:
+    """
+    Write only file object that keeps what is written to it until it's handed out in chunks.
+    It's used as the output of reportlab and zipfile so the result can be sent with a StreamingHttpResponse
+    without copying the whole document into an HttpResponse first.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.buffers = deque()
+
+    def write(self, data):
+        self.buffers.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def chunks(self):
+        """
+        hands out and forgets what was written so far, in pieces of chunk_size at most
+        """
+        while self.buffers:
+            data = memoryview(self.buffers.popleft())
+            for start in range(0, len(data), self.chunk_size):
+                yield data[start:start + self.chunk_size].tobytes()
+
+
+def file_chunks(file, chunk_size=CHUNK_SIZE):
+    """
+    generate the content of a file from its current position in pieces of chunk_size at most
+    """
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            return
+        yield data
@@ -1,19 +1,43 @@
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import Paragraph, Frame, Table, TableStyle, BaseDocTemplate, PageTemplate, FrameBreak
+from reportlab.platypus import Paragraph, Frame, Table, TableStyle, BaseDocTemplate, PageTemplate, FrameBreak, \
+    PageBreak
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.colors import Color
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from utils.pdf.stream import PDFStream, file_chunks
+import logging
 import os
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
 
 PAGE_HEIGHT = A4[1]
 PAGE_WIDTH = A4[0]
 
+# name of the form with what is printed on every page
+PAGE_FORM = 'TicketPage'
+
+logger = logging.getLogger(__name__)
+
+
+class TicketDocTemplate(BaseDocTemplate):
+    """
+    Document of tickets that draws the background, the logo and the title once, into a form used by every page.
+    """
+
+    def beforeDocument(self):
+        TicketPDF.draw_page_form(self.canv)
+
 
 class TicketPDF:
     """
     Generate pdf of a Ticket.
+    The fonts are registered and the page template is built once and reused by every render,
+    everything else lives on the instance. The threads of a process build their documents one at a time.
     """
     # generate the paths for the files used.
     base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -40,27 +64,64 @@ class TicketPDF:
     styleH.borderColor = Color(0, 0.6, 0.8, 1)
     styleH.fontSize = 14
     styleH.alignment = 1
-    # story lists for the frames
-    story = []
-    # create the frames
+    # the position and size of the frames
     htwelve = PAGE_HEIGHT / 12
-    info_frame_left = Frame(0, htwelve * 9, PAGE_WIDTH/2, (PAGE_HEIGHT / 12) * 1.4, leftPadding=30)
-    info_frame_right = Frame(PAGE_WIDTH / 2, htwelve * 9, PAGE_WIDTH / 2, htwelve * 1.4, leftPadding=30)
-    left_frame = Frame(0, htwelve * 6, PAGE_WIDTH / 2, htwelve * 3, leftPadding=30)
-    right_frame = Frame(PAGE_WIDTH / 2, htwelve * 6, PAGE_WIDTH / 2, htwelve * 3, leftPadding=30)
-    actions_frame = Frame(0, htwelve * 4, PAGE_WIDTH, htwelve * 2, leftPadding=30)
-    parts_frame = Frame(0, 0, PAGE_WIDTH, htwelve * 4, leftPadding=30)
+    frames = [
+        (0, htwelve * 9, PAGE_WIDTH / 2, htwelve * 1.4),  # client info
+        (PAGE_WIDTH / 2, htwelve * 9, PAGE_WIDTH / 2, htwelve * 1.4),  # device info
+        (0, htwelve * 6, PAGE_WIDTH / 2, htwelve * 3),  # problem
+        (PAGE_WIDTH / 2, htwelve * 6, PAGE_WIDTH / 2, htwelve * 3),  # diagnosis
+        (0, htwelve * 4, PAGE_WIDTH, htwelve * 2),  # actions
+        (0, 0, PAGE_WIDTH, htwelve * 4),  # parts
+    ]
+    # resources shared by the renders of the process
+    _lock = threading.Lock()
+    _fonts = False
+    # the registered fonts are subset into every document from the same font face, which is not thread safe,
+    # so the documents of the threads of a process are built one at a time
+    _build_lock = threading.Lock()
+    # the frames keep their layout state while building so every thread gets its own page template
+    _local = threading.local()
 
     def __init__(self, ticket):
-        # Generate the response object and set the contant type
-        self.response = HttpResponse(content_type='application/pdf')
-        # Change the disposition of the pdf file
-        self.response['Content-Disposition'] = 'inline; filename="ticket.pdf"'
-        # register the font to the pdf class
-        pdfmetrics.registerFont(TTFont('Verdana', self.font_file))
-        pdfmetrics.registerFont(TTFont('VerdanaBold', self.font_file_bold))
+        # register the fonts the first time a pdf is generated
+        self.setup()
         # get the ticket passed to the class.
         self.ticket = ticket
+        # the flowables of the document
+        self.story = []
+        # statistics of the last render
+        self.render_time = None
+        self.peak_memory = None
+        self.memory_growth = None
+
+    @classmethod
+    def setup(cls):
+        """
+        Register the fonts once per process.
+        """
+        if cls._fonts:
+            return
+        with cls._lock:
+            if not cls._fonts:
+                pdfmetrics.registerFont(TTFont('Verdana', cls.font_file))
+                pdfmetrics.registerFont(TTFont('VerdanaBold', cls.font_file_bold))
+                cls._fonts = True
+
+    @classmethod
+    def page_template(cls):
+        """
+        returns the page template of the current thread
+        :return: PageTemplate
+        """
+        template = getattr(cls._local, 'template', None)
+        if template is None:
+            template = PageTemplate(
+                frames=[Frame(*frame, leftPadding=30) for frame in cls.frames],
+                onPage=cls.build_page
+            )
+            cls._local.template = template
+        return template
 
     def print_client_info(self):
         """
@@ -70,16 +131,16 @@ class TicketPDF:
             Paragraph('Πληροφορίες Πελάτη', self.styleH)
         )
         self.story.append(
-            Paragraph('<font color=(0,0.6,0.8)>Πελάτης: </font>{0}'.format(self.ticket.client.full_name()), self.styleN)
+            Paragraph('<font color="#0099cc">Πελάτης: </font>{0}'.format(self.ticket.client.full_name()), self.styleN)
         )
         self.story.append(
-            Paragraph('<font color=(0,0.6,0.8)>Σταθερό: </font>{0}'.format(self.ticket.client.landline()), self.styleN)
+            Paragraph('<font color="#0099cc">Σταθερό: </font>{0}'.format(self.ticket.client.landline()), self.styleN)
         )
         self.story.append(
-            Paragraph('<font color=(0,0.6,0.8)>Κινητό: </font>{0}'.format(self.ticket.client.mobile_phone()), self.styleN)
+            Paragraph('<font color="#0099cc">Κινητό: </font>{0}'.format(self.ticket.client.mobile_phone()), self.styleN)
         )
         self.story.append(
-            Paragraph('<font color=(0,0.6,0.8)>Service ID: </font>{0}'.format(self.ticket.id), self.styleN)
+            Paragraph('<font color="#0099cc">Service ID: </font>{0}'.format(self.ticket.id), self.styleN)
         )
         self.story.append(FrameBreak())
 
@@ -91,16 +152,16 @@ class TicketPDF:
             Paragraph('Πληροφορίες Συσκευής', self.styleH)
         )
         self.story.append(
-            Paragraph('<font color=(0,0.6,0.8)>Ημερομηνία Εισαγωγής: </font>{0}'.format(self.ticket.admission_date.strftime("%d-%m-%Y")), self.styleN)
+            Paragraph('<font color="#0099cc">Ημερομηνία Εισαγωγής: </font>{0}'.format(self.ticket.admission_date.strftime("%d-%m-%Y")), self.styleN)
         )
         self.story.append(
-            Paragraph('<font color=(0,0.6,0.8)>Ημερομηνία Εξαγωγής: </font>{0}'.format(self.ticket.discharge_full_date()), self.styleN)
+            Paragraph('<font color="#0099cc">Ημερομηνία Εξαγωγής: </font>{0}'.format(self.ticket.discharge_full_date()), self.styleN)
         )
         self.story.append(
-            Paragraph('<font color=(0,0.6,0.8)>Συσκευή: </font>{0}'.format(self.ticket.device.model), self.styleN)
+            Paragraph('<font color="#0099cc">Συσκευή: </font>{0}'.format(self.ticket.device.model), self.styleN)
         )
         self.story.append(
-            Paragraph('<font color=(0,0.6,0.8)>S/N: </font>{0}'.format(self.ticket.device.serial_number), self.styleN)
+            Paragraph('<font color="#0099cc">S/N: </font>{0}'.format(self.ticket.device.serial_number), self.styleN)
         )
         self.story.append(FrameBreak())
 
@@ -150,9 +211,9 @@ class TicketPDF:
         heading = [['Ανταλλακτικό', 'Serial Number', 'Τιμή']]
         parts = [[x.part.part, x.serial_number, "{0} €".format(x.charge)] for x in self.ticket.charges.all()]
         prices = [
-            ['', 'Σύνολο Ανταλλακτικών', "{0} €".format(self.ticket.parts_cost())],
+            ['', 'Σύνολο Ανταλλακτικών', "{0} €".format(self.ticket.parts_total)],
             ['', 'Σύνολο Εργασίας', "{0} €".format(self.ticket.work_charge)],
-            ['', 'Τελικό Σύνολο', "{0} €".format(self.ticket.total_cost())]
+            ['', 'Τελικό Σύνολο', "{0} €".format(self.ticket.total_cost)]
         ]
         data = heading + parts + prices
         # set the table style
@@ -174,7 +235,12 @@ class TicketPDF:
         self.story.append(table)
 
     @staticmethod
-    def build_page(canvas, doc):
+    def draw_page_form(canvas):
+        """
+        Draw what is printed on every page into a form of the document.
+        The images are embedded once per document and every page refers to the form instead of drawing them again.
+        """
+        canvas.beginForm(PAGE_FORM)
         canvas.saveState()
         canvas.drawImage(TicketPDF.background_image, 0, 0)
         canvas.drawImage(TicketPDF.dh_logo, 50, 750, 200, 80, True, 'c')
@@ -182,36 +248,117 @@ class TicketPDF:
         canvas.drawString(350, 780, "Παραστατικό Service")
         # print the dividing line
         # TicketPDF.draw_line(730)
+        canvas.restoreState()
+        canvas.endForm()
+
+    @staticmethod
+    def build_page(canvas, doc):
+        canvas.saveState()
+        canvas.doForm(PAGE_FORM)
         canvas.setFont(TicketPDF.font, 16)
         canvas.restoreState()
 
-    def render(self):
+    def build_story(self):
         """
-        Render the file and return the HttpResponse with the file.
-        :return: HttpResponse
+        Generate the flowables of the ticket.
+        :return: list
         """
-        doc = BaseDocTemplate(
-            self.response,
-            title="{0} - ServiceID {1}".format(self.ticket.client.full_name(), self.ticket.id),
-            author='Digital Horizon'
-        )
-        doc.addPageTemplates([
-            PageTemplate(
-                frames=[
-                    self.info_frame_left,
-                    self.info_frame_right,
-                    self.left_frame,
-                    self.right_frame,
-                    self.actions_frame,
-                    self.parts_frame
-                ], onPage=TicketPDF.build_page
-            )
-        ])
+        self.story = []
         self.print_client_info()
         self.print_device_info()
         self.print_problem()
         self.print_diagnosis()
         self.print_actions()
         self.print_parts()
-        doc.build(self.story)
-        return self.response
+        return self.story
+
+    def render(self, output=None):
+        """
+        Render the file into the output file.
+        Without an output the file is rendered lazily into a StreamingHttpResponse.
+        The time and the memory of the render are kept in render_time, peak_memory and memory_growth and logged.
+        :return: StreamingHttpResponse or the output file
+        """
+        if output is None:
+            # Generate the response object and set the contant type
+            response = StreamingHttpResponse(self.stream(), content_type='application/pdf')
+            # Change the disposition of the pdf file
+            response['Content-Disposition'] = 'inline; filename="ticket.pdf"'
+            return response
+        started = time.perf_counter()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # with PYTHONTRACEMALLOC=1 the peak is counted from the start of this render,
+            # the traces of the earlier allocations are dropped
+            tracemalloc.clear_traces()
+        else:
+            peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        doc = TicketDocTemplate(
+            output,
+            title="{0} - ServiceID {1}".format(self.ticket.client.full_name(), self.ticket.id),
+            author='Digital Horizon'
+        )
+        doc.addPageTemplates([self.page_template()])
+        story = self.build_story()
+        with self._build_lock:
+            doc.build(story)
+        # keep the statistics of the render, the memory in KiB
+        self.render_time = time.perf_counter() - started
+        if tracing:
+            # the most memory the render allocated and what is still allocated after it
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak_memory = peak // 1024
+            self.memory_growth = current // 1024
+            logger.info('Rendered ticket %s in %.1f ms, peak memory %d KiB (%+d KiB)',
+                        self.ticket.id, self.render_time * 1000, self.peak_memory, self.memory_growth)
+        else:
+            # without the traces only how much the render raised the peak resident memory of the process is known
+            self.peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_before
+            logger.info('Rendered ticket %s in %.1f ms, peak resident memory %+d KiB',
+                        self.ticket.id, self.render_time * 1000, self.peak_memory)
+        return output
+
+    @classmethod
+    def render_many(cls, tickets, output):
+        """
+        Render many tickets into one document, every ticket starts on a new page.
+        All the tickets share the fonts, the images and the page form.
+        :return: the output file
+        """
+        started = time.perf_counter()
+        doc = TicketDocTemplate(output, title='Service Tickets', author='Digital Horizon')
+        doc.addPageTemplates([cls.page_template()])
+        story = []
+        count = 0
+        for ticket in tickets:
+            if story:
+                story.append(PageBreak())
+            story.extend(cls(ticket).build_story())
+            count += 1
+        if story:
+            with cls._build_lock:
+                doc.build(story)
+        logger.info('Rendered %d tickets in %.1f ms', count, (time.perf_counter() - started) * 1000)
+        return output
+
+    def stream(self):
+        """
+        Render the file when the first chunk is requested and hand it out in chunks.
+        reportlab writes the document only when it's built completely, so nothing is sent
+        before the whole pdf is rendered and it's kept in memory until it's sent.
+        """
+        output = PDFStream()
+        self.render(output)
+        yield from output.chunks()
+
+    @classmethod
+    def stream_many(cls, tickets):
+        """
+        Same as render_many but hands the file out in chunks.
+        The document is spooled to a temporary file and read back from there,
+        so the finished pdf of many tickets is never kept in memory.
+        """
+        with tempfile.TemporaryFile() as output:
+            cls.render_many(tickets, output)
+            output.seek(0)
+            yield from file_chunks(output)
@@ -0,0 +1,14 @@
+import unicodedata
+
+
+def normalize(text):
+    """
+    Normalize a text for searching, it removes the accents, lowercases it and collapses the white space.
+    e.g. 'Παπαδόπουλος  Γιώργος' -> 'παπαδοπουλοσ γιωργοσ'
+    :return: string
+    """
+    if not text:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', text)
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.casefold().split())